@@ -391,11 +391,14 @@ class AbstractGeocacheLayer(AbstractMapLayer):
 
     MAX_NUM_RESULTS_SHOW = 100
 
-    def __init__(self, get_geocaches_callback, show_cache_callback):
+    def __init__(self, get_geocaches_callback, show_cache_callback, get_clusters_callback = None):
         AbstractMapLayer.__init__(self)
         #self.show_found = False
         self.show_name = False
         self.get_geocaches_callback = get_geocaches_callback
+        # Returns the clusters (see PointProvider.get_clusters) which are drawn
+        # instead of the geocaches if there are too many of them, or None.
+        self.get_clusters_callback = get_clusters_callback
         self.visualized_geocaches = []
         self.show_cache_callback = show_cache_callback
         self.current_cache = None
@@ -407,6 +410,11 @@ class AbstractGeocacheLayer(AbstractMapLayer):
         else:
             self.select_found = False
     '''
+    def get_clusters(self, area, zoom):
+        if self.get_clusters_callback == None:
+            return None
+        return self.get_clusters_callback(area, zoom)
+
     def set_show_name(self, show_name):
         self.show_name = show_name
 
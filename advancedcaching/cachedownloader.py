@@ -31,14 +31,14 @@ try:
 except (ImportError, AttributeError):
     import simplejson as json	 
 from geocaching import GeocacheCoordinate
-from downloader import read_from_network
+from downloader import read_from_network, BodyCollector
 import geo
 import os
 import threading
 import re
 import gobject
 from utils import HTMLManipulations
-from lxml.html import fromstring, tostring
+from lxml.html import fromstring, tostring, HTMLParser
 
 #ugly workaround...
 user_token = [None]
@@ -292,11 +292,11 @@ class GeocachingComCacheDownloader(CacheDownloader):
             i += 1
             coordinate.found = found
             logger.debug("Coordinate %s, found=%r" % (coordinate.name, found))
-            self.emit("progress", "Geocache %d of %d" % (i, len(points_that_need_downloading)), i, len(points_that_need_downloading))
+            self.emit("progress", "Geocache %d of %d%s" % (i, len(points_that_need_downloading), self.downloader.get_cache_status()), i, len(points_that_need_downloading))
             logger.info("Downloading %s..." % id)
             url = self.PRINT_PREVIEW_URL_FULLNAME % fullname
-            response = self.downloader.get_reader(url, login_callback = self.login_callback, check_login_callback = self.check_login_callback)                
-            result = self.__parse_cache_page(response, coordinate, 10, progress_min = i, progress_max = i+1, progress_all = len(points_that_need_downloading), download_images = False)
+            doc = self._get_document(url)
+            result = self.__parse_cache_page(doc, coordinate, 10, progress_min = i, progress_max = i+1, progress_all = len(points_that_need_downloading), download_images = False)
             if result != None and result.lat != -1:
                 points_finished.append(result)
                 
@@ -308,14 +308,30 @@ class GeocachingComCacheDownloader(CacheDownloader):
         logger.debug("_update_coordinate, pmin = %f, pmax = %f." % (progress_min, progress_max))
         
         # Progress should be displayed in the range between progress_min and progress_max. 
-        self.emit('progress', "Downloading %s" % coordinate.name, progress_min, progress_all)
+        self.emit('progress', "Downloading %s%s" % (coordinate.name, self.downloader.get_cache_status()), progress_min, progress_all)
         
         url = self.DETAILS_URL % coordinate.name
-        response = self.downloader.get_reader(url, login_callback = self.login_callback, check_login_callback = self.check_login_callback)
+        doc = self._get_document(url)
             
-        return self.__parse_cache_page(response, coordinate, num_logs, progress_min = progress_min, progress_max = progress_max, progress_all = progress_all)
+        return self.__parse_cache_page(doc, coordinate, num_logs, progress_min = progress_min, progress_max = progress_max, progress_all = progress_all)
 
     
+    def _get_document(self, url):
+        """
+        Download the page at url and return its document tree, or None.
+        
+        The page is parsed while it is downloaded, so it is never held in memory as a whole.
+        
+        """
+        return self.downloader.get_parsed(url, lambda: HTMLParser(encoding='utf-8'), login_callback = self.login_callback, check_login_callback = self.check_login_callback)
+
+    def _get_logs(self, url):
+        """
+        Download and parse a page of the logbook at url.
+        
+        """
+        return self._parse_logs_json(self.downloader.get_parsed(url, BodyCollector, login_callback = self.login_callback, check_login_callback = self.check_login_callback))
+
     @staticmethod
     def check_login_callback(downloader):
         login_request = downloader.get_reader(GeocachingComCacheDownloader.NEAREST_URL, login = False)
@@ -358,17 +374,11 @@ class GeocachingComCacheDownloader(CacheDownloader):
             return True
         raise Exception("Name/Password MAY be correct, but I encountered unexpected data while logging in.")
         
-    def __parse_cache_page(self, cache_page, coordinate, num_logs, download_images = True, progress_min = 0.0, progress_max = 1.0, progress_all = 1.0):
+    def __parse_cache_page(self, doc, coordinate, num_logs, download_images = True, progress_min = 0.0, progress_max = 1.0, progress_all = 1.0):
         logger.debug("Start parsing, pmin = %f, pmax = %f." % (progress_min, progress_max))
-        if cache_page == None:
+        if doc == None:
             logger.warning("Can't parse this cache, it is None")
             return
-        pg = read_from_network(cache_page)
-        if pg == None:
-            return False
-
-        t = unicode(pg, 'utf-8')
-        doc = fromstring(t)
                 
         # Basename - Image name without path and extension
         def basename(url):
@@ -498,11 +508,7 @@ class GeocachingComCacheDownloader(CacheDownloader):
         self.emit('progress', 'Fetching logs', progress_min + 0.2 * (progress_max - progress_min), progress_all)
         
         #Ask first page of logs. And same time number of pages
-        logs = self.downloader.get_reader(
-            self.LOGBOOK_URL % (userToken, 1),
-            login_callback = self.login_callback, 
-            check_login_callback = self.check_login_callback)
-        new_set_of_logs.extend(self._parse_logs_json(read_from_network(logs)))
+        new_set_of_logs.extend(self._get_logs(self.LOGBOOK_URL % (userToken, 1)))
 
         #First page is already handled, so counter starts from 2
         counter = 2
@@ -514,11 +520,7 @@ class GeocachingComCacheDownloader(CacheDownloader):
             logger.debug("- Progress internal is %f" % progress_internal)
             logger.debug("- Progress is %f of %f" % (progress_min + progress_internal * (progress_max - progress_min), progress_all))
             self.emit('progress', "Logs (%d)" % counter, progress_min + progress_internal * (progress_max - progress_min), progress_all)
-            logs = self.downloader.get_reader(
-                self.LOGBOOK_URL % (userToken, counter),
-                login_callback = self.login_callback, 
-                check_login_callback = self.check_login_callback)
-            new_set_of_logs.extend(self._parse_logs_json(read_from_network(logs)))
+            new_set_of_logs.extend(self._get_logs(self.LOGBOOK_URL % (userToken, counter)))
 
             counter += 1
             
@@ -1073,12 +1075,36 @@ if __name__ == '__main__':
     
    
     outfile = None
-    if len(sys.argv) != 3: 
+    # With --record DIR, all HTTP requests are recorded into DIR. With
+    # --replay DIR [latency in ms] [bandwidth in KB/s], they are answered
+    # from DIR instead, so the test runs offline and deterministically.
+    args = sys.argv[1:]
+    cookies = '/tmp/cookies'
+    if '--record' in args:
+        i = args.index('--record')
+        downloader.enable_http_recording(args[i + 1])
+        args = args[:i] + args[i + 2:]
+        cookies = None
+    elif '--replay' in args:
+        i = args.index('--replay')
+        options = args[i + 1:]
+        args = args[:i]
+        latency = float(options[1]) / 1000 if len(options) > 1 else 0
+        bandwidth = float(options[2]) * 1024 if len(options) > 2 else 0
+        downloader.enable_http_replay(options[0], latency, bandwidth)
+        cookies = None
+    if len(args) != 2: 
         logger.error("Please provide username and password on the command line.")
         sys.exit(2)
+    if cookies == None:
+        # The replayed requests depend on whether the login cookies are valid, so always start without them
+        import tempfile
+        cookies = os.path.join(tempfile.mkdtemp(), 'cookies')
 
-    name, password = sys.argv[1:3]
-    a = parser(downloader.FileDownloader(name, password, '/tmp/cookies'), '/tmp/', True)
+    name, password = args
+    a = parser(downloader.FileDownloader(name, password, cookies), '/tmp/', True)
+    from time import time
+    start = time()
 
     logger.info("Using Username %s" % name)
 
@@ -1147,6 +1173,7 @@ if __name__ == '__main__':
     logger.info(u"Owner:%r (type %r)\nTitle:%r (type %r)\nTerrain:%r\nDifficulty:%r\nDescription:%r (type %r)\nShortdesc:%r (type %r)\nHints:%r (type %r)\nLogs: %r\nAttributes: %r" % (c.owner, type(c.owner), c.title, type(c.title), c.get_terrain(), c.get_difficulty(), c.desc[:200], type(c.desc), c.shortdesc, type(c.shortdesc), c.hints, type(c.hints), c.get_logs()[:3], c.attributes))
     logger.info(c.get_waypoints())
     
+    logger.info("Downloading took %.2f s" % (time() - start))
     if errors > 0:
         sys.exit("Found %d error(s)." % errors)
         
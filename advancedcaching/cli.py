@@ -23,6 +23,7 @@
 import geocaching
 import sys
 import geo
+import geobatch
 import math
 import os
 import re
@@ -70,6 +71,10 @@ options:
         --user(name) username
         --pass(word) password
                 Your geocaching.com login data.
+        --http-cache-size megabytes
+                Size of the cache for downloaded pages, which are only downloaded
+                again if they have changed (default: 32). Larger sizes help when
+                updating the details of many geocaches at once.
 importactions:
         --skip-found
         --skip-existing
@@ -109,6 +114,10 @@ filter-options:
         -i|--id id-search-string
         -a|--attribute attribute-search-string
                 Search owner, name (title), id or attributes of the geocaches (see below for search string syntax).
+        -x|--text words
+                Full text search in name, title, owner, attributes, description, hints
+                and logs. Matches geocaches which contain all words (or words starting
+                with them) and sorts them by relevance.
         --new
                 Caches which were downloaded in current session. Useful to
                 get alerted when new caches arrive.
@@ -189,7 +198,9 @@ class Cli():
     def __init__(self, core):
         self.nt = 1
         self.core = core
+        # None means all geocaches (or all results of self.query), see iter_caches
         self.caches = None
+        self.query = None
         self.new_caches = []
         self.pointprovider = core.pointprovider
         core.connect('progress', lambda caller, fraction, text: self.show_progress(fraction, text))
@@ -222,11 +233,19 @@ class Cli():
         return False
             
             
-    def check_caches_retrieved(self):
-        if self.caches == None:
-            self.caches = self.pointprovider.get_all()
-            print "* retrieved all caches (%d) from database" % len(self.caches)
-        
+    def iter_caches(self):
+        """
+        Iterate over the current geocaches.
+        
+        As long as no filter was applied, the geocaches are streamed from the database each time, so the whole database is never held in memory.
+        
+        """
+        if self.caches != None:
+            return iter(self.caches)
+        elif self.query != None:
+            return self.pointprovider.iter_by_query(self.query)
+        return self.pointprovider.iter_all()
+
 
     def parse_input (self):
         while self.has_next():
@@ -270,6 +289,8 @@ class Cli():
             elif token == '--user' or token == '--username':
                 username = self.parse_string()
                 self.set_username(username)
+            elif token == '--http-cache-size':
+                self.set_http_cache_size(self.parse_int())
             else:
                 raise ParseError("I don't understand '%s'" % token)
         print "* Finished setting options."
@@ -346,21 +367,31 @@ class Cli():
     def parse_sql(self):
         self.nt += 1
         if not self.has_next():
-            print "Table structure for geocaches:"
-            info = self.pointprovider.get_table_info()
+            for title, details in (("geocaches", False), ("geocache_details (join on name)", True)):
+                print "Table structure for %s:" % title
+                info = self.pointprovider.get_table_info(details)
 
-            for row in info:
-                #Note: sqlite3.Row is iterable since python2.6 (agtl targets to python2.5)
-                print "\t".join([str(row[i]) for i in range(len(row))])  
+                for row in info:
+                    #Note: sqlite3.Row is iterable since python2.6 (agtl targets to python2.5)
+                    print "\t".join([str(row[i]) for i in range(len(row))])  
             print "Example SQL-Query:"
             print "SELECT * FROM geocaches WHERE type = 'multi' AND name LIKE 'GC1X%' AND found = 0 ORDER BY title DESC LIMIT 5"
             raise ParseError("Expected sql string.")
         text = self.parse_string()
-        self.caches = self.pointprovider.get_by_query(text)
+        results = self.pointprovider.iter_by_query(text)
+        try:
+            results.next()
+        except StopIteration:
+            # No results, e.g. for an UPDATE statement, which must not run again
+            self.caches = []
+        else:
+            # The results are read again each time they are used
+            results.close()
+            self.caches = None
+            self.query = text
             
         
     def parse_filter(self):
-        self.check_caches_retrieved()
         self.nt += 1
         if not self.has_next():
             raise ParseError("Expected filter options.")
@@ -408,6 +439,9 @@ class Cli():
             elif token == '-a' or token == '--attribute':
                 attribute = self.parse_string()
                 self.add_filter_attribute (attribute)
+            elif token == '-x' or token == '--text':
+                text = self.parse_string()
+                self.add_filter_text (text)
             elif token == '--new':
                 self.caches = self.new_caches
             else:
@@ -416,7 +450,6 @@ class Cli():
                 return
                 
     def parse_actions(self):
-        self.check_caches_retrieved()
         self.nt += 1
         if not self.has_next():
             raise ParseError("Expected actions.")
@@ -577,6 +610,10 @@ class Cli():
     def set_password(self, string):
         new_settings = {'options_password': string,}
         self.core.save_settings(new_settings, self)
+
+    def set_http_cache_size(self, megabytes):
+        new_settings = {'download_http_cache_size': megabytes,}
+        self.core.save_settings(new_settings, self)
         
     def import_points(self, c1, c2):
         def skip_callback(id, found):
@@ -612,9 +649,9 @@ class Cli():
         
     def add_filter_in(self, coord1, coord2):
         if isinstance(coord2, geo.Coordinate):
-            self.caches = filter(lambda x: self.filter_in(coord1, coord2, x), self.caches)
+            self.caches = filter(lambda x: self.filter_in(coord1, coord2, x), self.iter_caches())
         else:
-            self.caches = filter(lambda x: self.filter_in_radius(coord1, coord2, x), self.caches)
+            self.caches = geobatch.within_radius(coord1, coord2 * 1000, self.iter_caches())
         print "* filter in radius/coordinates: %d left" % len(self.caches)
         
     def filter_in(self, c1, c2, check):
@@ -624,71 +661,73 @@ class Cli():
             and check.lon < max(c1.lon, c2.lon))
             
             
-    def filter_in_radius(self, coord1, radius, check):
-        return check.distance_to(coord1) <= radius * 1000
-            
     def add_filter_found(self, found):
-        self.caches = filter(lambda x: x.found == found, self.caches)
+        self.caches = filter(lambda x: x.found == found, self.iter_caches())
         print "* filter width found: %d left" % len(self.caches)
         
     def add_filter_has_details(self, has_details):
-        self.caches = filter(lambda x: x.was_downloaded() == has_details, self.caches)
+        self.caches = filter(lambda x: x.was_downloaded() == has_details, self.iter_caches())
         print "* filter with 'has details': %d left" % len(self.caches)
         
     def add_filter_size(self, op, size):
         if op == self.EQ:
-            self.caches = filter(lambda x: x.size == size, self.caches)
+            self.caches = filter(lambda x: x.size == size, self.iter_caches())
         elif op == self.MIN:
-            self.caches = filter(lambda x: x.size >= size, self.caches)
+            self.caches = filter(lambda x: x.size >= size, self.iter_caches())
         elif op == self.MAX:
-            self.caches = filter(lambda x: x.size <= size, self.caches)
+            self.caches = filter(lambda x: x.size <= size, self.iter_caches())
         else:
             raise RunError("What Happen? Somebody set us up the geocache.")
         print "* filter with size: %d left" % len(self.caches)
         
     def add_filter_difficulty(self, op, diff):
         if op == self.EQ:
-            self.caches = filter(lambda x: int(float(x.get_difficulty())*10) == diff, self.caches)
+            self.caches = filter(lambda x: int(float(x.get_difficulty())*10) == diff, self.iter_caches())
         elif op == self.MIN:
-            self.caches = filter(lambda x: int(float(x.get_difficulty())*10) >= diff, self.caches)
+            self.caches = filter(lambda x: int(float(x.get_difficulty())*10) >= diff, self.iter_caches())
         elif op == self.MAX:
-            self.caches = filter(lambda x: int(float(x.get_difficulty())*10) <= diff, self.caches)
+            self.caches = filter(lambda x: int(float(x.get_difficulty())*10) <= diff, self.iter_caches())
         else:
             raise RunError("What Happen? Somebody set us up the geocache.")
         print "* filter with difficulty: %d left" % len(self.caches)
             
     def add_filter_terrain(self, op, terr):
         if op == self.EQ:
-            self.caches = filter(lambda x: int(float(x.get_terrain())*10) == terr, self.caches)
+            self.caches = filter(lambda x: int(float(x.get_terrain())*10) == terr, self.iter_caches())
         elif op == self.MIN:
-            self.caches = filter(lambda x: int(float(x.get_terrain())*10) >= terr, self.caches)
+            self.caches = filter(lambda x: int(float(x.get_terrain())*10) >= terr, self.iter_caches())
         elif op == self.MAX:
-            self.caches = filter(lambda x: int(float(x.get_terrain())*10) <= terr, self.caches)
+            self.caches = filter(lambda x: int(float(x.get_terrain())*10) <= terr, self.iter_caches())
         else:
             raise RunError("What Happen? Somebody set us up the geocache.")
         print "* filter with terrain: %d left" % len(self.caches)
             
     def add_filter_types(self, types):
-        self.caches = filter(lambda x: x.type in types, self.caches)
+        self.caches = filter(lambda x: x.type in types, self.iter_caches())
         print "* filter with types: %d left" % len(self.caches)
         
     def add_filter_owner(self, owner):
-        self.caches = filter(lambda x: self.get_string_filter(owner)(x.owner), self.caches)
+        self.caches = filter(lambda x: self.get_string_filter(owner)(x.owner), self.iter_caches())
         
         print "* filter with owner: %d left" % len(self.caches)
         
     def add_filter_name (self, name):
-        self.caches = filter(lambda x: self.get_string_filter(name)(x.title), self.caches)
+        self.caches = filter(lambda x: self.get_string_filter(name)(x.title), self.iter_caches())
         print "* filter with name: %d left" % len(self.caches)
     
     def add_filter_id (self, idstring):
-        self.caches = filter(lambda x: self.get_string_filter(idstring)(x.name), self.caches)
+        self.caches = filter(lambda x: self.get_string_filter(idstring)(x.name), self.iter_caches())
         print "* filter with id: %d left" % len(self.caches)
         
     def add_filter_attribute (self, attribute):
-        self.caches = filter(lambda x: self.get_string_filter(attribute)(x.attributes), self.caches)
+        self.caches = filter(lambda x: self.get_string_filter(attribute)(x.attributes), self.iter_caches())
         print "* filter with attribute: %d left" % len(self.caches)
         
+    def add_filter_text (self, text):
+        ranking = dict((name, i) for i, name in enumerate(self.pointprovider.search_names(text)))
+        self.caches = sorted((x for x in self.iter_caches() if x.name in ranking), key = lambda x: ranking[x.name])
+        print "* filter with text: %d left" % len(self.caches)
+        
     def get_string_filter(self, searchstring):
         if searchstring.startswith('r:'):
             matcher = re.compile(searchstring[2:])
@@ -697,41 +736,44 @@ class Cli():
             return lambda x: searchstring.lower() in x.lower()
     
     def action_print (self):
-        print "Found %d Caches:" % len(self.caches)
-        for c in self.caches:
+        i = 0
+        for c in self.iter_caches():
             print (u"%s\t%s (%s)%s" % (c.name, c.title, c.type, ('*' if c.was_downloaded() else ''))).encode('utf-8')
+            i += 1
+        print "Found %d Caches." % i
             
             
     def action_fetch_details(self):
-        self.core.download_cache_details_list(self.caches, sync=True)
+        self.core.download_cache_details_list(list(self.iter_caches()), sync=True)
     
     def action_export(self, format, folder):
         i = 1
-        for c in self.caches:
-            print "* (%d of %d)\tExporting to %s: '%s'" % (i, len(self.caches), format, c.title)
+        for c in self.iter_caches():
+            print "* (%d)\tExporting to %s: '%s'" % (i, format, c.title)
             self.core.export_cache(c, format, folder)
             i += 1
 
     def action_command(self, commandline):
-        if len(self.caches) == 0:
+        list = " -- ".join([("%s (%s)" % (a.title, a.type)).encode('utf-8') for a in self.iter_caches()])
+        if list == '':
             print "* Not running command (no geocaches left)"
             return
-        list = " -- ".join([("%s (%s)" % (a.title, a.type)).encode('utf-8') for a in self.caches])
         os.system(commandline % ('"%s"' % list.encode('string-escape')))
         
     def action_command_split(self, commandline):
         from pipes import quote
-        if len(self.caches) == 0:
-            print "* Not running command (no geocaches left)"
-            return
         def my_encode(t):
             try:
-                return quote(unicode(b).encode('utf-8'))
+                return quote(unicode(t).encode('utf-8'))
             except Exception, e:
                 return ''
-        for a in self.caches:
-            cmd = commandline.format(**dict([(a, my_encode(b)) for a, b in a.__dict__.items()]))
+        found = False
+        for a in self.iter_caches():
+            cmd = commandline.format(**dict((k, my_encode(v)) for k, v in a.serialize().items()))
             os.system(cmd)
+            found = True
+        if not found:
+            print "* Not running command (no geocaches left)"
         
     def set_download_progress(self, some, thing):
         pass
@@ -32,6 +32,7 @@ logging.basicConfig(level=logging.WARNING,
                     
 
 from geo import Coordinate
+import geobatch
 try:
     from json import loads, dumps
 except (ImportError, AttributeError):
@@ -50,6 +51,7 @@ from actors.tts import TTS
 from re import sub
 import threading
 from datetime import datetime
+from time import time
 
 import connection
 import gobject
@@ -66,6 +68,11 @@ if '-v' in argv or '--remote' in argv:
     
 if '--debug-http' in argv:
     downloader.enable_http_debugging()
+
+if '--record-http' in argv:
+    downloader.enable_http_recording(argv[argv.index('--record-http') + 1])
+elif '--replay-http' in argv:
+    downloader.enable_http_replay(argv[argv.index('--replay-http') + 1])
     
 extensions = []
 if '--simple' in argv:
@@ -110,11 +117,13 @@ class Core(gobject.GObject):
         'error': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, )),
         'progress': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT, )),
         'hide-progress': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, ()),
+        'optimize-done': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, )),
         }
 
     SETTINGS_DIR = path.expanduser(path.join('~', '.agtl'))
     CACHES_DB = path.join(SETTINGS_DIR, "caches.db")
     COOKIE_FILE = path.join(SETTINGS_DIR, "cookies.lwp")
+    HTTP_CACHE_DIR = path.join(SETTINGS_DIR, 'http-cache')
     UPDATE_DIR = path.join(SETTINGS_DIR, 'updates')
 
     MAEMO_HOME = path.expanduser(path.join('~', 'MyDocs', '.'))
@@ -125,7 +134,6 @@ class Core(gobject.GObject):
     UPDATE_MODULES = [cachedownloader]
     
     updating_lock = threading.Lock()
-    _geocache_by_name_event = threading.Event()
     
     DEFAULT_SETTINGS = {
         'download_visible': True,
@@ -164,6 +172,7 @@ class Core(gobject.GObject):
         'options_default_log_text' : 'TFTC!\n\nLogged at %X from my %(machine)s using AGTL.',
         'options_auto_update': True,
         'download_num_logs': 20,
+        'download_http_cache_size': 32, # MB of downloaded pages kept for conditional requests, see downloader.HTTPCache
         'options_night_view_mode': 0,
         'debug_log_to_http': False,
         'options_backend': 'geocaching-com-new',
@@ -204,7 +213,7 @@ class Core(gobject.GObject):
         self.create_recursive(self.settings['download_output_dir'])
         self.create_recursive(self.settings['download_map_path'])
         
-        self.downloader = downloader.FileDownloader(self.settings['options_username'], self.settings['options_password'], self.COOKIE_FILE)
+        self.downloader = downloader.FileDownloader(self.settings['options_username'], self.settings['options_password'], self.COOKIE_FILE, self.HTTP_CACHE_DIR, self.settings['download_http_cache_size'] * 1024 * 1024)
 
         # Download log-type icons
         #logger.info("Download log-type icons")
@@ -233,7 +242,7 @@ class Core(gobject.GObject):
                     logger.exception(e)
                     logger.error("Failed to download image from URL %s" % url)
 
-        self.pointprovider = provider.PointProvider(self.CACHES_DB, geocaching.GeocacheCoordinate)
+        self.pointprovider = provider.PointProvider(self.CACHES_DB, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
 
         self.gui = guitype(self)
         
@@ -291,28 +300,69 @@ class Core(gobject.GObject):
                     logging.info("Could not create directory; %s" % e)
                     pass
 
-    def optimize_data(self):
+    def optimize_data(self, sync=False):
         """
         Clean up database and file system.
         
-        Removes found geocaches and their images from the database or filesystem, respectively.
+        Removes found geocaches and their images from the database or filesystem, respectively, and reclaims the free space in the database (see PointProvider.maintain).
+        sync -- Perform all steps at once. Otherwise, the steps run whenever the main loop is idle and 'optimize-done' is emitted at the end.
+        
+        Returns a dict with the number of removed geocaches, the number of reclaimed database pages and the time spent (if sync is True).
+        """
+        stats = {'geocaches': 0, 'pages': 0, 'time': 0}
+        steps = self._optimize_data_steps(stats)
+        if sync:
+            while self._optimize_data_step(steps, stats):
+                pass
+            return stats
+        gobject.idle_add(self._optimize_data_step, steps, stats, priority=gobject.PRIORITY_LOW)
+        return False
+
+    def _optimize_data_step(self, steps, stats):
         """
+        Run one step of optimize_data. Returns False when all steps are done, so the idle callback is removed.
+        
+        """
+        start = time()
+        try:
+            fraction, text = steps.next()
+        except StopIteration:
+            self.emit('hide-progress')
+            self.emit('map-marks-changed')
+            logger.info("Removed %(geocaches)d geocaches and reclaimed %(pages)d pages in %(time).1f seconds" % stats)
+            self.emit('optimize-done', stats)
+            return False
+        finally:
+            stats['time'] += time() - start
+        self.emit('progress', fraction, text)
+        return True
+
+    def _optimize_data_steps(self, stats):
         self.pointprovider.push_filter()
         self.pointprovider.set_filter(found=True)
-        old_geocaches = self.pointprovider.get_points_filter()
+        old_geocaches = self.pointprovider.iter_points_filter()
         self.pointprovider.pop_filter()
+        # Remove the geocaches in batches, so that they are not all held in memory
+        batch = []
         for x in old_geocaches:
             images = x.get_images()
-            if len(images) == 0:
-                continue
             for filename, caption in images.items():
                 fullpath = path.join(self.settings['download_output_dir'], filename)
                 try:
                     remove(fullpath)
                 except Exception:
                     logging.warning("Could not remove " + fullpath)
-        self.pointprovider.remove_geocaches(old_geocaches)
-        self.pointprovider.optimize()
+            batch.append(x)
+            if len(batch) >= 500:
+                self.pointprovider.remove_geocaches(batch)
+                stats['geocaches'] += len(batch)
+                batch = []
+                yield (0, "Removed %d found geocaches" % stats['geocaches'])
+        self.pointprovider.remove_geocaches(batch)
+        stats['geocaches'] += len(batch)
+        for pages, left in self.pointprovider.maintain():
+            stats['pages'] = pages
+            yield (float(pages) / (pages + left) if pages + left > 0 else 1, "Optimizing database")
 
     def get_file_sizes(self):
         """
@@ -506,6 +556,8 @@ class Core(gobject.GObject):
             self.downloader.update_userdata(username = settings['options_username'])
         if 'options_password' in settings:
             self.downloader.update_userdata(password = settings['options_password'])
+        if 'download_http_cache_size' in settings and self.downloader.http_cache != None:
+            self.downloader.http_cache.max_size = settings['download_http_cache_size'] * 1024 * 1024
 
     def __on_save_settings(self, caller):
         """
@@ -667,11 +719,14 @@ class Core(gobject.GObject):
         together = []
         TOL = 15
         MAX_TOGETHER = 20
+        # from each point of the route to the next one
+        bearings = geobatch.bearings(route[:-1], route[1:])
+        distances = geobatch.distances(route[:-1], route[1:])
         for i in range(len(route)):
             if len(together) == 0:
                 together = [route[i]] 
             if (i < len(route) - 1):
-                brg = route[i].bearing_to(route[i + 1])
+                brg = bearings[i]
                 
             if len(together) < MAX_TOGETHER \
                 and (i < len(route) - 1) \
@@ -679,7 +734,7 @@ class Core(gobject.GObject):
                      or abs(brg + 90) < TOL
                      or abs(brg) < TOL
                      or abs (brg - 180) < TOL) \
-                and route[i].distance_to(route[i + 1]) < (r * 1000 * 2):
+                and distances[i] < (r * 1000 * 2):
                     together.append(route[i + 1])
             else:
                 from math import sqrt
@@ -703,14 +758,14 @@ class Core(gobject.GObject):
     #
     ##############################################
                 
-    def set_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None):
+    def set_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None, text_search=''):
         """
         Sets a new filter for the pointprovider. 
         
         Is mainly used to filter the map display. (Currently only in hildongui_plugins)
         
         """
-        self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked)
+        self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked, text_search=text_search)
         self.emit('map-marks-changed')
                 
     def reset_filter(self):
@@ -723,16 +778,18 @@ class Core(gobject.GObject):
         self.pointprovider.set_filter()
         self.emit('map-marks-changed')
 
-    def get_points_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None, preserve_filter = False):
+    def get_points_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None, preserve_filter = False, text_search='', center=None):
         """
         Performs a search according to the given criteria and returns the geocaches. Also returns information on whether the result was truncated due to the maximum number of search results configured in pointprovider.
         preserve_filter -- Apply the filter and keep it active after this method. If set to False, the filtering remains unchanged after the method call.
+        text_search -- Full text search, the best matches are returned first (see PointProvider.set_filter)
+        center -- Return the geocaches closest to this coordinate, ordered by distance (takes precedence over the order of a text search). They are found by the nearest neighbour search of the pointprovider, see PointProvider.get_nearest_points.
         
         """
         if not preserve_filter:
             self.pointprovider.push_filter()
-        self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked)
-        points = self.pointprovider.get_points_filter(location)
+        self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked, text_search=text_search)
+        points = self.pointprovider.get_points_filter(location, center=center)
         truncated = (len(points) >= self.pointprovider.MAX_RESULTS)
         if not preserve_filter:
             self.pointprovider.pop_filter()
@@ -777,35 +834,40 @@ class Core(gobject.GObject):
         skip_callback -- A callback function which gets the geocache id and its found status as input. If it returns true, the geocache's details are not downloaded.
         """
         if not sync:                
-            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.get_overview', self._download_overview_complete, location, self.get_geocache_by_name_async, skip_callback])
+            t = Thread(target=self._download_upload_helper, args=['self._download_overview', self._download_overview_complete, location, skip_callback])
             t.daemon = True
             t.start()
             return False
         else:
-            return self._download_overview_complete(self.cachedownloader.get_overview(location, self.get_geocache_by_name, skip_callback), True)
+            return self._download_overview_complete(self._download_overview(location, skip_callback), True)
+
+    def _download_overview(self, location, skip_callback):
+        """
+        Download the overview and store the geocaches, runs in the download thread.
+        
+        The geocaches are read and written directly from this thread, the point provider uses a separate database connection for each thread and a single lock for all writes, so the main loop is not blocked.
+        
+        Returns a tuple of the geocaches and the geocaches which were not in the database before.
+        
+        """
+        caches = self.cachedownloader.get_overview(location, self.get_geocache_by_name, skip_callback)
+        new_names = set(self.pointprovider.add_points(caches))
+        return (caches, [c for c in caches if c.name in new_names])
 
-    def _download_overview_complete(self, caches, sync=False):
+    def _download_overview_complete(self, result, sync=False):
         """
         Called upon completion of the download of all geocaches within a boundary.
         
-        caches -- Updated geocache information.
+        result -- Updated geocache information and new geocaches, as returned by _download_overview.
         sync -- Perform actions synchronized, i.e., don't use threads.
         """
-        new_caches = []
-        for c in caches:
-            self.emit('cache-changed', c)
-            point_new = self.pointprovider.add_point(c)
-            if point_new:
-                new_caches.append(c)
-        self.pointprovider.save()
-        
-        for c in caches:
+        for c in result[0]:
             self.emit('cache-changed', c)
             
         self.emit('hide-progress')
         self.emit('map-marks-changed')
         if sync:
-            return (caches, new_caches)
+            return result
         else:
             return False
 
@@ -818,22 +880,29 @@ class Core(gobject.GObject):
         
         """
         if not sync:                
-            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.update_coordinate', self._download_cache_details_complete, cache, self.settings['download_num_logs']])
+            t = Thread(target=self._download_upload_helper, args=['self._download_cache_details', self._download_cache_details_complete, cache])
             t.daemon = True
             t.start()
             #t.join()
             return False
         else:
-            full = self.cachedownloader.update_coordinate(cache, self.settings['download_num_logs'])
-            return self._download_cache_details_complete(full, sync)
+            return self._download_cache_details_complete(self._download_cache_details(cache), sync)
+
+    def _download_cache_details(self, cache):
+        """
+        Download and store the details of a single geocache, runs in the download thread.
+
+        """
+        full = self.cachedownloader.update_coordinate(cache, self.settings['download_num_logs'])
+        self.pointprovider.add_point(full, True)
+        self.pointprovider.save()
+        return full
 
     def _download_cache_details_complete(self, cache, sync = False):
         """
         Called when a single geocache was successfully downloaded.
 
         """
-        self.pointprovider.add_point(cache, True)
-        self.pointprovider.save()
         self.emit('hide-progress')
         self.emit('cache-changed', cache)
         if not sync:
@@ -884,12 +953,21 @@ class Core(gobject.GObject):
         
         """
         if not sync:
-            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.update_coordinates', self._download_cache_details_list_complete, caches, self.settings['download_num_logs']])
+            t = Thread(target=self._download_upload_helper, args=['self._download_cache_details_list', self._download_cache_details_list_complete, caches])
             t.daemon = True
             t.start()
             return False
         else:
-            return self._download_cache_details_list_complete(self.cachedownloader.update_coordinates(caches,self.settings['download_num_logs']))
+            return self._download_cache_details_list_complete(self._download_cache_details_list(caches))
+
+    def _download_cache_details_list(self, caches):
+        """
+        Download and store the details for a list of geocaches, runs in the download thread.
+        
+        """
+        caches = self.cachedownloader.update_coordinates(caches, self.settings['download_num_logs'])
+        self.pointprovider.add_points(caches, True)
+        return caches
         
     def _download_cache_details_list_complete(self, caches):
         """
@@ -898,9 +976,6 @@ class Core(gobject.GObject):
         caches -- List of geocaches
         
         """
-        for c in caches:
-            self.pointprovider.add_point(c, True)
-        self.pointprovider.save()
         self.emit('hide-progress')
         for c in caches:
             self.emit('cache-changed', c)
@@ -963,19 +1038,6 @@ class Core(gobject.GObject):
             return True
         return False
         
-    def get_geocache_by_name_async(self, id):
-        self._geocache_by_name_event.clear()
-        gobject.idle_add(self._get_geocache_by_name_async_idle, id, priority=gobject.PRIORITY_HIGH)
-        res = self._geocache_by_name_event.wait(1)
-        if res == False:
-            logger.error("Screw it!")
-            return None
-        return self._geocache_by_name_result
-        
-    def _get_geocache_by_name_async_idle(self, id):
-        self._geocache_by_name_result = self.get_geocache_by_name(id)
-        self._geocache_by_name_event.set()
-
     ##############################################
     #
     # Exporting
@@ -1045,7 +1107,9 @@ class Core(gobject.GObject):
         """
         for c in caches:
             c.logas = geocaching.GeocacheCoordinate.LOG_NO_LOG
-            self.save_cache_attribute(c, 'logas')
+        # a single transaction for all of them
+        self.pointprovider.save_changes(caches, ('logas',))
+        for c in caches:
             self.emit('cache-changed', c)
         self.emit('hide-progress')
         self.emit('fieldnotes-changed')
@@ -1066,15 +1130,10 @@ class Core(gobject.GObject):
 
     def save_cache_attribute(self, cache, attribute):
         """
-        Save the attribute of a geocache to the database.
+        Save the attribute (or tuple of attributes) of a geocache to the database.
         
         """
-        if type(attribute) == tuple:
-            for a in attribute:
-                self.pointprovider.update_field(cache, a, cache.serialize_one(a), save=False)
-            self.pointprovider.save()
-        else:
-            self.pointprovider.update_field(cache, attribute, cache.serialize_one(attribute))
+        self.pointprovider.save_changes([cache], attribute if type(attribute) == tuple else (attribute,))
 
     def set_alternative_position(self, cache, ap):
         """
@@ -25,7 +25,20 @@ from __future__ import with_statement
 import logging
 logger = logging.getLogger('downloader')
 import connection
-from sys import argv
+import httplib
+import os
+import random
+import socket
+import threading
+try:
+    from simplejson import dumps, loads
+except (ImportError, AttributeError):
+    from json import loads, dumps
+from email.utils import parsedate_tz, mktime_tz
+from hashlib import sha1
+from sys import argv, version_info
+from time import time, sleep
+from urllib2 import BaseHandler, HTTPHandler, HTTPSHandler, HTTPError, URLError, addinfourl
 
 DEBUG_HTTP = False
 
@@ -36,74 +49,789 @@ def enable_http_debugging():
     DEBUG_COUNTER = 0
     logger.info("Writing debug HTTP logs.")
 
-def read_from_network(req, UrlOpen=False):
-        from urllib2 import urlopen, URLError
-        #try 3 times
-        for count in range(3,0,-1):
-          try:
-              if UrlOpen:
-                  return urlopen(req)
-              else:
-                  ret=req.read()
-                  req.close()
-                  return ret
-          except Exception, e:
-              logger.warning("Download error "+str(e)) #debug only
-              logger.warning("Download error "+str(type(e))) #debug only
-              if str(type(e)) == "<class 'socket.timeout'>":
-                  logger.warning("Socket timeout error: "+str(e))
-              elif str(type(e)) == "<class 'httplib.IncompleteRead'>":
-                  logger.warning("IncompleteRead error (giving up): "+str(e))
-                  count = 1 #this will break the loop
-              elif str(type(e)) == "<type 'exceptions.IOError'>":
-                  logger.warning("IOError (not gzipped file) (giving up): "+str(e))
-                  count = 1 #this will break the loop
-              elif str(type(e)) == "<type 'exceptions.ValueError'>":
-                  logger.warning("ValueError (giving up): "+str(e))
-                  count = 1 #this will break the loop
-              elif str(type(e)) == "<type 'exceptions.AttributeError'>":
-                  logger.warning("Attribute error (giving up): "+str(e))
-                  count = 1 #this will break the loop
-              elif  str(type(e)) == "<class 'urllib2.HTTPError'>": #after that it is safe to ask .code (but better to print message also)
-                  logger.warning("Download error (giving up): "+str(e))
-                  count = 1 #this will break the loop
-              elif str(type(e)) =="<class 'urllib2.URLError'>": #after that it is safe to ask .reason
-                  if 'timed out' in str(e.reason):
-                      logger.warning("Time out error while downloading: "+str(e))
-                  elif 'Network is unreachable' in str(e.reason):
-                      logger.warning("Network is down while downloading:"+str(e))
-              else:
-                  #logger.warning("Error "+str(e)+str(e.reason)+str(e.code)+str(e.read()))
-                  count = 1 #this will break the loop
-
-              if count == 1:
-                  logger.error('  Giving up downloading')
-                  return None
-
-              logger.warning(" Trying again")
-          else: #this is for try-catch
-              break
-
-        #it should never come here
+HTTP_RECORD_PATH = None
+HTTP_REPLAY = None
+
+def enable_http_recording(path):
+    """
+    Record all requests and responses of FileDownloaders created from now on into the HTTPArchive at path.
+    
+    """
+    global HTTP_RECORD_PATH
+    HTTP_RECORD_PATH = path
+    logger.info("Recording HTTP requests to %s." % path)
+
+def enable_http_replay(path, latency=0, bandwidth=0):
+    """
+    Answer all requests of FileDownloaders created from now on from the HTTPArchive at path instead of the network.
+    
+    latency (in seconds) and bandwidth (in bytes per second, 0 for unlimited) simulate a network connection.
+    
+    """
+    global HTTP_REPLAY
+    HTTP_REPLAY = (path, latency, bandwidth)
+    logger.info("Replaying HTTP requests from %s." % path)
+
+class ConnectError(URLError):
+    """
+    Raised by the KeepAliveHandlers if the connection to the server could not be established, so that nothing of the request has been sent.
+    
+    """
+
+
+def open_with_timeout(req, timeout, opener=None):
+    """
+    Open req with opener (or urlopen) and the given socket timeout.
+    
+    Python 2.5 has no timeouts for single requests, so the default socket timeout applies there.
+    
+    """
+    from urllib2 import urlopen
+    do_open = opener.open if opener != None else urlopen
+    if version_info < (2, 6):
+        return do_open(req)
+    return do_open(req, timeout=timeout)
+
+
+class RetryPolicy():
+    """
+    Decides whether a failed request is tried again, and how long to wait before.
+    
+    Only errors which may go away by themselves are retried: timeouts, network and connection errors, incomplete responses and the HTTP status codes in RETRY_STATUS. Requests other than GET and HEAD (such as the POSTs which log in or upload field notes) may have reached the server even if they failed, so they are only retried after a ConnectError. Unless the server asks for a delay in a Retry-After header, the delay doubles from BACKOFF up to MAX_BACKOFF for each retry, and a random part of it is left out, so that clients which failed at the same time don't retry at the same time. All attempts of a request must finish within DEADLINE seconds.
+    
+    """
+    MAX_ATTEMPTS = 4
+    BACKOFF = 1.0 # seconds before the first retry
+    MAX_BACKOFF = 30.0 # seconds
+    TIMEOUT = 15.0 # seconds, socket timeout of each attempt
+    DEADLINE = 120.0 # seconds for all attempts of a request
+    RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.give_ups = 0
+
+    def should_retry(self, e, idempotent=True):
+        if not idempotent:
+            return isinstance(e, ConnectError)
+        # HTTPError is a subclass of URLError, and socket.error is a subclass of IOError, so the order matters
+        if isinstance(e, HTTPError):
+            return e.code in self.RETRY_STATUS
+        if isinstance(e, URLError):
+            # Timeouts, unreachable networks, refused connections; but not unknown URL types etc.
+            return isinstance(e.reason, socket.error)
+        return isinstance(e, (socket.error, httplib.IncompleteRead, httplib.BadStatusLine))
+
+    def get_delay(self, attempt, e):
+        """
+        Return the delay in seconds before attempt + 1 after e has been raised by attempt.
+        
+        """
+        retry_after = self.get_retry_after(e)
+        if retry_after != None:
+            return retry_after
+        backoff = min(self.MAX_BACKOFF, self.BACKOFF * 2 ** (attempt - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    @staticmethod
+    def get_retry_after(e):
+        """
+        Return the delay in seconds from the Retry-After header of an HTTPError, or None.
+        
+        """
+        if not isinstance(e, HTTPError) or e.info() == None:
+            return None
+        value = e.info().get('Retry-After')
+        if value == None:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        date = parsedate_tz(value)
+        if date == None:
+            return None
+        return max(0, mktime_tz(date) - time())
+
+    def run(self, function, idempotent=True):
+        """
+        Call function(timeout) until it does not raise an exception, and return its result.
+        
+        timeout is the socket timeout for the attempt, limited by the deadline. If the error is not retried (anymore), the exception is raised.
+        idempotent -- False if repeating the request may have side effects, see should_retry
+        
+        """
+        deadline = time() + self.DEADLINE
+        attempt = 1
+        while True:
+            try:
+                return function(max(1, min(self.TIMEOUT, deadline - time())))
+            except Exception, e:
+                delay = self.get_delay(attempt, e) if self.should_retry(e, idempotent) else None
+                if delay == None or attempt >= self.MAX_ATTEMPTS or time() + delay >= deadline:
+                    with self.lock:
+                        self.give_ups += 1
+                    logger.warning("Download error (giving up after %d attempts): %s" % (attempt, e))
+                    raise
+                with self.lock:
+                    self.retries += 1
+                logger.warning("Download error (trying again in %.1f s): %s" % (delay, e))
+                sleep(delay)
+                attempt += 1
+
+
+class HTTPCache():
+    """
+    Stores downloaded responses on disk together with their validators (ETag and Last-Modified), so that they can be downloaded again with a conditional request and served from disk if the server answers 304 Not Modified.
+    
+    Each response is stored in a file named after the SHA-1 of its URL and the user who requested it, because the pages differ between users (found logs, own coordinates, premium member caches). The first line of the file holds the metadata as JSON, the rest is the (decoded) body. The files are evicted in least recently used order when the cache grows beyond max_size; the modification time of a file is the time when it was used last.
+    
+    """
+    # A cache page with its logbooks is a few hundred kB, so this holds
+    # about a hundred geocaches without taking much of the N900's storage
+    MAX_SIZE = 32 * 1024 * 1024 # bytes
+    # Not stored, because the body is stored decoded and the connection is a different one
+    SKIP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive')
+    # Request headers a response may vary on and still be stored: the body is
+    # stored decoded, and the cookies belong to the user, who is part of the key
+    VARY_HEADERS = ('accept-encoding', 'cookie')
+
+    def __init__(self, directory, max_size=None):
+        """
+        directory -- Where the responses are stored, created if necessary
+        max_size -- Size limit in bytes, MAX_SIZE if None
+        
+        """
+        self.directory = directory
+        self.max_size = max_size if max_size != None else self.MAX_SIZE
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # file name -> size, and the file names, least recently used first
+        self.entries = {}
+        self.order = []
+        files = [(os.stat(os.path.join(directory, name)), name) for name in os.listdir(directory) if not name.endswith('.tmp')]
+        for st, name in sorted(files, key=lambda x: x[0].st_mtime):
+            self.entries[name] = st.st_size
+            self.order.append(name)
+        self.size = sum(self.entries.values())
+
+    def get_filename(self, url, user):
+        return sha1("%s\n%s" % (user, url)).hexdigest()
+
+    def read(self, url, user, with_body=True):
+        """
+        Return the metadata and the body stored for url and user, or None.
+        
+        with_body -- If False, only the metadata is read from the file and the body is None.
+        
+        """
+        try:
+            with open(os.path.join(self.directory, self.get_filename(url, user)), 'rb') as f:
+                meta = loads(f.readline())
+                body = f.read() if with_body else None
+        except (IOError, ValueError):
+            return None
+        if meta.get('request_url') != url.decode('latin-1') or meta.get('user') != user.decode('latin-1'):
+            return None
+        return meta, body
+
+    def get_validators(self, url, user):
+        """
+        Return the headers which make the request for url by user conditional, or an empty dict if nothing is stored for it.
+        
+        """
+        stored = self.read(url, user, False)
+        if stored == None:
+            return {}
+        meta, body = stored
+        headers = {}
+        if meta.get('etag') != None:
+            headers['If-None-Match'] = meta['etag'].encode('latin-1')
+        if meta.get('last_modified') != None:
+            headers['If-Modified-Since'] = meta['last_modified'].encode('latin-1')
+        return headers
+
+    def not_modified(self, url, user):
+        """
+        Return the URL, the headers and the body stored for url and user, after the server has answered 304 Not Modified, or None if the response is not stored anymore.
+        
+        """
+        stored = self.read(url, user)
+        if stored == None:
+            return None
+        meta, body = stored
+        name = self.get_filename(url, user)
+        with self.lock:
+            self.hits += 1
+            if name in self.entries:
+                self.order.remove(name)
+                self.order.append(name)
+        try:
+            os.utime(os.path.join(self.directory, name), None)
+        except OSError:
+            pass
+        return meta['url'].encode('latin-1'), meta['headers'].encode('latin-1'), body
+
+    def miss(self):
+        """
+        Count a cacheable request which was downloaded, because nothing was stored for it or it has been modified.
+        
+        """
+        with self.lock:
+            self.misses += 1
+
+    def is_storable(self, info):
+        """
+        Return whether a response with the headers info may be stored: it needs a validator, must not forbid storing and must not vary on request headers other than VARY_HEADERS.
+        
+        """
+        if 'no-store' in info.get('Cache-Control', '') or (info.get('ETag') == None and info.get('Last-Modified') == None):
+            return False
+        vary = [field.strip().lower() for value in info.getheaders('Vary') for field in value.split(',')]
+        return all(field in self.VARY_HEADERS or field == '' for field in vary)
+
+    def store(self, url, user, resp, body):
+        """
+        Store the response resp with the decoded body for url and user, if is_storable allows it.
+        
+        """
+        entry = self.open_entry(url, user, resp)
+        if entry != None:
+            entry.write(body)
+            entry.commit()
+
+    def open_entry(self, url, user, resp):
+        """
+        Return an HTTPCacheEntry to which the decoded body of the response resp for url and user can be written while it is downloaded, or None if is_storable does not allow storing it.
+        
+        """
+        info = resp.info()
+        if not self.is_storable(info):
+            return None
+        # header values are bytes, which JSON can only store as unicode
+        def text(value):
+            return value.decode('latin-1') if value != None else None
+        headers = ''.join(line for line in info.headers if line.split(':', 1)[0].strip().lower() not in self.SKIP_HEADERS)
+        meta = {'request_url': text(url), 'user': text(user), 'url': text(resp.geturl()), 'etag': text(info.get('ETag')), 'last_modified': text(info.get('Last-Modified')), 'headers': text(headers)}
+        entry = HTTPCacheEntry(self, self.get_filename(url, user))
+        entry.write(dumps(meta))
+        entry.write('\n')
+        return entry
+
+    def add(self, name, size):
+        """
+        Account for the file name of the given size, which has just been written, and evict the least recently used files if the cache is too large now.
+        
+        """
+        with self.lock:
+            if name in self.entries:
+                self.size -= self.entries[name]
+                self.order.remove(name)
+            self.size += size
+            self.entries[name] = size
+            self.order.append(name)
+            evicted = []
+            while self.size > self.max_size and len(self.order) > 1:
+                old = self.order.pop(0)
+                self.size -= self.entries.pop(old)
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def get_status(self):
+        return "%d cached, %d downloaded" % (self.hits, self.misses)
+
+
+class HTTPCacheEntry():
+    """
+    A response which is being written to an HTTPCache, see HTTPCache.open_entry.
+    
+    The data goes to a temporary file, which replaces the stored response in commit. If writing fails, the entry is discarded and a warning is logged, but the download goes on.
+    
+    """
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self.filename = os.path.join(cache.directory, name)
+        # unique, so that two downloads of the same URL don't write to the same file
+        self.temp_filename = '%s.%x.tmp' % (self.filename, id(self))
+        self.f = None
+        try:
+            self.f = open(self.temp_filename, 'wb')
+        except IOError, e:
+            self.fail(e)
+
+    def fail(self, e):
+        logger.warning("Could not write to HTTP cache: %s" % e)
+        self.abort()
+
+    def write(self, data):
+        if self.f == None:
+            return
+        try:
+            self.f.write(data)
+        except IOError, e:
+            self.fail(e)
+
+    def commit(self):
+        """
+        Store the response, after its body has been written completely.
+        
+        """
+        if self.f == None:
+            return
+        try:
+            size = self.f.tell()
+            self.f.close()
+            self.f = None
+            os.rename(self.temp_filename, self.filename)
+        except (IOError, OSError), e:
+            self.fail(e)
+            return
+        self.cache.add(self.name, size)
+
+    def abort(self):
+        """
+        Discard the response, e.g. because its body could not be downloaded completely.
+        
+        """
+        if self.f != None:
+            self.f.close()
+        self.f = None
+        try:
+            os.remove(self.temp_filename)
+        except OSError:
+            pass
+
+
+def read_from_network(req, UrlOpen=False, opener=None):
+    """
+    Open the request req if UrlOpen is set, otherwise read and close the response req. Return None if this fails.
+    
+    Opening is retried as RetryPolicy says. Reading a response can't be retried, use FileDownloader.get_reader, which retries whole requests, for that.
+    
+    """
+    try:
+        if UrlOpen:
+            return RetryPolicy().run(lambda timeout: open_with_timeout(req, timeout, opener))
+        ret = req.read()
+        req.close()
+        return ret
+    except Exception, e:
+        logger.error("Giving up downloading: %s" % e)
         return None
 
+class ConnectionPool():
+    """
+    Keeps HTTP/1.1 connections open after their responses have been read, so that the next request to the same host does not need a new TCP (and TLS) handshake.
+    
+    At most MAX_IDLE_PER_HOST idle connections are kept per host, and connections which have been idle for more than IDLE_TIMEOUT seconds are closed, because the server has most probably closed them already.
+    
+    """
+    MAX_IDLE_PER_HOST = 4
+    IDLE_TIMEOUT = 30 # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (scheme, host, tunnel host) -> list of (connection, time when it became idle), most recently used last
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+
+    def get(self, key, create):
+        """
+        Return an idle connection for key and True, or a new connection from create() and False.
+        
+        """
+        now = time()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while len(idle) > 0:
+                conn, since = idle.pop()
+                if now - since <= self.IDLE_TIMEOUT:
+                    self.reused += 1
+                    return conn, True
+                conn.close()
+            self.opened += 1
+        return create(), False
+
+    def put(self, key, conn):
+        """
+        Return a connection whose response has been read completely.
+        
+        """
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            idle.append((conn, time()))
+            if len(idle) > self.MAX_IDLE_PER_HOST:
+                idle.pop(0)[0].close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        
+        """
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, since in idle:
+                    conn.close()
+            self.idle = {}
+
+
+class PooledResponse():
+    """
+    Wraps an httplib.HTTPResponse and returns its connection to the pool as soon as the response has been read completely.
+    
+    If the response is closed before, the connection is closed as well, because the rest of the response would still be in its way.
+    
+    """
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def recv(self, amt=None):
+        data = self.response.read(amt)
+        if data == '' and amt != 0 and self.response.length:
+            # The server has closed the connection before sending the whole body,
+            # which HTTPResponse.read(amt) silently accepts
+            self.conn.close()
+            self.conn = None
+            raise httplib.IncompleteRead('', self.response.length)
+        self.release()
+        return data
+
+    read = recv
+
+    def release(self):
+        if self.conn == None or not self.response.isclosed():
+            return
+        if self.response.will_close:
+            self.conn.close()
+        else:
+            self.pool.put(self.key, self.conn)
+        self.conn = None
+
+    def close(self):
+        self.release()
+        if self.conn != None:
+            self.conn.close()
+            self.conn = None
+        self.response.close()
+
+
+class KeepAliveHandler():
+    """
+    Opens requests on persistent connections from a ConnectionPool instead of a new connection for each request.
+    
+    Mixed into the HTTP and HTTPS handlers below, which set connection_class.
+    
+    """
+    # The timeouts of requests and connections, set_tunnel and buffered
+    # responses need Python 2.7, older versions use the handlers of urllib2
+    SUPPORTED = version_info >= (2, 7)
+
+    def create_connection(self, req):
+        kwargs = {}
+        if getattr(self, '_context', None) != None:
+            kwargs['context'] = self._context
+        conn = self.connection_class(req.get_host(), timeout=req.timeout, **kwargs)
+        conn.set_debuglevel(self._debuglevel)
+        if req._tunnel_host:
+            tunnel_headers = {}
+            if 'Proxy-Authorization' in req.headers:
+                tunnel_headers['Proxy-Authorization'] = req.headers.pop('Proxy-Authorization')
+            conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+        return conn
+
+    def do_pooled_open(self, req):
+        """
+        Like AbstractHTTPHandler.do_open, but the connection is not closed after the response.
+        
+        """
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        key = (req.get_type(), req.get_host(), req._tunnel_host)
+        while True:
+            if req.has_data():
+                # The server may close an idle connection just as the request
+                # is sent. Then it is unknown whether the request has arrived,
+                # so a request with a body always gets a new connection.
+                conn, reused = self.create_connection(req), False
+            else:
+                conn, reused = self.pool.get(key, lambda: self.create_connection(req))
+            if reused and conn.sock != None:
+                conn.sock.settimeout(req.timeout)
+            elif conn.sock == None:
+                try:
+                    conn.connect()
+                except socket.error, e:
+                    conn.close()
+                    raise ConnectError(e)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                response = conn.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused:
+                    # The server has closed the idle connection meanwhile, so try again on a new one
+                    logger.debug("Reused connection failed (%s), opening a new one" % e)
+                    continue
+                if isinstance(e, socket.error):
+                    raise URLError(e)
+                raise
+            break
+        fp = socket._fileobject(PooledResponse(self.pool, key, conn, response), close=True)
+        resp = addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandler, HTTPHandler):
+    connection_class = httplib.HTTPConnection
+
+    def __init__(self, pool, debuglevel=0):
+        HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_pooled_open(req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandler, HTTPSHandler):
+    connection_class = httplib.HTTPSConnection
+
+    def __init__(self, pool, debuglevel=0):
+        HTTPSHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.do_pooled_open(req)
+
+
+class BodyCollector():
+    """
+    A parser for FileDownloader.get_parsed which returns the body as a string, for content without an incremental parser (such as JSON).
+    
+    The chunks are only joined once, in close().
+    
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        return ''.join(self.chunks)
+
+
+class HTTPArchive():
+    """
+    A content-addressed archive of HTTP requests and responses, for replaying them without network access.
+    
+    The bodies of requests and responses are stored in bodies/, in files named after their SHA-1. For each request (method, URL and body, but not the headers, which contain cookies), a file in requests/ named after the SHA-1 of the request holds the responses as JSON, in the order in which they were recorded. They are replayed in the same order, and the last one is repeated.
+    
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # request key -> number of responses replayed
+        self.replayed = {}
+        for name in ('bodies', 'requests'):
+            if not os.path.exists(os.path.join(directory, name)):
+                os.makedirs(os.path.join(directory, name))
+
+    @staticmethod
+    def get_key(req):
+        return sha1('%s %s\n%s' % (req.get_method(), req.get_full_url(), req.get_data() or '')).hexdigest()
+
+    def put_body(self, body):
+        name = sha1(body).hexdigest()
+        filename = os.path.join(self.directory, 'bodies', name)
+        if not os.path.exists(filename):
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(body)
+            os.rename(filename + '.tmp', filename)
+        return name
+
+    def get_body(self, name):
+        with open(os.path.join(self.directory, 'bodies', name), 'rb') as f:
+            return f.read()
+
+    def load(self, key):
+        try:
+            with open(os.path.join(self.directory, 'requests', '%s.json' % key), 'rb') as f:
+                return loads(f.read())
+        except IOError:
+            return None
+
+    def record(self, req, resp, body):
+        """
+        Add the response resp with the (undecoded) body to req.
+        
+        """
+        # header values are bytes, which JSON can only store as unicode
+        response = {'url': resp.geturl().decode('latin-1'), 'status': resp.code, 'reason': resp.msg.decode('latin-1'), 'headers': ''.join(resp.info().headers).decode('latin-1'), 'body': self.put_body(body)}
+        key = self.get_key(req)
+        filename = os.path.join(self.directory, 'requests', '%s.json' % key)
+        with self.lock:
+            exchange = self.load(key)
+            if exchange == None:
+                data = req.get_data()
+                exchange = {'method': req.get_method(), 'url': req.get_full_url().decode('latin-1'), 'body': self.put_body(data) if data != None else None, 'responses': []}
+            exchange['responses'].append(response)
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(dumps(exchange, indent=1))
+            os.rename(filename + '.tmp', filename)
+
+    def replay(self, req):
+        """
+        Return the URL, status, reason, headers and body of the next response to req, or None if req has not been recorded.
+        
+        """
+        key = self.get_key(req)
+        exchange = self.load(key)
+        if exchange == None:
+            return None
+        with self.lock:
+            count = self.replayed.get(key, 0)
+            self.replayed[key] = count + 1
+        response = exchange['responses'][min(count, len(exchange['responses']) - 1)]
+        return response['url'].encode('latin-1'), response['status'], response['reason'].encode('latin-1'), response['headers'].encode('latin-1'), self.get_body(response['body'])
+
+
+class RecordingProcessor(BaseHandler):
+    """
+    Records all responses into an HTTPArchive.
+    
+    """
+    # before HTTPErrorProcessor, so that error responses are recorded as well
+    handler_order = 400
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def http_response(self, req, resp):
+        from StringIO import StringIO
+        try:
+            body = resp.read()
+        finally:
+            resp.close()
+        self.archive.record(req, resp, body)
+        result = addinfourl(StringIO(body), resp.info(), resp.geturl())
+        result.code = resp.code
+        result.msg = resp.msg
+        return result
+
+    https_response = http_response
+
+
+class ThrottledReader():
+    """
+    A file-like object which returns data no faster than bandwidth bytes per second.
+    
+    """
+    def __init__(self, data, bandwidth):
+        from StringIO import StringIO
+        self.fp = StringIO(data)
+        self.bandwidth = bandwidth
+
+    def throttle(self, data):
+        if self.bandwidth > 0:
+            sleep(float(len(data)) / self.bandwidth)
+        return data
+
+    def read(self, amt=-1):
+        return self.throttle(self.fp.read(amt))
+
+    def readline(self, limit=-1):
+        return self.throttle(self.fp.readline(limit))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fp.close()
+
+
+class ReplayHandler(BaseHandler):
+    """
+    Answers requests from an HTTPArchive instead of the network, after latency seconds and at the given bandwidth.
+    
+    """
+    # before the default handlers, which would use the network
+    handler_order = 100
+
+    def __init__(self, archive, latency=0, bandwidth=0):
+        self.archive = archive
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def http_open(self, req):
+        from mimetools import Message
+        from StringIO import StringIO
+        response = self.archive.replay(req)
+        if response == None:
+            raise URLError("No recorded response for %s %s" % (req.get_method(), req.get_full_url()))
+        url, status, reason, headers, body = response
+        sleep(self.latency)
+        resp = addinfourl(ThrottledReader(body, self.bandwidth), Message(StringIO(headers)), url)
+        resp.code = status
+        resp.msg = reason
+        return resp
+
+    https_open = http_open
+
+
 class FileDownloader():
     USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.19 (KHTML, like Gecko) Ubuntu/12.04 Chromium/18.0.1025.168 Chrome/18.0.1025.168 Safari/535.19'
-    opener_installed = False
+    STREAM_CHUNK_SIZE = 16384 # bytes read at once by get_parsed
 
-    def __init__(self, username, password, cookiefile):
+    def __init__(self, username, password, cookiefile, cache_dir=None, cache_size=None):
         self.username = username
         self.password = password
         self.cookiefile = cookiefile
         self.logged_in = False
         from socket import setdefaulttimeout
         setdefaulttimeout(15)
-        self.opener_installed = False
         
         # This controls the use of the cache-headers in requests to allow/deny minified answers
         # as provided by some mobile operators.
         self.allow_minified_answers = True
 
+        # All requests share the cookie jar and the connection pool, so that
+        # a cache page, its logbook and its images are downloaded over the
+        # same connection.
+        from cookielib import LWPCookieJar
+        from urllib2 import build_opener, HTTPCookieProcessor
+        self.cookiejar = LWPCookieJar(self.cookiefile)
+        self.pool = ConnectionPool()
+        self.retry_policy = RetryPolicy()
+        self.http_cache = HTTPCache(cache_dir, cache_size) if cache_dir != None else None
+        debuglevel = 1 if DEBUG_HTTP else 0
+        if KeepAliveHandler.SUPPORTED:
+            handlers = [KeepAliveHTTPHandler(self.pool, debuglevel), KeepAliveHTTPSHandler(self.pool, debuglevel)]
+        else:
+            handlers = [HTTPHandler(debuglevel), HTTPSHandler(debuglevel)]
+        handlers.append(HTTPCookieProcessor(self.cookiejar))
+        if HTTP_REPLAY != None:
+            path, latency, bandwidth = HTTP_REPLAY
+            handlers.append(ReplayHandler(HTTPArchive(path), latency, bandwidth))
+        elif HTTP_RECORD_PATH != None:
+            handlers.append(RecordingProcessor(HTTPArchive(HTTP_RECORD_PATH)))
+        self.opener = build_opener(*handlers)
+
     def update_userdata(self, username = None, password = None):
         from os import path, remove
         if username != None:
@@ -111,6 +839,7 @@ class FileDownloader():
         if password != None:
             self.password = password
         self.logged_in = False
+        self.cookiejar.clear()
         if path.exists(self.cookiefile):
             try:
                 remove(self.cookiefile)
@@ -126,17 +855,7 @@ class FileDownloader():
         if self.username == '' or self.password == '':
             raise Exception("Please configure your username/password and restart the application")
         logger.info("Checking Login status")
-        from cookielib import LWPCookieJar
-        cj = LWPCookieJar(self.cookiefile)
-
-        if not self.opener_installed:
-            from urllib2 import build_opener, install_opener, HTTPCookieProcessor, HTTPHandler
-            if DEBUG_HTTP:
-                opener = build_opener(HTTPHandler(debuglevel=1), HTTPCookieProcessor(cj))
-            else:
-                opener = build_opener(HTTPCookieProcessor(cj))
-            install_opener(opener)
-            self.opener_installed = True
+        cj = self.cookiejar
 
         try:
             cj.load()
@@ -160,6 +879,54 @@ class FileDownloader():
 
 
     def get_reader(self, url, values=None, data=None, login=True, login_callback=None, check_login_callback=None):
+        req = self.prepare_request(url, values, data, login, login_callback, check_login_callback)
+        if req == None:
+            return None
+
+        self.debug_request(req)
+        try:
+            resp = self.retry_policy.run(lambda timeout: self.fetch(req, timeout), self.is_idempotent(req))
+        except Exception, e:
+            logger.error("Giving up downloading %s: %s" % (url, e))
+            return None
+        resp = self.debug_response(resp)
+        return resp
+
+    def get_parsed(self, url, parser_factory, values=None, data=None, login=True, login_callback=None, check_login_callback=None):
+        """
+        Like get_reader, but feed the body to a parser while it is downloaded, instead of reading it into memory first.
+        
+        parser_factory() must return a new parser with feed(data) and close() methods (such as lxml's HTMLParser or a BodyCollector) for each attempt. Return the result of close(), or None if the download failed.
+        
+        """
+        global DEBUG_HTTP
+        if DEBUG_HTTP:
+            # The debug files are written from complete responses
+            resp = self.get_reader(url, values, data, login, login_callback, check_login_callback)
+            if resp == None:
+                return None
+            parser = parser_factory()
+            parser.feed(read_from_network(resp))
+            return parser.close()
+
+        req = self.prepare_request(url, values, data, login, login_callback, check_login_callback)
+        if req == None:
+            return None
+        try:
+            return self.retry_policy.run(lambda timeout: self.stream(req, timeout, parser_factory), self.is_idempotent(req))
+        except Exception, e:
+            logger.error("Giving up downloading %s: %s" % (url, e))
+            return None
+
+    @staticmethod
+    def is_idempotent(req):
+        """
+        Return True if sending req again has no side effects, so that it may be retried after any error (see RetryPolicy).
+        
+        """
+        return req.get_method() in ('GET', 'HEAD')
+
+    def prepare_request(self, url, values, data, login, login_callback, check_login_callback):
         if login and not (login_callback and check_login_callback):
             raise Exception("Either login must be set to False or (check_)login_callback must be provided.")
         if connection.offline:
@@ -194,22 +961,150 @@ class FileDownloader():
 
         else: #This should never happen: values != None and data != None
             return None
+        return req
 
-        self.debug_request(req)
-        resp = read_from_network(req, UrlOpen=True)
-        if resp == None:
-            return None
+    def is_cacheable(self, req):
+        """
+        Return whether the response to req may come from and go to the HTTP cache: only GET requests without a body are, as the response to anything else depends on more than the URL.
+        
+        """
+        return self.http_cache != None and req.get_method() == 'GET' and not req.has_data()
 
+    def get_cache_user(self):
+        # the username from the settings is unicode, the HTTP cache works with bytes
+        return self.username.encode('utf-8') if isinstance(self.username, unicode) else self.username
+
+    def open_request(self, req, timeout):
+        """
+        Open req. Cacheable requests are made conditional if the response is in the HTTP cache.
+        
+        Return the response and whether it is the cached one (which has not been modified, and whose body is in memory).
+        
+        """
+        from StringIO import StringIO
+        url = req.get_full_url()
+        cacheable = self.is_cacheable(req)
+        validators = ('If-None-Match', 'If-Modified-Since')
+        for name in validators:
+            req.unredirected_hdrs.pop(name.capitalize(), None)
+        if cacheable:
+            for name, value in self.http_cache.get_validators(url, self.get_cache_user()).items():
+                req.add_unredirected_header(name, value)
+        try:
+            resp = open_with_timeout(req, timeout, self.opener)
+            if cacheable:
+                self.http_cache.miss()
+            return resp, False
+        except HTTPError, e:
+            if not cacheable or e.code != 304:
+                raise
+            # read the (empty) body, so that the connection can be reused
+            e.read()
+            e.close()
+            cached = self.http_cache.not_modified(url, self.get_cache_user())
+            if cached != None:
+                logger.debug("Not modified, using cached answer")
+                from mimetools import Message
+                cached_url, headers, body = cached
+                result = addinfourl(StringIO(body), Message(StringIO(headers)), cached_url)
+                result.code = 200
+                result.msg = 'OK'
+                return result, True
+            # evicted meanwhile, so download it again
+            for name in validators:
+                req.unredirected_hdrs.pop(name.capitalize(), None)
+            resp = open_with_timeout(req, timeout, self.opener)
+            self.http_cache.miss()
+            return resp, False
+
+    def store_response(self, req, resp, body):
+        if self.is_cacheable(req) and resp.code == 200:
+            self.http_cache.store(req.get_full_url(), self.get_cache_user(), resp, body)
+
+    def open_cache_entry(self, req, resp):
+        """
+        Return the HTTPCacheEntry to which the body of resp is written while it is downloaded, or None if it is not stored.
+        
+        """
+        if self.is_cacheable(req) and resp.code == 200:
+            return self.http_cache.open_entry(req.get_full_url(), self.get_cache_user(), resp)
+        return None
+
+    def fetch(self, req, timeout):
+        """
+        Open req and read the complete response, so that errors while reading can be retried as well.
+        
+        Return a response whose body is in memory.
+        
+        """
+        from StringIO import StringIO
+        resp, cached = self.open_request(req, timeout)
+        if cached:
+            return resp
+        try:
+            body = resp.read()
+        finally:
+            resp.close()
         if resp.info().get('Content-Encoding') == 'gzip':
-            from StringIO import StringIO
             import gzip
             logger.debug("Got gzip encoded answer")
-            buf = StringIO(read_from_network(resp))
-            resp = gzip.GzipFile(fileobj=buf)
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
         else:
             logger.debug("Got unencoded answer")
-        resp = self.debug_response(resp)
-        return resp
+        self.store_response(req, resp, body)
+        result = addinfourl(StringIO(body), resp.info(), resp.geturl())
+        result.code = resp.code
+        result.msg = resp.msg
+        return result
+
+    def stream(self, req, timeout, parser_factory):
+        """
+        Open req and feed the body to a new parser from parser_factory while it is downloaded, gzip encoded bodies are decompressed on the way.
+        
+        Return the result of the parser's close().
+        
+        """
+        import zlib
+        resp, cached = self.open_request(req, timeout)
+        parser = parser_factory()
+        if cached:
+            parser.feed(resp.read())
+            return parser.close()
+        if resp.info().get('Content-Encoding') == 'gzip':
+            logger.debug("Got gzip encoded answer")
+            # 16 + MAX_WBITS: expect a gzip header and trailer
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            logger.debug("Got unencoded answer")
+            decompressor = None
+        # The HTTP cache gets the body as it is parsed, so it is not kept in memory
+        entry = self.open_cache_entry(req, resp)
+        try:
+            while True:
+                data = resp.read(self.STREAM_CHUNK_SIZE)
+                if data == '':
+                    break
+                if decompressor != None:
+                    data = decompressor.decompress(data)
+                if data != '':
+                    parser.feed(data)
+                    if entry != None:
+                        entry.write(data)
+            if decompressor != None:
+                data = decompressor.flush()
+                if data != '':
+                    parser.feed(data)
+                    if entry != None:
+                        entry.write(data)
+        except:
+            if entry != None:
+                entry.abort()
+            raise
+        finally:
+            resp.close()
+        if entry != None:
+            entry.commit()
+        return parser.close()
             
     def debug_request(self, req):
         global DEBUG_HTTP
@@ -238,6 +1133,15 @@ class FileDownloader():
             f.write(resp.read())    
         return open(path, 'r')
             
+    def get_cache_status(self):
+        """
+        Return a short description of the HTTP cache hits and misses, for progress messages.
+        
+        """
+        if self.http_cache == None:
+            return ''
+        return " (%s)" % self.http_cache.get_status()
+
     def encode_multipart_formdata(self, fields, files):
         """
         fields is a sequence of (name, value) elements for regular form fields.
@@ -36,8 +36,181 @@ except Exception:
         return Coordinate.RADIUS_EARTH * c;
     distance_to = distance_to_manual
 
+def bearing_to(src, target):
+    lat1 = math.radians(src.lat)
+    lat2 = math.radians(target.lat)
+
+    dlon = math.radians(target.lon - src.lon);
+    y = math.sin(dlon) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    bearing = math.degrees(math.atan2(y, x))
+    return (360 + bearing) % 360
+
 DEGREES = "°"
 
+# Quadkeys name the tiles of the map (in the Mercator projection) as in
+# Bing Maps: each digit selects one quarter of the tile before.
+QUADKEY_MAX_LAT = 85.05112878
+
+def tile_xy(lat, lon, zoom):
+    """
+    Return the x and y number of the map tile at the given zoom level which contains lat, lon.
+    
+    """
+    n = 1 << zoom
+    lat_rad = math.radians(max(-QUADKEY_MAX_LAT, min(QUADKEY_MAX_LAT, lat)))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + (1.0 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def quadkey_from_tile(x, y, zoom):
+    """
+    Return the quadkey of a map tile.
+    
+    """
+    digits = []
+    for i in xrange(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append('0123'[(1 if x & mask else 0) + (2 if y & mask else 0)])
+    return ''.join(digits)
+
+def quadkey_to_tile(key):
+    """
+    Return the x and y number and the zoom level of the map tile with the given quadkey.
+    
+    """
+    x = y = 0
+    for digit in key:
+        d = '0123'.index(digit)
+        x = (x << 1) | (d & 1)
+        y = (y << 1) | (d >> 1)
+    return x, y, len(key)
+
+def quadkey_encode(lat, lon, zoom):
+    """
+    Return the quadkey of the map tile at the given zoom level which contains lat, lon.
+    
+    """
+    x, y = tile_xy(lat, lon, zoom)
+    return quadkey_from_tile(x, y, zoom)
+
+def quadkey_decode(key):
+    """
+    Return the boundaries (minlat, maxlat, minlon, maxlon) of the map tile with the given quadkey.
+    
+    """
+    x, y, zoom = quadkey_to_tile(key)
+    n = float(1 << zoom)
+    lat = lambda y: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat(y + 1), lat(y), x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+
+def quadkey_neighbours(key):
+    """
+    Return the quadkeys of the (up to eight) tiles around the tile with the given quadkey.
+    
+    """
+    x, y, zoom = quadkey_to_tile(key)
+    n = 1 << zoom
+    return [quadkey_from_tile((x + dx) % n, y + dy, zoom) for dy in (-1, 0, 1) for dx in (-1, 0, 1) \
+        if (dx, dy) != (0, 0) and 0 <= y + dy < n and (n > 2 or 0 <= x + dx < n)]
+
+def quadkeys_covering(c1, c2, zoom):
+    """
+    Return the quadkeys of the map tiles at the given zoom level which cover the rectangle between c1 and c2.
+    
+    """
+    x1, y1 = tile_xy(max(c1.lat, c2.lat), min(c1.lon, c2.lon), zoom)
+    x2, y2 = tile_xy(min(c1.lat, c2.lat), max(c1.lon, c2.lon), zoom)
+    return [quadkey_from_tile(x, y, zoom) for y in xrange(y1, y2 + 1) for x in xrange(x1, x2 + 1)]
+
+# Geohashes encode latitude and longitude in alternating bits, starting
+# with the longitude, five bits per character.
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def _geohash_cell(precision):
+    """
+    Return the height and width in degrees of the cells of geohashes with the given number of characters.
+    
+    """
+    bits = 5 * precision
+    return 180.0 / (1 << (bits // 2)), 360.0 / (1 << (bits - bits // 2))
+
+def geohash_encode(lat, lon, precision=9):
+    """
+    Return the geohash of lat, lon with the given number of characters.
+    
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    even = True
+    for i in xrange(precision):
+        value = 0
+        for bit in xrange(5):
+            interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+            middle = (interval[0] + interval[1]) / 2
+            if coordinate >= middle:
+                value = (value << 1) | 1
+                interval[0] = middle
+            else:
+                value = value << 1
+                interval[1] = middle
+            even = not even
+        chars.append(GEOHASH_ALPHABET[value])
+    return ''.join(chars)
+
+def geohash_decode(geohash):
+    """
+    Return the boundaries (minlat, maxlat, minlon, maxlon) of the cell of a geohash.
+    
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = GEOHASH_ALPHABET.index(char)
+        for bit in xrange(4, -1, -1):
+            interval = lon_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if value & (1 << bit):
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+def geohash_neighbours(geohash):
+    """
+    Return the geohashes of the (up to eight) cells around the cell of a geohash.
+    
+    """
+    minlat, maxlat, minlon, maxlon = geohash_decode(geohash)
+    height, width = maxlat - minlat, maxlon - minlon
+    lat, lon = (minlat + maxlat) / 2, (minlon + maxlon) / 2
+    result = []
+    for dlat in (height, 0, -height):
+        for dlon in (-width, 0, width):
+            if (dlat, dlon) != (0, 0) and -90 < lat + dlat < 90:
+                neighbour = geohash_encode(lat + dlat, (lon + dlon + 180) % 360 - 180, len(geohash))
+                if neighbour not in result and neighbour != geohash:
+                    result.append(neighbour)
+    return result
+
+def geohashes_covering(c1, c2, precision):
+    """
+    Return the geohashes with the given number of characters whose cells cover the rectangle between c1 and c2.
+    
+    """
+    height, width = _geohash_cell(precision)
+    minlat, maxlat = min(c1.lat, c2.lat), max(c1.lat, c2.lat)
+    minlon, maxlon = min(c1.lon, c2.lon), max(c1.lon, c2.lon)
+    rows = int(math.floor((min(maxlat, 90.0 - height / 2) + 90.0) / height)) - int(math.floor((minlat + 90.0) / height)) + 1
+    columns = int(math.floor((min(maxlon, 180.0 - width / 2) + 180.0) / width)) - int(math.floor((minlon + 180.0) / width)) + 1
+    # the centers of the cells
+    lat0 = (math.floor((minlat + 90.0) / height) + 0.5) * height - 90.0
+    lon0 = (math.floor((minlon + 180.0) / width) + 0.5) * width - 180.0
+    return [geohash_encode(lat0 + i * height, lon0 + j * width, precision) for i in xrange(rows) for j in xrange(columns)]
+
 def try_parse_coordinate(text):
     
     text = text.strip()
@@ -194,14 +367,7 @@ class Coordinate(object):
             [int(math.floor(lon)), (lon - math.floor(lon)) * 60]]
     
     def bearing_to(self, target):
-        lat1 = math.radians(self.lat)
-        lat2 = math.radians(target.lat)
-        
-        dlon = math.radians(target.lon - self.lon);
-        y = math.sin(dlon) * math.cos(lat2)
-        x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
-        bearing = math.degrees(math.atan2(y, x))
-        return (360 + bearing) % 360
+        return bearing_to(self, target)
         
     def transform(self, bearing, distance):
         # expect distance in meters and bearing in degrees
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#   Copyright (C) 2012 Daniel Fett
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Author: Daniel Fett agtl@danielfett.de
+#   Jabber: fett.daniel@jaber.ccc.de
+#   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
+#
+
+
+"""
+Geodesy for many coordinates at once, see geo for single coordinates.
+
+The functions take geocaches, coordinates or anything else with lat and lon attributes. Where two arguments are given, each may be a single coordinate or a sequence, and the results are calculated pairwise (like NumPy broadcasting). NumPy is used if it is available, otherwise the functions of geo are called for each pair. The results are always lists.
+
+"""
+
+import logging
+import math
+
+import geo
+logger = logging.getLogger('geobatch')
+
+try:
+    import numpy
+    logger.debug("Using numpy")
+except ImportError:
+    numpy = None
+    logger.debug("Not using numpy")
+
+# Number of points which within_radius converts to arrays at once
+CHUNK_SIZE = 1000
+
+
+def _is_single(points):
+    return hasattr(points, 'lat')
+
+def _radians(points):
+    """
+    Return the latitudes and longitudes of points in radians, as arrays (or numbers for a single coordinate).
+    
+    """
+    if _is_single(points):
+        return math.radians(points.lat), math.radians(points.lon)
+    count = len(points)
+    lat = numpy.fromiter((p.lat for p in points), float, count)
+    lon = numpy.fromiter((p.lon for p in points), float, count)
+    return numpy.radians(lat), numpy.radians(lon)
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """
+    Return the great circle distances in meters for arrays of coordinates in radians, see geo.distance_to.
+    
+    """
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * geo.Coordinate.RADIUS_EARTH * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+def _pairs(sources, targets):
+    """
+    Return the pairs of coordinates for the plain Python implementation.
+    
+    """
+    if _is_single(sources) and _is_single(targets):
+        return [(sources, targets)]
+    elif _is_single(sources):
+        return [(sources, t) for t in targets]
+    elif _is_single(targets):
+        return [(s, targets) for s in sources]
+    if len(sources) != len(targets):
+        raise ValueError("Got %d sources, but %d targets" % (len(sources), len(targets)))
+    return zip(sources, targets)
+
+def _as_list(result):
+    result = result.tolist()
+    return result if type(result) == list else [result]
+
+
+def distances(sources, targets):
+    """
+    Return the distances in meters from sources to targets.
+    
+    """
+    if numpy == None:
+        return [geo.distance_to(s, t) for s, t in _pairs(sources, targets)]
+    return _as_list(_haversine(*(_radians(sources) + _radians(targets))))
+
+def bearings(sources, targets):
+    """
+    Return the bearings in degrees (0 to 360) from sources to targets, see geo.Coordinate.bearing_to.
+    
+    """
+    if numpy == None:
+        return [geo.bearing_to(s, t) for s, t in _pairs(sources, targets)]
+    lat1, lon1 = _radians(sources)
+    lat2, lon2 = _radians(targets)
+    dlon = lon2 - lon1
+    y = numpy.sin(dlon) * numpy.cos(lat2)
+    x = numpy.cos(lat1) * numpy.sin(lat2) - numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(dlon)
+    return _as_list((numpy.degrees(numpy.arctan2(y, x)) + 360) % 360)
+
+def distance_matrix(points1, points2=None):
+    """
+    Return the distances in meters between all points1 and all points2 (or all points1, if points2 is None) as a list of rows, one row for each of points1.
+    
+    """
+    if points2 == None:
+        points2 = points1
+    if numpy == None:
+        return [[geo.distance_to(p, q) for q in points2] for p in points1]
+    lat1, lon1 = _radians(points1)
+    lat2, lon2 = _radians(points2)
+    return _haversine(lat1[:, numpy.newaxis], lon1[:, numpy.newaxis], lat2, lon2).tolist()
+
+def within_radius(center, radius, points):
+    """
+    Return the points which are at most radius meters away from center.
+    
+    points may be any iterable, it is read in chunks of CHUNK_SIZE.
+    
+    """
+    if numpy == None:
+        return [p for p in points if geo.distance_to(p, center) <= radius]
+    result = []
+    chunk = []
+    for p in points:
+        chunk.append(p)
+        if len(chunk) == CHUNK_SIZE:
+            result += [q for q, d in zip(chunk, distances(center, chunk)) if d <= radius]
+            chunk = []
+    if len(chunk) > 0:
+        result += [q for q, d in zip(chunk, distances(center, chunk)) if d <= radius]
+    return result
+
+def thin_out(points, min_distance, max_points=None):
+    """
+    Return the points which are at least min_distance meters away from all points before them in the result.
+    
+    max_points -- Stop as soon as the result has more than this many points
+    
+    """
+    result = []
+    if numpy == None:
+        for p in points:
+            if all(geo.distance_to(p, q) >= min_distance for q in result):
+                result.append(p)
+                if max_points != None and len(result) > max_points:
+                    break
+        return result
+    points = list(points)
+    lat, lon = _radians(points)
+    # coordinates of the result
+    kept_lat = numpy.empty(len(points))
+    kept_lon = numpy.empty(len(points))
+    count = 0
+    for i in xrange(len(points)):
+        if count > 0 and _haversine(lat[i], lon[i], kept_lat[:count], kept_lon[:count]).min() < min_distance:
+            continue
+        kept_lat[count] = lat[i]
+        kept_lon[count] = lon[i]
+        count += 1
+        result.append(points[i])
+        if max_points != None and count > max_points:
+            break
+    return result
+
+
+if __name__ == '__main__':
+    # Micro benchmarks, comparing the batch functions with calling geo for each point
+    import random
+    import sys
+    from time import time
+    logging.basicConfig(level=logging.INFO, format='%(relativeCreated)6d %(levelname)10s %(name)-20s %(message)s')
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000, 100000]
+    center = geo.Coordinate(49.5, 6.5)
+    def measure(function, *args):
+        start = time()
+        function(*args)
+        return (time() - start) * 1000
+    logger.info("Using %s" % ('numpy %s' % numpy.__version__ if numpy != None else 'plain Python'))
+    for size in sizes:
+        points = [geo.Coordinate(random.uniform(47, 55), random.uniform(6, 15)) for i in xrange(size)]
+        others = points[1:] + points[:1]
+        results = [
+            ('distances from one point', measure(lambda: [geo.distance_to(center, p) for p in points]), measure(distances, center, points)),
+            ('pairwise distances', measure(lambda: [geo.distance_to(p, q) for p, q in zip(points, others)]), measure(distances, points, others)),
+            ('bearings from one point', measure(lambda: [geo.bearing_to(center, p) for p in points]), measure(bearings, center, points)),
+            ('within 50 km', measure(lambda: [p for p in points if geo.distance_to(p, center) <= 50000]), measure(within_radius, center, 50000, points)),
+            ('distance matrix %dx100' % size, measure(lambda: [[geo.distance_to(p, q) for q in points[:100]] for p in points]), measure(distance_matrix, points, points[:100])),
+            ]
+        if size <= 10000:
+            # as the route search used to do it
+            def thin_out_one_by_one(points, min_distance):
+                result = []
+                for p in points:
+                    for q in result:
+                        if geo.distance_to(p, q) < min_distance:
+                            break
+                    else:
+                        result.append(p)
+                return result
+            results.append(('thin out to 5 km', measure(thin_out_one_by_one, points, 5000), measure(thin_out, points, 5000)))
+        for title, single, batch in results:
+            logger.info("%7d points: %s: %.1f ms one by one, %.1f ms batched" % (size, title, single, batch))
@@ -28,10 +28,68 @@ except (ImportError, AttributeError):
 from datetime import datetime
 import logging
 import time
+import zlib
 
 import geo
+from utils import HTMLManipulations
 logger = logging.getLogger('geocaching')
 
+
+class ReadOnlyDict(dict):
+    """
+    A dict which can not be changed, for the decoded values of the JSON fields of a geocache (see GeocacheCoordinate._freeze_json).
+    
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("The value of a JSON field can not be changed in place, use the set_... methods of the geocache.")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+class GeocacheSummary(object):
+    """
+    Compact, read-only record with the information needed to draw a geocache on the map or in a list.
+    
+    Use PointProvider.get_by_name to load the full geocache once it is opened.
+    
+    """
+    __slots__ = ('lat', 'lon', 'name', 'title', 'type', 'size', 'difficulty', \
+                 'terrain', 'found', 'marked', 'status', 'alter_lat', 'alter_lon', \
+                 'has_details')
+
+    # SQL expressions for the attributes which are not plain table fields
+    SQLEXPRESSIONS = {
+        'has_details': "EXISTS (SELECT 1 FROM %(details)s WHERE %(details)s.name = %(table)s.name AND logs IS NOT NULL AND logs != '')",
+        }
+
+    def __init__(self, data):
+        for key in self.__slots__:
+            setattr(self, key, data[key])
+
+    def was_downloaded(self):
+        return bool(self.has_details)
+
+    def get_difficulty(self):
+        return "%.1f" % (self.difficulty / 10.0) if self.difficulty != -1 else '?'
+
+    def get_terrain(self):
+        return "%.1f" % (self.terrain / 10.0) if self.terrain != -1 else '?'
+
+    def get_size_string(self):
+        if self.size == -1:
+            return '?'
+        else:
+            return GeocacheCoordinate.SIZES[self.size]
+
+    def get_status(self):
+        return GeocacheCoordinate.STATUS_TEXT[self.status] if self.status != None else ''
+
+    def distance_to(self, target):
+        return geo.distance_to(self, target)
+
+    def __str__(self):
+        return "%s (%s)" % (self.name, self.title)
+
 class GeocacheCoordinate(geo.Coordinate):
     LOG_NO_LOG = 0
     LOG_AS_FOUND = 1
@@ -108,6 +166,25 @@ class GeocacheCoordinate(geo.Coordinate):
              'size', 'difficulty', 'terrain', 'owner', 'found', 'waypoints', \
              'images', 'logs', 'status', 'attributes', 'updated', 'websitelink')
 
+    # These are the large fields which are only needed when the geocache
+    # is viewed in detail. They are stored in a separate table and loaded
+    # on first access (see __getattr__).
+    DETAIL_ATTRS = ('shortdesc', 'desc', 'hints', 'waypoints', 'images', 'logs')
+
+    # The largest details may be stored compressed (see compress). They
+    # are decompressed on first access.
+    COMPRESSED_ATTRS = ('desc', 'images', 'logs')
+
+    # First byte of a compressed value, so that other codecs can be added
+    # later. Values which were stored as text are not compressed.
+    CODEC_ZLIB = '\x01'
+
+    # These fields hold JSON, mapped to the type of their decoded value.
+    # They are decoded once, on first access, and only encoded again if the
+    # decoded value was replaced (see _get_json and _set_json). The decoded
+    # values are read-only, so that changes in place can't go unnoticed.
+    JSON_ATTRS = {'waypoints': list, 'user_coordinates': list, 'images': dict, 'logs': list}
+
     SQLROW = {
         'lat': 'REAL',
         'lon': 'REAL',
@@ -141,7 +218,21 @@ class GeocacheCoordinate(geo.Coordinate):
         'websitelink' : 'TEXT',
         'upload_as' : 'INTEGER',
         }
+
+    # The table fields and the values derived from them are kept in slots,
+    # which is much more compact than a dict for each geocache. Other
+    # attributes (such as prox or display_text) still end up in __dict__,
+    # which is only created when the first one is set.
+    __slots__ = ATTRS + ('calc', 'details_loader', 'packed_details', \
+             'json_values', 'json_dirty', 'changed')
+
+    # see __setattr__
+    TRACKED_ATTRS = frozenset(ATTRS)
+
     def __init__(self, lat, lon=None, name='', data=None):
+        self.json_values = None
+        self.json_dirty = None
+        self.changed = None
         geo.Coordinate.__init__(self, lat, lon, name)
         if data != None:
             self.unserialize(data)
@@ -178,10 +269,84 @@ class GeocacheCoordinate(geo.Coordinate):
         self.websitelink = ''
         self.upload_as = self.UPLOAD_AS_FIELDNOTE
 
+    def __getattr__(self, name):
+        # Only called if the attribute is not set, i.e. for details which were not loaded
+        # or not decompressed yet
+        if name in self.DETAIL_ATTRS:
+            if self._is_set('details_loader'):
+                loader = self.details_loader
+                del self.details_loader
+                self.packed_details = {}
+                # loading is no change, so __setattr__ is bypassed
+                for key, value in loader(self.name).items():
+                    if self._is_set(key):
+                        continue
+                    elif isinstance(value, buffer):
+                        self.packed_details[key] = value
+                    else:
+                        object.__setattr__(self, key, value)
+            if self._is_set(name):
+                return object.__getattribute__(self, name)
+            if self._is_set('packed_details') and name in self.packed_details:
+                value = self.decompress(self.packed_details.pop(name))
+                object.__setattr__(self, name, value)
+                return value
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        # Remember which fields were changed, see get_changes
+        if name in self.TRACKED_ATTRS:
+            if self.changed == None:
+                self.changed = set()
+            self.changed.add(name)
+            # New text for a JSON field replaces its decoded value
+            if name in self.JSON_ATTRS and self.json_values != None:
+                self.json_values.pop(name, None)
+                if self.json_dirty != None:
+                    self.json_dirty.discard(name)
+        object.__setattr__(self, name, value)
+
+    def get_changes(self):
+        """
+        Return the names of the fields (see ATTRS) which were changed since the geocache was loaded or saved.
+        
+        All fields of a geocache which was not loaded from the database count as changed.
+        
+        """
+        return frozenset(self.changed) if self.changed != None else frozenset()
+
+    def clear_changes(self, attributes=None):
+        """
+        Forget the changes of the given fields (or of all fields, if attributes is None) after they were saved.
+        
+        """
+        if attributes == None:
+            self.changed = None
+        elif self.changed != None:
+            self.changed.difference_update(attributes)
+
+    def _is_set(self, name):
+        # Unlike hasattr, this does not load the details
+        try:
+            object.__getattribute__(self, name)
+            return True
+        except AttributeError:
+            return False
+
     def clone(self):
         n = GeocacheCoordinate(self.lat, self.lon)
+        for k in list(self.json_dirty or ()):
+            self._encode_json(k)
+        loading = self._is_set('details_loader')
         for k in self.ATTRS:
-            setattr(n, k, getattr(self, k))
+            if not loading or self._is_set(k):
+                setattr(n, k, getattr(self, k))
+            else:
+                # Details which were not loaded yet are loaded by the clone on demand
+                delattr(n, k)
+        if loading:
+            n.details_loader = self.details_loader
+        n.changed = set(self.changed) if self.changed != None else None
         return n
 
     def touch_updated(self):
@@ -200,7 +365,7 @@ class GeocacheCoordinate(geo.Coordinate):
         return "%.1f" % (self.difficulty / 10.0) if self.difficulty != -1 else '?'
         
     def get_terrain(self):
-        return "%.1f" % (self.terrain / 10.0) if self.difficulty != -1 else '?'
+        return "%.1f" % (self.terrain / 10.0) if self.terrain != -1 else '?'
 
     def get_status(self):
         return self.STATUS_TEXT[self.status] if self.status != None else ''
@@ -218,87 +383,174 @@ class GeocacheCoordinate(geo.Coordinate):
             return 1 if self.marked else 0
         elif attribute == 'vars':
             return dumps(self.calc.get_vars()) if self.calc != None else self.vars
-        elif attribute == 'user_coordinates':
-            try:
-                return dumps(self.saved_user_coordinates)
-            except AttributeError:
-                return self.user_coordinates
-        elif attribute == 'waypoints':
-            try:
-                return dumps(self.saved_waypoints)
-            except AttributeError:
-                return self.waypoints
+        elif attribute in self.JSON_ATTRS:
+            return self._encode_json(attribute)
         else:
             return getattr(self, attribute)
                 
     def unserialize(self, data):
-        ret = {}
+        # Loading is no change, so __setattr__ is bypassed
+        assign = object.__setattr__
+        assign(self, 'json_values', None)
+        assign(self, 'json_dirty', None)
+        assign(self, 'changed', None)
         for key in self.ATTRS:
-            ret[key] = data[key]
-        self.__dict__ = ret
+            try:
+                assign(self, key, self.decompress(data[key]) if key in self.COMPRESSED_ATTRS else data[key])
+            except (IndexError, KeyError):
+                # Details are usually not part of the query, see DETAIL_ATTRS
+                if key not in self.DETAIL_ATTRS:
+                    raise
+
+    def _get_json(self, name):
+        """
+        Return the decoded value of a JSON field (see JSON_ATTRS), which is only decoded on first access.
+        
+        Lists are returned as tuples and dicts as ReadOnlyDicts, see _freeze_json.
+        
+        """
+        if self.json_values == None:
+            self.json_values = {}
+        elif name in self.json_values:
+            return self.json_values[name]
+        text = getattr(self, name)
+        empty = self.JSON_ATTRS[name]
+        value = empty() if text in (None, '{}', '') else loads(text, object_hook=self._freeze_object)
+        if not isinstance(value, empty):
+            logger.debug('Replacing invalid value of %s' % name)
+            value = empty()
+        value = tuple(value) if empty == list else ReadOnlyDict(value)
+        self.json_values[name] = value
+        return value
+
+    def _set_json(self, name, value):
+        """
+        Set the decoded value of a JSON field.
+        
+        The text is encoded when it is needed, see _encode_json. A read-only copy of value is kept, so changing value afterwards has no effect.
+        
+        """
+        if self.json_values == None:
+            self.json_values = {}
+        if self.json_dirty == None:
+            self.json_dirty = set()
+        if self.changed == None:
+            self.changed = set()
+        self.json_values[name] = self._freeze_json(value)
+        self.json_dirty.add(name)
+        self.changed.add(name)
+
+    @classmethod
+    def _freeze_json(cls, value):
+        """
+        Return a copy of a decoded JSON value with all lists turned into tuples and all dicts into ReadOnlyDicts.
+        
+        """
+        if isinstance(value, (list, tuple)):
+            return tuple(cls._freeze_json(x) for x in value)
+        elif isinstance(value, dict):
+            return ReadOnlyDict((k, cls._freeze_json(v)) for k, v in value.iteritems())
+        return value
+
+    @staticmethod
+    def _freeze_object(d):
+        """
+        Turn a decoded JSON object into a ReadOnlyDict while it is decoded, like _freeze_json does afterwards.
+        
+        """
+        for k, v in d.iteritems():
+            if type(v) == list:
+                d[k] = tuple(v)
+        return ReadOnlyDict(d)
+
+    def _encode_json(self, name):
+        """
+        Return the text of a JSON field, after encoding its decoded value if that was changed.
+        
+        """
+        if self.json_dirty != None and name in self.json_dirty:
+            # keeps the decoded value, unlike __setattr__
+            object.__setattr__(self, name, dumps(self.json_values[name]))
+            self.json_dirty.discard(name)
+        return getattr(self, name)
         
     def get_waypoints(self):
-        try:
-            return self.saved_waypoints
-        except (AttributeError):
-            if self.waypoints in (None, '{}', ''):
-                self.saved_waypoints = []
-            else:
-                self.saved_waypoints = loads(self.waypoints)
-            return self.saved_waypoints
+        return self._get_json('waypoints')
 
     def get_user_coordinates(self, ctype):
-        try:
-            self.saved_user_coordinates
-        except (AttributeError):
-            if self.user_coordinates in (None, '{}', ''):
-                self.saved_user_coordinates = []
-            else:
-                self.saved_user_coordinates = loads(self.user_coordinates)
-                if type(self.saved_user_coordinates) != list:
-                    logger.debug('Creating new list!')
-                    self.saved_user_coordinates = []
-        return [(id, point) for id, point in zip(range(len(self.saved_user_coordinates)), self.saved_user_coordinates) if point['type'] == ctype]
-        
+        return [(id, point) for id, point in enumerate(self._get_json('user_coordinates')) if point['type'] == ctype]
 
     def get_user_coordinate(self, id):
         try:
-            return self.saved_user_coordinates[id]
-        except AttributeError:
-            logger.exception("Call get_user_coordinates first!")
-        except KeyError:
+            return self._get_json('user_coordinates')[id]
+        except (IndexError, KeyError):
             raise Exception("No user coordinate with id %d" % id)
 
-
     def get_logs(self):
-        if self.logs == None or self.logs == '':
-            return []
-        return loads(self.logs)
+        return self._get_json('logs')
 
     def get_images(self):
-        if self.images == None or self.images == '':
-            return {}
-        try:
-            return self.saved_images
-        except (AttributeError):
-            self.saved_images = loads(self.images)
-            return self.saved_images
+        return self._get_json('images')
 
     def set_waypoints(self, wps):
-        self.saved_waypoints = wps
+        self._set_json('waypoints', wps)
 
     def set_logs(self, ls):
-        self.logs = dumps(ls)
+        self._set_json('logs', ls)
 
     def set_images(self, imgs):
-        self.images = dumps(imgs)
-        try:
-            del self.saved_images
-        except:
-            pass
+        self._set_json('images', imgs)
                 
     def was_downloaded(self):
-        return (self.logs != None and self.logs != '')
+        logs = self._encode_json('logs')
+        return (logs != None and logs != '')
+
+    @staticmethod
+    def compress(text):
+        """
+        Return the compressed form of a text field for the database, see COMPRESSED_ATTRS.
+        
+        Empty values are left as they are, so that they can still be compared with ''.
+        
+        """
+        if text == None or text == '':
+            return text
+        return buffer(GeocacheCoordinate.CODEC_ZLIB + zlib.compress(text.encode('utf-8')))
+
+    @staticmethod
+    def decompress(value):
+        """
+        Return the text of a field as read from the database, which may be compressed (see compress) or not.
+        
+        """
+        if not isinstance(value, buffer):
+            return value
+        value = str(value)
+        if value[0] == GeocacheCoordinate.CODEC_ZLIB:
+            return zlib.decompress(value[1:]).decode('utf-8')
+        raise ValueError("Unknown codec %r" % value[0])
+
+    @staticmethod
+    def get_search_text(html):
+        """
+        Return the plain text of an HTML field (such as desc) for the full text index.
+        
+        """
+        html = GeocacheCoordinate.decompress(html)
+        if html == None or html == '':
+            return ''
+        return HTMLManipulations._decode_htmlentities(HTMLManipulations._strip_html(html, True))
+
+    @staticmethod
+    def get_search_logs(logs):
+        """
+        Return the text of all logs in a serialized logs field for the full text index.
+        
+        """
+        logs = GeocacheCoordinate.decompress(logs)
+        if logs == None or logs == '':
+            return ''
+        return u' '.join(l.get('text', '') for l in loads(logs))
         
     def get_bounds(self):
         minlat = maxlat = self.lat
@@ -367,23 +619,20 @@ class GeocacheCoordinate(geo.Coordinate):
 
     def set_user_coordinate(self, type, value, name, id = None):
         d = {'value': value, 'type' : type, 'name' : name}
-        try:
-            if id == None:
-                new_id = len(self.saved_user_coordinates)
-                self.saved_user_coordinates.append(d)
-                return new_id
-            else:
-                self.saved_user_coordinates[id] = d
-                return id
-        except AttributeError:
-            raise Exception("get_user_coordinates has to be called first!")
+        coordinates = list(self._get_json('user_coordinates'))
+        if id == None:
+            id = len(coordinates)
+            coordinates.append(d)
+        else:
+            coordinates[id] = d
+        self._set_json('user_coordinates', coordinates)
+        return id
         
 
     def delete_user_coordinate(self, id):
-        try:
-            del self.saved_user_coordinates[id]
-        except AttributeError:
-            raise Exception("get_user_coordinates has to be called first!")
+        coordinates = list(self._get_json('user_coordinates'))
+        del coordinates[id]
+        self._set_json('user_coordinates', coordinates)
 
     def get_collected_coordinates(self, format, include_unknown = True, htmlcallback = lambda x: x, shorten_callback = lambda x: x, skip_calc = False):
         cache = self
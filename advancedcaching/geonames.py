@@ -23,6 +23,7 @@
 from urllib import quote
 
 import geo
+import geobatch
 try:
     import json
     json.dumps
@@ -111,17 +112,12 @@ class Geonames():
                 if p.nodeType != Node.ELEMENT_NODE:
                     continue
                 lon, tmp, lat = p.childNodes[0].data.partition(' ')
-                c = geo.Coordinate(float(lat), float(lon))
-                stop = False
-                for o in route_points:
-                    if c.distance_to(o) < mdist:
-                        stop = True
-                        break
-                if not stop:
-                    route_points.append(c)
-
-                if len(route_points) > self.MAX_NODES:
-                    raise Exception("Too many waypoints! Try a bigger radius.")
+                route_points.append(geo.Coordinate(float(lat), float(lon)))
+
+        # skip the points which are close to the ones before
+        route_points = geobatch.thin_out(route_points, mdist, self.MAX_NODES)
+        if len(route_points) > self.MAX_NODES:
+            raise Exception("Too many waypoints! Try a bigger radius.")
         logger.info("Using the following Waypoints:")
         return route_points
 
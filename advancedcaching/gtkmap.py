@@ -519,21 +519,29 @@ class GeocacheLayer(AbstractGeocacheLayer):
     COLOR_ARCHIVED = gtk.gdk.color_parse('blue')
     COLOR_WAYPOINTS = gtk.gdk.color_parse('deeppink')
 
+    CLUSTER_MAX_RADIUS = 32
+
     def draw(self):
         surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.map.map_width, self.map.map_height)
         cr = gtk.gdk.CairoContext(cairo.Context(surface))
 
-        coords = self.get_geocaches_callback(self.map.get_visible_area(), self.MAX_NUM_RESULTS_SHOW)
+        area = self.map.get_visible_area()
+        zoom = self.map.get_zoom()
 
-        if self.map.get_zoom() < self.CACHES_ZOOM_LOWER_BOUND:
-            self.map.set_osd_message('Zoom in to see geocaches.')
-            self.visualized_geocaches = []
-            self.result = surface
-            return
-        elif len(coords) >= self.MAX_NUM_RESULTS_SHOW:
-            self.map.set_osd_message('Too many geocaches to display.')
+        # Don't query the geocaches when they are not drawn anyway
+        coords = [] if zoom < self.CACHES_ZOOM_LOWER_BOUND else self.get_geocaches_callback(area, self.MAX_NUM_RESULTS_SHOW)
+
+        if zoom < self.CACHES_ZOOM_LOWER_BOUND or len(coords) >= self.MAX_NUM_RESULTS_SHOW:
             self.visualized_geocaches = []
             self.result = surface
+            clusters = self.get_clusters(area, zoom)
+            if clusters != None:
+                self.map.set_osd_message(None)
+                self._draw_clusters(cr, clusters)
+            elif zoom < self.CACHES_ZOOM_LOWER_BOUND:
+                self.map.set_osd_message('Zoom in to see geocaches.')
+            else:
+                self.map.set_osd_message('Too many geocaches to display.')
             return
         self.map.set_osd_message(None)
         self.visualized_geocaches = coords
@@ -689,6 +697,37 @@ class GeocacheLayer(AbstractGeocacheLayer):
             cr.stroke()
         self.result = surface
 
+    def _draw_clusters(self, cr, clusters):
+        """
+        Draw a circle for each cluster, its area growing with the number of geocaches.
+        
+        """
+        for lat, lon, count, found, type in clusters:
+            p = self.map.coord2point(geo.Coordinate(lat, lon))
+            if not self.map.point_in_screen(p):
+                continue
+            if found == count:
+                color = self.COLOR_FOUND
+            elif type == geocaching.GeocacheCoordinate.TYPE_REGULAR:
+                color = self.COLOR_REGULAR
+            elif type == geocaching.GeocacheCoordinate.TYPE_MULTI:
+                color = self.COLOR_MULTI
+            else:
+                color = self.COLOR_DEFAULT
+            radius = min(self.CACHE_DRAW_SIZE * math.sqrt(count) / 2.0 + 3, self.CLUSTER_MAX_RADIUS)
+
+            cr.arc(p[0], p[1], radius, 0, math.pi * 2)
+            cr.set_source_color(color)
+            cr.set_line_width(3)
+            cr.stroke()
+
+            layout = self.map.create_pango_layout(str(count))
+            layout.set_font_description(self.CACHE_DRAW_FONT)
+            width, height = layout.get_pixel_size()
+            cr.move_to(p[0] - width / 2, p[1] - height / 2)
+            cr.set_source_color(self.CACHE_DRAW_FONT_COLOR)
+            cr.show_layout(layout)
+
 logger = logging.getLogger('markslayer')
 
 class MarksLayer(AbstractMarksLayer):
@@ -27,6 +27,7 @@ import pango
 import threadpool
 import logging
 import geo
+import geobatch
 from utils import HTMLManipulations
 logger = logging.getLogger('plugins')
 
@@ -212,8 +213,8 @@ class HildonSearchGeocaches(object):
 
 
         name = hildon.Entry(gtk.HILDON_SIZE_AUTO_WIDTH | gtk.HILDON_SIZE_FINGER_HEIGHT)
-        name.set_placeholder("search for name...")
-        name_hbox = hildon.Caption(None, "Name", name, None, hildon.CAPTION_OPTIONAL)
+        name.set_placeholder("search for name, owner, description, logs...")
+        name_hbox = hildon.Caption(None, "Text", name, None, hildon.CAPTION_OPTIONAL)
 
         sel_dist_type = hildon.TouchSelector(text=True)
         sel_dist_type.append_text('anywhere')
@@ -349,7 +350,7 @@ class HildonSearchGeocaches(object):
                 
                 return
             
-            name_search = name.get_text().strip().lower()
+            text_search = name.get_text().strip()
 
             sizes = [x + 1 for x, in sel_size.get_selected_rows(0)]
             if sizes == [1, 2, 3, 4, 5]:
@@ -422,7 +423,8 @@ class HildonSearchGeocaches(object):
                 location = None
 
             if response == RESPONSE_SHOW_LIST:
-                points, truncated = self.core.get_points_filter(found=found, name_search=name_search, size=sizes, terrain=terrains, diff=difficulties, ctype=types, marked=marked, location=location)
+                position = self.gps_data.position if self.gps_data != None else None
+                points, truncated = self.core.get_points_filter(found=found, text_search=text_search, size=sizes, terrain=terrains, diff=difficulties, ctype=types, marked=marked, location=location, center=position)
                 if len(points) > 0:
                     self._display_results(points, truncated)
                     break
@@ -430,7 +432,7 @@ class HildonSearchGeocaches(object):
                     self.show_error("Search returned no geocaches. Please remember that search works only within the downloaded geocaches.")
 
             elif response == gtk.RESPONSE_ACCEPT:
-                self.core.set_filter(found=found, name_search=name_search, size=sizes, terrain=terrains, diff=difficulties, ctype=types, marked=marked)
+                self.core.set_filter(found=found, text_search=text_search, size=sizes, terrain=terrains, diff=difficulties, ctype=types, marked=marked)
                 self.show_success("Filter for map activated, ignoring distance restrictions.")
                 self.map_filter_active = True
                 break
@@ -438,18 +440,21 @@ class HildonSearchGeocaches(object):
                 break
 
     def _display_results(self, caches, truncated):
+        # If the position is known, the results are ordered by their distance
+        # to it already (see RESPONSE_SHOW_LIST above).
+        order = dict((c.name, i) for i, c in enumerate(caches))
         sortfuncs = [
-            ('Dist', lambda x, y: cmp(x.prox, y.prox)),
-            ('Name', lambda x, y: cmp(x.title, y.title)),
-            ('Diff', lambda x, y: cmp(x.difficulty if x.difficulty > 0 else 100, y.difficulty if y.difficulty > 0 else 100)),
-            ('Terr', lambda x, y: cmp(x.terrain if x.terrain > 0 else 100, y.terrain if y.terrain > 0 else 100)),
-            ('Size', lambda x, y: cmp(x.size if x.size > 0 else 100, y.size if y.size > 0 else 100)),
-            ('Type', lambda x, y: cmp(x.type, y.type)),
+            ('Dist', lambda x: order[x.name]),
+            ('Name', lambda x: x.title),
+            ('Diff', lambda x: x.difficulty if x.difficulty > 0 else 100),
+            ('Terr', lambda x: x.terrain if x.terrain > 0 else 100),
+            ('Size', lambda x: x.size if x.size > 0 else 100),
+            ('Type', lambda x: x.type),
         ]
 
         if self.gps_data != None and self.gps_data.position != None:
-            for c in caches:
-                c.prox = c.distance_to(self.gps_data.position)
+            for c, distance in zip(caches, geobatch.distances(self.gps_data.position, caches)):
+                c.prox = distance
         else:
             for c in caches:
                 c.prox = None
@@ -486,7 +491,7 @@ class HildonSearchGeocaches(object):
         def on_change_sort(widget, sortfunc):
             tv.handler_block_by_func(select_cache)
             ls.clear()
-            caches.sort(cmp=sortfunc)
+            caches.sort(key=sortfunc)
             for c in caches:
                 ls.append([self.shorten_name(c.title, 40), " " + c.get_size_string(), ' D%s T%s' % (c.get_difficulty(), c.get_terrain()), " " + geo.Coordinate.format_distance(c.prox), c])
             tv.handler_unblock_by_func(select_cache)
@@ -533,6 +538,7 @@ class HildonAboutDialog(object):
 
     def plugin_init(self):
         logger.info("Using About Dialog plugin")
+        self.core.connect('optimize-done', self._on_optimize_done)
         logger.debug("trying update")
         
         #import gobject
@@ -635,12 +641,13 @@ Author: Daniel Fett advancedcaching@fragcom.de'''
             self._try_parser_update()
             self._on_show_about(None, None)
         elif result == RESPONSE_OPTIMIZE:
-            hildon.hildon_gtk_window_set_progress_indicator(dialog, 1)
-            self.core.optimize_data()
-            hildon.hildon_gtk_window_set_progress_indicator(dialog, 0)
             dialog.hide()
-            self._on_show_about(None, None)
+            # runs in the background, see _on_optimize_done
+            self.core.optimize_data()
+
 
+    def _on_optimize_done(self, caller, stats):
+        self.show_success("Removed %(geocaches)d geocaches and reclaimed %(pages)d database pages in %(time).1f seconds." % stats)
 
     def _try_parser_update(self):
         updates = self.core.try_update()
@@ -20,103 +20,717 @@
 #   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
 #
 
-from math import sqrt
-from sqlite3 import connect, Row
+from __future__ import with_statement
+
+from math import sin, cos, tan, asin, radians, degrees, pi, log, floor
+from sqlite3 import connect, Row, OperationalError, sqlite_version, sqlite_version_info
 
 from copy import copy
+from time import time
+import threading
+import geo
 import logging
 logger = logging.getLogger(__name__)
 
 
+class Filter(object):
+    """
+    Immutable set of conditions on geocaches, as used by the query methods of PointProvider.
+    
+    The SQL of a filter only contains placeholders for the values, which are kept separately in args. Thus, filters which differ only in their values have the same key and share a compiled statement. Filters are combined using +.
+    
+    """
+    __slots__ = ('conditions', 'args', 'search', 'key')
+
+    def __init__(self, conditions=(), args=(), search=None):
+        """
+        conditions -- SQL expressions which must all be true
+        args -- Values for the placeholders in conditions
+        search -- Query for the full text index by which the results are ranked, or None
+        
+        """
+        object.__setattr__(self, 'conditions', tuple(conditions))
+        object.__setattr__(self, 'args', tuple(args))
+        object.__setattr__(self, 'search', search)
+        object.__setattr__(self, 'key', (self.conditions, search != None))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Filters can not be changed.")
+
+    def __add__(self, other):
+        return Filter(self.conditions + other.conditions, self.args + other.args, other.search if other.search != None else self.search)
+
+    def get_where(self):
+        """
+        Return the conditions as a WHERE clause.
+        
+        """
+        return " AND ".join(self.conditions) if len(self.conditions) > 0 else '1'
+
+
 class PointProvider():
     """
     Stores information about geocaches.
     
     This class stores geocache information in an SQLite database.
     
+    The database is used in WAL mode, so reading and writing don't block each other. All writes go through a single connection (self.conn) which may be used from any thread. Each thread reads through a connection of its own (see _get_reader), so it only sees committed changes.
+    
     """
     MAX_RESULTS = 1000
+    NEAREST_START_RADIUS = 500 # meters
+    STATEMENT_CACHE_SIZE = 100
+    RESULT_CACHE_SIZE = 5000 # summaries
+    CACHE_TILES = 16 # maximum number of map tiles for which results are cached per query, see _get_tiles
+    QUADKEY_ZOOM = 16 # zoom level of the stored quadkeys, tiles of about 600 meters
+    ITER_CHUNK_SIZE = 100 # rows
+    MAINTENANCE_SLICE = 0.05 # seconds, see maintain
+    COMPRESS_DETAILS = True # see self.ctype.COMPRESSED_ATTRS
+    CLUSTER_MAX_ZOOM = 12 # highest zoom level with clusters, see get_clusters
+    CLUSTER_CELL_BITS = 2 # cells of a quarter tile, i.e. 64x64 pixels
+    # The upserts need SQLite 3.24, the full text index and the spatial index
+    # need the FTS5 and R*Tree modules, see _check_sqlite
+    MIN_SQLITE_VERSION = (3, 24, 0)
 
-    def __init__(self, filename, ctype):
+    FILTER_FOUND = {
+        None: Filter(),
+        True: Filter(('(found = 1)',)),
+        False: Filter(('(found = 0)',)),
+        }
+
+    def __init__(self, filename, ctype, stype=None):
         """
         Initialize this data provider. 
         
         filename -- Filename to save the data to, depends on the OS
         ctype -- Python type which represents a geocache
+        stype -- Python type which represents the summary of a geocache, used for the summary mode of the query methods. If None, full geocaches are returned instead.
         
         """
+        self._check_sqlite()
         self.filterstack = []
-        self.conn = connect(filename)
-        self.conn.row_factory = Row
-        self.conn.text_factory = unicode
+        self.filename = filename
         self.ctype = ctype
+        self.readers = threading.local()
+        self.write_lock = threading.RLock()
+        self.cache_lock = threading.Lock()
+        self.conn = self._connect(check_same_thread=False)
+        self.stype = stype
         self.cache_table = 'geocaches'
-        self.filterstring = []
-        self.filterargs = []
+        self.details_table = 'geocache_details'
+        self.spatial_table = 'geocaches_rtree'
+        self.search_table = 'geocaches_fts'
+        self.cluster_table = 'geocaches_clusters'
+        self.changes_table = 'geocaches_changes'
+        self.filter = Filter()
+        # The keys of the caches are kept in lists as well, least recently used first
+        self.statements = {}
+        self.statement_keys = []
+        # Results of viewport queries, see _select_location. Every write
+        # increases the generation, which is part of the key.
+        self.results = {}
+        self.result_keys = []
+        self.results_size = 0
+        self.generation = 0
+
+        # The large fields (see self.ctype.DETAIL_ATTRS) live in a table of their own,
+        # so that queries on the geocache table don't have to read them.
+        self.fields = dict((k, v) for k, v in self.ctype.SQLROW.items() if k not in self.ctype.DETAIL_ATTRS)
+        self.detail_fields = dict((k, "%s DEFAULT ''" % self.ctype.SQLROW[k]) for k in self.ctype.DETAIL_ATTRS)
+        # Compressed values are stored as BLOBs in these columns, old rows keep their text
+        self.compressed_fields = self.ctype.COMPRESSED_ATTRS if self.COMPRESS_DETAILS else ()
+        # Columns which are derived from the coordinates, see check_table
+        self.derived_fields = (('quadkey', 'TEXT'),)
+        # A new database gets the current schema right away, so check_table only
+        # reports on the changes to databases of earlier versions.
+        self.upgrading = self._has_table(self.cache_table)
 
         # yes, the synchronous=off setting is a bit dangerous for the database,
         # but the advantages outbalance unlikely database corruption
+        # auto_vacuum only has an effect on new databases, see maintain
         self.conn.executescript(
-            'PRAGMA temp_store = MEMORY;' \
+            'PRAGMA auto_vacuum = INCREMENTAL;' \
+            'PRAGMA journal_mode = WAL;' \
             'PRAGMA synchronous=OFF;' \
-            'PRAGMA cache_size = -2048;' \
             'PRAGMA count_changes = OFF;' \
-            'CREATE TABLE IF NOT EXISTS %s (%s);' % (self.cache_table, ', '.join('%s %s' % m for m in self.ctype.SQLROW.items())))
+            'CREATE TABLE IF NOT EXISTS %s (%s);' % (self.cache_table, ', '.join('`%s` %s' % m for m in self.fields.items() + list(self.derived_fields))) + \
+            'CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY, %s);' % (self.details_table, ', '.join('`%s` %s' % m for m in self.detail_fields.items())))
         self.check_table()
         self.conn.executescript(
-            'CREATE INDEX IF NOT EXISTS %(table)s_latlon ON %(table)s (lat ASC, lon ASC);' \
+            'DROP INDEX IF EXISTS %(table)s_latlon;' \
             'DROP INDEX IF EXISTS %(table)s_name;'
             'CREATE UNIQUE INDEX IF NOT EXISTS %(table)s_name_unique ON %(table)s (name ASC);' \
             'CREATE INDEX IF NOT EXISTS %(table)s_fieldnote ON %(table)s (logas);' % {'table' : self.cache_table}
             )
 
-        self.to_replace_string = ', '.join("%s=:%s" % (x, x) for x in self.ctype.NON_USER_ATTRS)
+        columns = self.fields.keys()
+        non_user_columns = [x for x in self.ctype.NON_USER_ATTRS if x in self.fields]
+        self.insert_query = "INSERT INTO %s (`%s`) VALUES (%s)" % (self.cache_table, '`, `'.join(columns), ', '.join(':%s' % k for k in columns))
+        # Not INSERT OR REPLACE, which would delete the details and change the rowid
+        self.replace_query = "%s ON CONFLICT(name) DO UPDATE SET %s" % (self.insert_query, ', '.join("`%s`=excluded.`%s`" % (x, x) for x in columns if x != 'name'))
+        self.update_query = "UPDATE %s SET %s WHERE name=:name" % (self.cache_table, ', '.join("`%s`=:%s" % (x, x) for x in non_user_columns))
+        self.upsert_query = "%s ON CONFLICT(name) DO UPDATE SET %s" % (self.insert_query, ', '.join("`%s`=excluded.`%s`" % (x, x) for x in non_user_columns))
+        # All details are NON_USER_ATTRS, so they are always replaced
+        self.details_replace_query = "INSERT OR REPLACE INTO %s (name, `%s`) VALUES (:name, %s)" % (self.details_table, '`, `'.join(self.ctype.DETAIL_ATTRS), ', '.join(':%s' % k for k in self.ctype.DETAIL_ATTRS))
+        self.details_query = "SELECT * FROM %s WHERE name = ?" % self.details_table
+        if self.stype != None:
+            tables = {'table': self.cache_table, 'details': self.details_table}
+            self.summary_columns = ', '.join("%s AS `%s`" % (self.stype.SQLEXPRESSIONS[x] % tables if x in self.stype.SQLEXPRESSIONS else '`%s`' % x, x) for x in self.stype.__slots__)
+        else:
+            self.summary_columns = '%s.*' % self.cache_table
+        self.location_condition = '(%(table)s.rowid IN (SELECT id FROM %(rtree)s WHERE maxlat >= ? AND minlat <= ? AND maxlon >= ? AND minlon <= ?)) AND (%(table)s.lat BETWEEN ? AND ?) AND (%(table)s.lon BETWEEN ? AND ?)' % {'table': self.cache_table, 'rtree': self.spatial_table}
+
+    @classmethod
+    def _check_sqlite(cls):
+        """
+        Raise an exception if the SQLite library lacks a feature which the database schema needs.
+        
+        """
+        if sqlite_version_info < cls.MIN_SQLITE_VERSION:
+            raise Exception("SQLite %s is too old, at least version %s is needed." % (sqlite_version, '.'.join(str(x) for x in cls.MIN_SQLITE_VERSION)))
+        conn = connect(':memory:')
+        try:
+            for module, columns in (('fts5', 'a'), ('rtree', 'id, a, b')):
+                try:
+                    conn.execute('CREATE VIRTUAL TABLE test_%s USING %s(%s)' % (module, module, columns))
+                except OperationalError:
+                    raise Exception("SQLite %s was built without the %s module, which is needed." % (sqlite_version, module.upper()))
+        finally:
+            conn.close()
+
+    def _connect(self, **kwargs):
+        """
+        Open a new connection to the database.
+        
+        """
+        # SQLite keeps the prepared statements for the queries built by
+        # _get_statement, plus those for the fixed queries.
+        conn = connect(self.filename, cached_statements=2 * self.STATEMENT_CACHE_SIZE, **kwargs)
+        conn.row_factory = Row
+        conn.text_factory = unicode
+        # used by the triggers which keep the full text index up to date
+        conn.create_function('search_text', 1, self.ctype.get_search_text)
+        conn.create_function('search_logs', 1, self.ctype.get_search_logs)
+        # used by the triggers which keep the clusters up to date
+        conn.create_function('cluster_x', 2, self._cluster_x)
+        conn.create_function('cluster_y', 2, self._cluster_y)
+        # used by the triggers which keep the derived columns up to date
+        conn.create_function('quadkey', 3, self._quadkey)
+        conn.executescript(
+            'PRAGMA temp_store = MEMORY;' \
+            'PRAGMA cache_size = -2048;' \
+            'PRAGMA recursive_triggers = ON;')
+        return conn
+
+    def _get_reader(self):
+        """
+        Return the connection which is used for reading in the current thread.
+        
+        """
+        try:
+            return self.readers.conn
+        except AttributeError:
+            self.readers.conn = self._connect()
+            return self.readers.conn
 
     def check_table(self):
         """
         Check the table schema and update it if necessary.
         
-        Takes the information about the necessary table schema which is stored in self.ctype.SQLROW and checks whether the SQLite table actually matches this schema. If not, update the table.
+        Takes the information about the necessary table schema which is stored in self.ctype.SQLROW and checks whether the SQLite tables actually match this schema. If not, update the tables.
         This makes updating the table schema painless.
         
         """
         c = self.conn.cursor()
-        fields = copy(self.ctype.SQLROW)
         c.execute('PRAGMA TABLE_INFO(%s)' % self.cache_table)
-        for row in c:
-            if row[1] in fields:
-                del fields[row[1]]
-
-        # add all remaining fields
-        for name, type in fields.items():
-            cmd = 'ALTER TABLE %s ADD COLUMN %s %s' % (self.cache_table, name, type)
-            print "Updating your Database, adding Column %s to Table %s:\n%s" % (name, self.cache_table, cmd)
-            c.execute(cmd)
+        columns = c.fetchall()
+        if len([row for row in columns if row[1] in self.detail_fields]) > 0:
+            self._move_details(columns)
+
+        for table, fields in ((self.cache_table, self.fields), (self.details_table, self.detail_fields)):
+            fields = copy(fields)
+            c.execute('PRAGMA TABLE_INFO(%s)' % table)
+            for row in c.fetchall():
+                if row[1] in fields:
+                    del fields[row[1]]
+
+            # add all remaining fields
+            for name, type in fields.items():
+                cmd = 'ALTER TABLE %s ADD COLUMN `%s` %s' % (table, name, type)
+                self._report_update("adding Column %s to Table %s:\n%s" % (name, table, cmd))
+                c.execute(cmd)
+        self.save()
+
+        c.execute('CREATE TRIGGER IF NOT EXISTS %(table)s_details_delete AFTER DELETE ON %(table)s BEGIN ' \
+                'DELETE FROM %(details)s WHERE name = old.name; ' \
+            'END;' % {'table': self.cache_table, 'details': self.details_table})
+
+        # The spatial index is an R*Tree which maps the rowid of each geocache
+        # to its (degenerate) bounding box. It is kept in sync by triggers.
+        if not self._has_table(self.spatial_table):
+            self._report_update("creating spatial index %s" % self.spatial_table)
+            c.execute('CREATE VIRTUAL TABLE %s USING rtree(id, minlat, maxlat, minlon, maxlon)' % self.spatial_table)
+            self._rebuild_spatial_index()
+        c.executescript(
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_rtree_insert AFTER INSERT ON %(table)s ' \
+                'WHEN new.lat IS NOT NULL AND new.lon IS NOT NULL BEGIN ' \
+                'INSERT OR REPLACE INTO %(rtree)s VALUES (new.rowid, new.lat, new.lat, new.lon, new.lon); ' \
+            'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_rtree_update AFTER UPDATE OF lat, lon ON %(table)s BEGIN ' \
+                'DELETE FROM %(rtree)s WHERE id = old.rowid; ' \
+                'INSERT INTO %(rtree)s SELECT new.rowid, new.lat, new.lat, new.lon, new.lon WHERE new.lat IS NOT NULL AND new.lon IS NOT NULL; ' \
+            'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_rtree_delete AFTER DELETE ON %(table)s BEGIN ' \
+                'DELETE FROM %(rtree)s WHERE id = old.rowid; ' \
+            'END;' % {'table': self.cache_table, 'rtree': self.spatial_table})
+
+        # Some columns are derived from the coordinates, kept up to date by
+        # triggers as well:
+        # The quadkey of the map tile at QUADKEY_ZOOM which contains the
+        # geocache. All geocaches in a tile at a lower zoom level share the
+        # quadkey of that tile as prefix, see _select_location.
+        # Earlier versions also stored unit vectors (ux, uy, uz) for ordering
+        # by distance. Their columns stay in old databases, but are no
+        # longer filled.
+        update = 'quadkey = quadkey(%(row)s.lat, %(row)s.lon, %(zoom)d)'
+        c.execute('PRAGMA TABLE_INFO(%s)' % self.cache_table)
+        existing = [row[1] for row in c.fetchall()]
+        missing = [(name, type) for name, type in self.derived_fields if name not in existing]
+        if len(missing) > 0:
+            self._report_update("adding Columns %s to Table %s" % (', '.join(name for name, type in missing), self.cache_table))
+            for name, type in missing:
+                c.execute('ALTER TABLE %s ADD COLUMN %s %s' % (self.cache_table, name, type))
+            c.execute('UPDATE %s SET %s' % (self.cache_table, update % {'row': self.cache_table, 'zoom': self.QUADKEY_ZOOM}))
+        c.executescript(
+            'DROP TRIGGER IF EXISTS %(table)s_unit_insert;' \
+            'DROP TRIGGER IF EXISTS %(table)s_unit_update;' \
+            'DROP TRIGGER IF EXISTS %(table)s_derived_insert;' \
+            'DROP TRIGGER IF EXISTS %(table)s_derived_update;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_quadkey_insert AFTER INSERT ON %(table)s BEGIN ' \
+                'UPDATE %(table)s SET %(update)s WHERE rowid = new.rowid; ' \
+            'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_quadkey_update AFTER UPDATE OF lat, lon ON %(table)s ' \
+                'WHEN old.lat IS NOT new.lat OR old.lon IS NOT new.lon BEGIN ' \
+                'UPDATE %(table)s SET %(update)s WHERE rowid = new.rowid; ' \
+            'END;' \
+            'CREATE INDEX IF NOT EXISTS %(table)s_quadkey ON %(table)s (quadkey);' % {'table': self.cache_table, 'update': update % {'row': 'new', 'zoom': self.QUADKEY_ZOOM}})
+
+        # The full text index uses the rowids of the geocache table as well.
+        # Its text columns are filled from both the geocache table and the details table.
+        if not self._has_table(self.search_table):
+            self._report_update("creating full text index %s" % self.search_table)
+            c.execute("CREATE VIRTUAL TABLE %s USING fts5(name, title, owner, attributes, description, hints, logs, tokenize = 'unicode61 remove_diacritics 1')" % self.search_table)
+            self._rebuild_search_index()
+        c.executescript(
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_fts_insert AFTER INSERT ON %(table)s BEGIN ' \
+                'INSERT INTO %(fts)s (rowid, name, title, owner, attributes, description, hints, logs) ' \
+                'SELECT new.rowid, new.name, new.title, new.owner, new.attributes, %(description)s, d.hints, search_logs(d.logs) ' \
+                'FROM (SELECT new.name AS name) AS g LEFT JOIN %(details)s AS d ON d.name = g.name; ' \
+            'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_fts_update AFTER UPDATE OF name, title, owner, attributes ON %(table)s ' \
+                'WHEN old.name IS NOT new.name OR old.title IS NOT new.title OR old.owner IS NOT new.owner OR old.attributes IS NOT new.attributes BEGIN ' \
+                'UPDATE %(fts)s SET name = new.name, title = new.title, owner = new.owner, attributes = new.attributes WHERE rowid = new.rowid; ' \
+            'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_fts_delete AFTER DELETE ON %(table)s BEGIN ' \
+                'DELETE FROM %(fts)s WHERE rowid = old.rowid; ' \
+            'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(details)s_fts_insert AFTER INSERT ON %(details)s BEGIN ' \
+                'UPDATE %(fts)s SET %(update)s WHERE rowid = (SELECT rowid FROM %(table)s WHERE name = new.name); ' \
+            'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(details)s_fts_update AFTER UPDATE ON %(details)s BEGIN ' \
+                'UPDATE %(fts)s SET %(update)s WHERE rowid = (SELECT rowid FROM %(table)s WHERE name = new.name); ' \
+            'END;' % {
+                'table': self.cache_table,
+                'details': self.details_table,
+                'fts': self.search_table,
+                'description': self._search_description('d'),
+                'update': 'description = %s, hints = new.hints, logs = search_logs(new.logs)' % self._search_description('new'),
+                })
+
+        # The clusters count the geocaches of each type, found or not, in each
+        # cell of the map at each zoom level. lat and lon are the sums of the
+        # coordinates, so that the center of the geocaches can be calculated.
+        # They are kept up to date by triggers as well.
+        if not self._has_table(self.cluster_table):
+            self._report_update("creating clusters %s" % self.cluster_table)
+            c.execute('CREATE TABLE %s (zoom INTEGER, x INTEGER, y INTEGER, type TEXT, found INTEGER, count INTEGER, lat REAL, lon REAL, ' \
+                'PRIMARY KEY (zoom, x, y, type, found)) WITHOUT ROWID' % self.cluster_table)
+            self._rebuild_clusters()
+        # The cells at lower zoom levels are derived from the cell at the highest one
+        cells = "SELECT column1, cx >> (%(max)d - column1), cy >> (%(max)d - column1), coalesce(%(row)s.type, ''), coalesce(%(row)s.found, 0) " \
+            "FROM (%(zooms)s), (SELECT cluster_x(%(row)s.lon, %(max)d) AS cx, cluster_y(%(row)s.lat, %(max)d) AS cy) " \
+            "WHERE %(row)s.lat IS NOT NULL AND %(row)s.lon IS NOT NULL"
+        add = 'INSERT INTO %(clusters)s (zoom, x, y, type, found, count, lat, lon) ' \
+                'SELECT *, 1, new.lat, new.lon FROM (%(new_cells)s) WHERE 1 ' \
+                'ON CONFLICT (zoom, x, y, type, found) DO UPDATE SET count = count + 1, lat = lat + excluded.lat, lon = lon + excluded.lon; '
+        remove = 'UPDATE %(clusters)s SET count = count - 1, lat = lat - old.lat, lon = lon - old.lon WHERE (zoom, x, y, type, found) IN (%(old_cells)s); ' \
+                'DELETE FROM %(clusters)s WHERE (zoom, x, y, type, found) IN (%(old_cells)s) AND count <= 0; '
+        names = {
+            'table': self.cache_table,
+            'clusters': self.cluster_table,
+            'new_cells': cells % {'row': 'new', 'zooms': self._cluster_zooms(), 'max': self.CLUSTER_MAX_ZOOM},
+            'old_cells': cells % {'row': 'old', 'zooms': self._cluster_zooms(), 'max': self.CLUSTER_MAX_ZOOM},
+            }
+        c.executescript((
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_clusters_insert AFTER INSERT ON %(table)s BEGIN ' + add + 'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_clusters_update AFTER UPDATE OF lat, lon, type, found ON %(table)s ' \
+                'WHEN old.lat IS NOT new.lat OR old.lon IS NOT new.lon OR old.type IS NOT new.type OR old.found IS NOT new.found BEGIN ' + remove + add + 'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_clusters_delete AFTER DELETE ON %(table)s BEGIN ' + remove + 'END;') % names)
+
+        # The journal holds the last change of each geocache. Its row is deleted
+        # and inserted again, which assigns a new, higher sequence number (see
+        # get_changes_since). INSERT OR REPLACE would be overridden by the
+        # conflict handling of the upserts which fire the triggers.
+        record = 'DELETE FROM %(changes)s WHERE name = %(name)s; ' \
+            'INSERT INTO %(changes)s (name, removed) SELECT %(name)s, %(removed)d %(where)s; '
+        names = {'table': self.cache_table, 'changes': self.changes_table}
+        changed = lambda row, where='': record % dict(names, name=row + '.name', removed=0, where=where)
+        removed = lambda row, where='': record % dict(names, name=row + '.name', removed=1, where=where)
+        in_table = 'WHERE EXISTS (SELECT 1 FROM %s WHERE name = new.name)' % self.cache_table
+        c.executescript((
+            'CREATE TABLE IF NOT EXISTS %(changes)s (seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, removed INTEGER);' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_changes_insert AFTER INSERT ON %(table)s BEGIN ' + changed('new') + 'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_changes_update AFTER UPDATE OF %(columns)s ON %(table)s BEGIN ' \
+                + removed('old', 'WHERE old.name IS NOT new.name') + changed('new') + 'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(table)s_changes_delete AFTER DELETE ON %(table)s BEGIN ' + removed('old') + 'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(details)s_changes_insert AFTER INSERT ON %(details)s BEGIN ' + changed('new', in_table) + 'END;' \
+            'CREATE TRIGGER IF NOT EXISTS %(details)s_changes_update AFTER UPDATE ON %(details)s BEGIN ' + changed('new', in_table) + 'END;'
+            ) % dict(names, details=self.details_table, columns=', '.join('`%s`' % x for x in self.fields)))
+        c.close()
+
+    def _report_update(self, message):
+        """
+        Tell the user about a change to the schema of an existing database, which may take a while.
+        
+        """
+        if self.upgrading:
+            print "Updating your Database, %s" % message
+
+    def _has_table(self, name):
+        """
+        Return True if a table with the given name exists.
+        
+        """
+        c = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+        return c.fetchone() != None
+
+    @staticmethod
+    def _search_description(row):
+        """
+        Return the SQL expression for the description column of the full text index, row being the details row.
+        
+        """
+        return "search_text(%(row)s.shortdesc) || ' ' || search_text(%(row)s.desc)" % {'row': row}
+
+    def _move_details(self, columns):
+        """
+        Move the details from the geocache table (where they were stored in earlier versions) to the details table.
+        
+        columns -- Result of PRAGMA TABLE_INFO for the geocache table
+        
+        """
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+        size = self.conn.execute('PRAGMA page_count').fetchone()[0] * page_size
+        moved = [row[1] for row in columns if row[1] in self.detail_fields]
+        keep = [row for row in columns if row[1] not in self.detail_fields]
+        print "Updating your Database, moving Columns %s from Table %s to Table %s" % (', '.join(moved), self.cache_table, self.details_table)
+        # SQLite can't drop columns, so the table is copied. The rowids are
+        # kept, but VACUUM may change them, so the spatial index is rebuilt.
+        self.conn.executescript(
+            'BEGIN;' \
+            'INSERT OR REPLACE INTO %(details)s (name, `%(moved)s`) SELECT name, `%(moved)s` FROM %(table)s;' \
+            'CREATE TABLE %(table)s_new (%(schema)s);' \
+            'INSERT INTO %(table)s_new (rowid, `%(keep)s`) SELECT rowid, `%(keep)s` FROM %(table)s;' \
+            'DROP TABLE %(table)s;' \
+            'ALTER TABLE %(table)s_new RENAME TO %(table)s;' \
+            'DROP TABLE IF EXISTS %(rtree)s;' \
+            'COMMIT;' \
+            'VACUUM;' % {
+                'table': self.cache_table,
+                'details': self.details_table,
+                'rtree': self.spatial_table,
+                'moved': '`, `'.join(moved),
+                'keep': '`, `'.join(row[1] for row in keep),
+                'schema': ', '.join('`%s` %s%s' % (row[1], row[2], ' PRIMARY KEY' if row[5] else '') for row in keep),
+                })
+        new_size = self.conn.execute('PRAGMA page_count').fetchone()[0] * page_size
+        print "Database size changed from %d kB to %d kB" % (size / 1024, new_size / 1024)
+
+    def _rebuild_spatial_index(self):
+        """
+        Fill the spatial index from scratch.
+        
+        Must be called whenever the rowids of the geocache table may have changed, e.g. after a VACUUM.
+        
+        """
+        self.conn.execute('DELETE FROM %s' % self.spatial_table)
+        self.conn.execute('INSERT INTO %s SELECT rowid, lat, lat, lon, lon FROM %s WHERE lat IS NOT NULL AND lon IS NOT NULL' % (self.spatial_table, self.cache_table))
         self.save()
+
+    def _rebuild_search_index(self):
+        """
+        Fill the full text index from scratch.
         
-    def get_table_info(self):
+        Must be called whenever the rowids of the geocache table may have changed, e.g. after a VACUUM.
+        
+        """
+        self.conn.execute('DELETE FROM %s' % self.search_table)
+        self.conn.execute('INSERT INTO %(fts)s (rowid, name, title, owner, attributes, description, hints, logs) ' \
+            'SELECT g.rowid, g.name, g.title, g.owner, g.attributes, %(description)s, d.hints, search_logs(d.logs) ' \
+            'FROM %(table)s AS g LEFT JOIN %(details)s AS d ON d.name = g.name' % {
+                'table': self.cache_table,
+                'details': self.details_table,
+                'fts': self.search_table,
+                'description': self._search_description('d'),
+                })
+        self.save()
+
+    def _cluster_zooms(self):
         """
-        Get information about the fields in the geocache table.
+        Return a subquery with the zoom levels which have clusters, in its column1.
+        
+        """
+        return 'VALUES %s' % ', '.join('(%d)' % z for z in xrange(self.CLUSTER_MAX_ZOOM + 1))
+
+    def _cluster_x(self, lon, zoom):
+        """
+        Return the x coordinate of the cell which contains lon at the given zoom level, see get_clusters.
+        
+        """
+        return int((lon + 180.0) / 360.0 * (1 << (zoom + self.CLUSTER_CELL_BITS)))
+
+    def _cluster_y(self, lat, zoom):
+        """
+        Return the y coordinate of the cell which contains lat at the given zoom level (in the Mercator projection of the map tiles), see get_clusters.
+        
+        """
+        lat_rad = radians(max(-85.0, min(85.0, lat)))
+        return int((1.0 - log(tan(lat_rad) + 1.0 / cos(lat_rad)) / pi) / 2.0 * (1 << (zoom + self.CLUSTER_CELL_BITS)))
+
+    @staticmethod
+    def _quadkey(lat, lon, zoom):
+        """
+        Return the quadkey of lat, lon at the given zoom level (see geo.quadkey_encode), or None if one of them is NULL.
+        
+        """
+        if lat == None or lon == None:
+            return None
+        return geo.quadkey_encode(lat, lon, zoom)
+
+    def _rebuild_clusters(self):
+        """
+        Calculate the clusters from scratch.
+        
+        """
+        self.conn.execute('DELETE FROM %s' % self.cluster_table)
+        self.conn.execute("INSERT INTO %(clusters)s (zoom, x, y, type, found, count, lat, lon) " \
+            "SELECT column1, cluster_x(lon, column1), cluster_y(lat, column1), coalesce(type, ''), coalesce(found, 0), count(*), sum(lat), sum(lon) " \
+            "FROM %(table)s, (%(zooms)s) WHERE lat IS NOT NULL AND lon IS NOT NULL GROUP BY 1, 2, 3, 4, 5" % {
+                'table': self.cache_table,
+                'clusters': self.cluster_table,
+                'zooms': self._cluster_zooms(),
+                })
+        self.save()
+
+    @staticmethod
+    def _to_unicode(text):
+        """
+        Return text as unicode. The GUIs pass the UTF-8 encoded text of their entry fields, and SQLite does not accept non-ASCII byte strings as parameters.
+        
+        """
+        if isinstance(text, str):
+            return text.decode('utf-8')
+        return text
+
+    @classmethod
+    def _get_search_query(cls, text):
+        """
+        Turn the text entered by the user into an FTS5 query which matches all words, each of them as a prefix.
+        
+        """
+        text = cls._to_unicode(text)
+        return u' '.join('"%s"*' % word.replace('"', '""') for word in text.split())
+
+    def _location_filter(self, c1, c2):
+        """
+        Return a filter which restricts a query to the rectangle given by the corners c1 and c2.
+        
+        The lookup is done in the spatial index, so this is fast regardless of the size of the rectangle and the table. The R*Tree stores its coordinates with single precision only, so the candidates are checked against the exact coordinates afterwards.
+        
+        """
+        return self._box_filter(self._get_box(c1, c2))
+
+    def _box_filter(self, box):
+        """
+        Return a filter which restricts a query to box, see _location_filter and _get_box.
+        
+        """
+        return Filter((self.location_condition,), box + box)
+
+    @staticmethod
+    def _get_box(c1, c2):
+        """
+        Return the rectangle given by the corners c1 and c2 as (minlat, maxlat, minlon, maxlon).
+        
+        """
+        return (min(c1.lat, c2.lat), max(c1.lat, c2.lat), min(c1.lon, c2.lon), max(c1.lon, c2.lon))
+
+    def _quadkey_filter(self, quadkey):
+        """
+        Return a filter which restricts a query to the map tile with the given quadkey.
+        
+        """
+        return Filter(('(%s.quadkey >= ? AND %s.quadkey < ?)' % (self.cache_table, self.cache_table),), (quadkey, quadkey + '4'))
+
+    def _get_tiles(self, box):
+        """
+        Return the quadkeys of the map tiles which cover box, at a zoom level where the tiles are about half as wide as box.
+        
+        Thus, the tiles don't change if the map is moved by a few pixels, and most of them are still needed after moving it further.
+        
+        """
+        minlat, maxlat, minlon, maxlon = box
+        zoom = min(self.QUADKEY_ZOOM, max(0, int(floor(log(360.0 / max(maxlon - minlon, 1e-9), 2))) + 1))
+        c1, c2 = geo.Coordinate(minlat, minlon), geo.Coordinate(maxlat, maxlon)
+        tiles = geo.quadkeys_covering(c1, c2, zoom)
+        while len(tiles) > self.CACHE_TILES and zoom > 0:
+            zoom -= 1
+            tiles = geo.quadkeys_covering(c1, c2, zoom)
+        return tiles
+
+    def _select_location(self, filter, c1, c2, summary=False, max_results=None):
+        """
+        Return the geocaches (or summaries) in the rectangle given by c1 and c2 which match the filter.
+        
+        Summaries are cached by map tiles (see _get_tiles), so that redrawing the map without moving it does not query the database, and moving it only queries the tiles which became visible. Geocaches are not cached, because they may be changed by the caller.
+        The results of a text search are ordered by their rank, which joining the tiles would lose. So they are cached for the whole rectangle instead.
+        
+        """
+        box = self._get_box(c1, c2)
+        if not summary or self.RESULT_CACHE_SIZE == 0:
+            return self._select(filter + self._box_filter(box), summary, max_results)
+        if filter.search != None:
+            return list(self._select_cached(filter, box, max_results))
+
+        result = []
+        for quadkey in self._get_tiles(box):
+            tile = self._select_cached(filter, quadkey, max_results)
+            if max_results != None and len(tile) >= max_results:
+                # The limit was reached, so the results for the tile don't necessarily contain all results in box
+                return list(self._select_cached(filter, box, max_results))
+            result += [p for p in tile if box[0] <= p.lat <= box[1] and box[2] <= p.lon <= box[3]]
+        return result[:max_results] if max_results != None else result
+
+    def _select_cached(self, filter, area, max_results):
+        """
+        Return the summaries in area (a quadkey or a box) which match the filter, from the result cache if possible.
+        
+        The returned list must not be changed.
+        
+        """
+        generation = self.generation
+        key = (filter.key, filter.args, filter.search, area, max_results, generation)
+        with self.cache_lock:
+            result = self.results.get(key)
+            if result != None:
+                # move to the end, which holds the most recently used results
+                self.result_keys.remove(key)
+                self.result_keys.append(key)
+                return result
+        # the lock is not held during the query, so a writer may commit meanwhile
+        result = self._select(filter + (self._quadkey_filter(area) if isinstance(area, basestring) else self._box_filter(area)), True, max_results)
+        with self.cache_lock:
+            if generation != self.generation or len(result) > self.RESULT_CACHE_SIZE:
+                # outdated or too large to be cached
+                return result
+            self.results_size += len(result)
+            while self.results_size > self.RESULT_CACHE_SIZE:
+                self.results_size -= len(self.results.pop(self.result_keys.pop(0)))
+            self.results[key] = result
+            self.result_keys.append(key)
+        return result
+
+    def _changed(self):
+        """
+        Must be called after each commit to the database, invalidates the result cache.
+        
+        """
+        with self.cache_lock:
+            self.generation += 1
+            self.results.clear()
+            del self.result_keys[:]
+            self.results_size = 0
+
+    def _get_statement(self, filter, summary=False, max_results=None):
+        """
+        Return the SELECT statement for the given filter.
+        
+        The statements are cached by the key of the filter, so building the SQL is only necessary for new combinations of conditions. Use _select to execute the statement.
+        
+        """
+        key = (filter.key, summary, max_results)
+        with self.cache_lock:
+            query = self.statements.get(key)
+            if query != None:
+                # move to the end, which holds the most recently used statements
+                self.statement_keys.remove(key)
+            else:
+                if filter.search != None:
+                    # the ranking is only available from the full text index itself
+                    join = ' JOIN (SELECT rowid AS search_id, rank AS search_rank FROM %s WHERE %s MATCH ?) ON %s.rowid = search_id' % (self.search_table, self.search_table, self.cache_table)
+                    order = ' ORDER BY search_rank'
+                else:
+                    join = ''
+                    order = ''
+                query = 'SELECT %s FROM %s%s WHERE %s%s' % (self.summary_columns if summary else '%s.*' % self.cache_table, self.cache_table, join, filter.get_where(), order)
+                if max_results != None:
+                    query = '%s LIMIT %d' % (query, max_results)
+                if len(self.statements) >= self.STATEMENT_CACHE_SIZE:
+                    del self.statements[self.statement_keys.pop(0)]
+                self.statements[key] = query
+            self.statement_keys.append(key)
+        return query
+
+    def _select(self, filter, summary=False, max_results=None):
+        """
+        Return a list of geocaches (or summaries) which match the filter.
+        
+        """
+        if filter.search != None:
+            args = (filter.search,) + filter.args
+        else:
+            args = filter.args
+        c = self._get_reader().execute(self._get_statement(filter, summary, max_results), args)
+        return self._pack_result(c, summary)
+        
+    def get_table_info(self, details=False):
+        """
+        Get information about the fields in the geocache table (or the details table, if details is True).
         
         This is currently only used in the command line interface to provide the user with information to build his/her own SQL queries.
         
         """
-        c = self.conn.cursor()
-        c.execute('PRAGMA TABLE_INFO(%s)' % self.cache_table)
+        c = self._get_reader().cursor()
+        c.execute('PRAGMA TABLE_INFO(%s)' % (self.details_table if details else self.cache_table))
         return c.fetchall()
                 
     def save(self):
         """
         Commit changes to the table.
         
-        Is not performed automatically to speed the interface up.
+        Is not performed automatically to speed the interface up. Other threads (and the reading methods) only see the changes afterwards.
         
         """
-        self.conn.commit()
+        with self.write_lock:
+            self.conn.commit()
+        self._changed()
                 
     def __del__(self):
-        self.conn.commit()
-        self.conn.close()
+        with self.write_lock:
+            self.conn.commit()
+            # updates the statistics of the query planner if necessary
+            self.conn.execute('PRAGMA optimize')
+            self.conn.close()
                 
     def add_point(self, p, replace=False):
         """
@@ -126,36 +740,127 @@ class PointProvider():
         replace -- If False, update the existing geocache, but only the fields listed in self.ctype.NON_USER_ATTRS. This is useful when existing user data, such as notes, should not be overwritten. If True, replace existing geocaches, deleting user data (unless user data was manually retained).
         
         """
-        if replace:
-            self.conn.execute("INSERT OR REPLACE INTO %s (`%s`) VALUES (%s)" % (self.cache_table, '`, `'.join(self.ctype.SQLROW.keys()), ', '.join(':%s' % k for k in self.ctype.SQLROW.keys())), p.serialize())
-            return None
-        else:
+        with self.write_lock:
+            data = self._compress_details(p.serialize())
+            # The details are written first, so that the full text index is
+            # filled in one go when a new geocache is inserted.
+            self.conn.execute(self.details_replace_query, data)
+            if replace:
+                self.conn.execute(self.replace_query, data)
+                new = None
+            else:
+                c = self.conn.cursor()
+                c.execute("SELECT found FROM %s WHERE name = ?" % self.cache_table, (p.name,))
+                num = len(c.fetchall())
+                existing = (num == 1)
+                c.close()
+
+                if existing:
+                    self.conn.execute(self.update_query, data)
+                    new = False
+                else:
+                    self.conn.execute(self.insert_query, data)
+                    new = True
+        # only the user data of existing geocaches was not written
+        p.clear_changes(self.ctype.NON_USER_ATTRS + self.ctype.DETAIL_ATTRS if new == False else None)
+        return new
+
+    def add_points(self, points, replace=False):
+        """
+        Add many geocaches to the database in a single transaction.
+        
+        This is much faster than calling add_point for each geocache. The changes are committed afterwards.
+        points -- Iterable of geocaches
+        replace -- See add_point.
+        
+        Returns the names of the geocaches which were not in the database before.
+        
+        """
+        points = list(points)
+        names = [p.name for p in points]
+        existing = set()
+        data = [self._compress_details(p.serialize()) for p in points]
+        query = self.replace_query if replace else self.upsert_query
+        with self.write_lock:
             c = self.conn.cursor()
-            c.execute("SELECT found FROM %s WHERE name = ?" % self.cache_table, (p.name,))
-            num = len(c.fetchall())
-            existing = (num == 1)
+            # SQLite limits the number of variables in a statement to 999
+            for i in xrange(0, len(names), 900):
+                chunk = names[i:i + 900]
+                c.execute("SELECT name FROM %s WHERE name IN (%s)" % (self.cache_table, ', '.join('?' for x in chunk)), chunk)
+                existing.update(row['name'] for row in c)
             c.close()
-            
-             
-            if existing:
-                self.conn.execute("UPDATE %s SET %s WHERE name=:name" % (self.cache_table, self.to_replace_string), p.__dict__)
-                return False
-            else:
-                self.conn.execute("INSERT INTO %s (`%s`) VALUES (%s)" % (self.cache_table, '`, `'.join(self.ctype.SQLROW.keys()), ', '.join(':%s' % k for k in self.ctype.SQLROW.keys())), p.serialize())
-                return True
+
+            new = []
+            for name in names:
+                if name not in existing:
+                    new.append(name)
+                    existing.add(name)
+
+            # see add_point
+            self.conn.executemany(self.details_replace_query, data)
+            self.conn.executemany(query, data)
+            self.save()
+        new_names = set(new)
+        for p in points:
+            p.clear_changes(None if replace or p.name in new_names else self.ctype.NON_USER_ATTRS + self.ctype.DETAIL_ATTRS)
+        return new
+
+    def save_changes(self, caches, attributes=None):
+        """
+        Write the changed fields of geocaches to the database and commit.
+        
+        Unlike add_point, only the changed columns are written, so that e.g. setting a geocache as marked does not rewrite its description and logs. The geocaches are grouped by the fields they changed, and each group is written with one statement.
+        caches -- Geocaches, see self.ctype.get_changes
+        attributes -- Write these fields instead of the changed ones
+        
+        """
+        groups = {}
+        for c in caches:
+            fields = tuple(sorted(f for f in (c.get_changes() if attributes == None else attributes) if f != 'name'))
+            if len(fields) > 0:
+                groups.setdefault(fields, []).append(c)
+        with self.write_lock:
+            for fields, group in groups.items():
+                data = [self._compress_details(dict([(f, c.serialize_one(f)) for f in fields], name=c.name)) for c in group]
+                columns = [f for f in fields if f in self.fields]
+                details = [f for f in fields if f in self.detail_fields]
+                if len(details) > 0:
+                    self.conn.executemany('INSERT INTO %s (name, `%s`) VALUES (:name, %s) ON CONFLICT(name) DO UPDATE SET %s' % (self.details_table, '`, `'.join(details), ', '.join(':%s' % f for f in details), ', '.join('`%s` = excluded.`%s`' % (f, f) for f in details)), data)
+                if len(columns) > 0:
+                    self.conn.executemany('UPDATE %s SET %s WHERE name = :name' % (self.cache_table, ', '.join('`%s` = :%s' % (f, f) for f in columns)), data)
+                for c in group:
+                    c.clear_changes(fields)
+            self.save()
                 
                 
+    def _compress_details(self, data):
+        """
+        Compress the fields of the (possibly partial) serialized geocache data which are stored compressed, see self.ctype.compress.
+        
+        """
+        for k in self.compressed_fields:
+            if k in data:
+                data[k] = self.ctype.compress(data[k])
+        return data
+
     def get_all(self):
         """
         Return all geocaches in the database.
         
-        Currently only used by the CLI. Should be used with caution ;-)
+        Currently only used by the CLI. Should be used with caution ;-) See iter_all.
         
         """
-        c = self.conn.cursor()
+        return list(self.iter_all())
 
-        c.execute('SELECT * FROM %s' % self.cache_table)
-        return self._pack_result(c)
+    def iter_all(self):
+        """
+        Iterate over all geocaches in the database.
+        
+        The geocaches are read in chunks while iterating, so the memory usage does not depend on the size of the database.
+        
+        """
+        c = self._get_reader().execute('SELECT * FROM %s' % self.cache_table)
+        return self._iter_result(c)
         
     def get_by_query(self, query):
         """
@@ -164,22 +869,31 @@ class PointProvider():
         WARNING! To avoid SQL injection attacks, this method should only be used with explicitely user provided queries. Should not be used in any regular context in the application.
         
         """
-        c = self.conn.execute(query)
-        return self._pack_result(c)
+        return list(self.iter_by_query(query))
+
+    def iter_by_query(self, query):
+        """
+        Iterate over all geocaches according to the SQL query given, see get_by_query.
+        
+        The query is executed immediately, the geocaches are read in chunks while iterating.
+        
+        """
+        with self.write_lock:
+            c = self.conn.execute(query)
+            if c.description == None:
+                # the query has no results, but might have changed something
+                self.save()
+        return self._iter_result(c)
                 
-    def get_points(self, c1, c2, max_points = None):
+    def get_points(self, c1, c2, max_points = None, summary = False):
         """
         Return points in the given boundaries.
         
         Returns all points within the boundaries given by the two corners c1 and c2. If max_points is given, return max_points or less.
+        summary -- Return summaries instead of full geocaches (see get_points_filter)
         
         """
-        query = 'SELECT * FROM %s WHERE (lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?)' % self.cache_table
-        args = (min(c1.lat, c2.lat), max(c1.lat, c2.lat), min(c1.lon, c2.lon), max(c1.lon, c2.lon))
-        if max_points != None:
-            query = "%s LIMIT %d" % (query, max_points)
-        c = self.conn.execute(query, args)
-        return self._pack_result(c)
+        return self._select_location(Filter(), c1, c2, summary, max_points)
             
     def get_new_fieldnotes_count(self):
         """
@@ -188,7 +902,7 @@ class PointProvider():
         A pending fieldnote is when the field logas contains something different than self.ctype.LOG_NO_LOG, because this field is expected to be reset once the fieldnote was uploaded.
         
         """
-        c = self.conn.execute('SELECT count(*) AS cnt FROM %s WHERE logas != %d' % (self.cache_table, self.ctype.LOG_NO_LOG))
+        c = self._get_reader().execute('SELECT count(*) AS cnt FROM %s WHERE logas != %d' % (self.cache_table, self.ctype.LOG_NO_LOG))
         for row in c:
             return row['cnt']
         return 0
@@ -198,9 +912,17 @@ class PointProvider():
         Return geocaches with pending fieldnotes.
         
         """
-        c = self.conn.execute('SELECT * FROM %s WHERE logas != %d' % (self.cache_table, self.ctype.LOG_NO_LOG))
+        c = self._get_reader().execute('SELECT * FROM %s WHERE logas != %d' % (self.cache_table, self.ctype.LOG_NO_LOG))
         return self._pack_result(c)
 
+    def search_names(self, text):
+        """
+        Look up text in the full text index (see set_filter) and return the names of all matching geocaches, best matches first.
+        
+        """
+        c = self._get_reader().execute('SELECT name FROM %s WHERE %s MATCH ? ORDER BY rank' % (self.search_table, self.search_table), (self._get_search_query(text),))
+        return [row['name'] for row in c]
+
     def get_last_viewed(self, count):
         """
         Get the geocaches which were viewed recently.
@@ -208,7 +930,7 @@ class PointProvider():
         count -- Maximum number of results.
         
         """
-        c = self.conn.execute('SELECT * FROM %s ORDER BY last_viewed DESC LIMIT %d' % (self.cache_table, count))
+        c = self._get_reader().execute('SELECT * FROM %s ORDER BY last_viewed DESC LIMIT %d' % (self.cache_table, count))
         return self._pack_result(c)
         
     def get_last_updated(self, count):
@@ -218,188 +940,384 @@ class PointProvider():
         count -- Maximum number of results.
         
         """
-        c = self.conn.execute('SELECT * FROM %s ORDER BY updated DESC LIMIT %d' % (self.cache_table, count))
+        c = self._get_reader().execute('SELECT * FROM %s ORDER BY updated DESC LIMIT %d' % (self.cache_table, count))
         return self._pack_result(c)
         
     def get_nearest_point_filter(self, center, c1, c2, found):
         """ 
         Get the geocache closest to center.
         
-        The distance calculation is performed in python. First, all geocaches between c1 and c2 are retrieved from the database. Afterwards, the distance to center is calculated in python and the closest cache is selected. 
+        Only geocaches between c1 and c2 are considered. See get_nearest_points for details.
         center -- Center coordinate
         c1 -- Corner 
         c2 -- Corner
         found -- Retrieve only found/not found geocaches (None = all, True = only found, False = only not found)
         
         """
-        filterstring = copy(self.filterstring)
-        filterargs = copy(self.filterargs)
-                
-        filterstring.append('((lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?))')
-        filterargs.append(min(c1.lat, c2.lat))
-        filterargs.append(max(c1.lat, c2.lat))
-        filterargs.append(min(c1.lon, c2.lon))
-        filterargs.append(max(c1.lon, c2.lon))
+        result = self._get_nearest(center, 1, self.filter + self.FILTER_FOUND[found], (c1, c2))
+        if len(result) == 0:
+            return None
+        return result[0][1]
 
-        if found == True:
-            filterstring.append('(found = 1)')
-        elif found == False:
-            filterstring.append('(found = 0)')
-    
+    def get_nearest_points(self, center, k, found=None):
+        """
+        Get the k geocaches closest to center, ordered by their distance to center.
         
-        # we don't have 'power' or other advanced mathematic operators
-        # in sqlite, so doing distance calculation in python
-        query = 'SELECT * FROM %s WHERE %s' % (self.cache_table, " AND ".join(filterstring))
-                
-        c = self.conn.execute(query, tuple(filterargs))
+        The current filter is applied. The search starts with a small rectangle around center which grows until the k-th result is known to be closer than anything outside of the rectangle. Thus, only the neighbourhood of center is read from the database.
+        center -- Center coordinate
+        k -- Maximum number of results
+        found -- Retrieve only found/not found geocaches (None = all, True = only found, False = only not found)
+        
+        """
+        return [coord for dist, coord in self._get_nearest(center, k, self.filter + self.FILTER_FOUND[found])]
 
-        mindist = () # we use this as positive infinity
-        mindistrow = None
-        for row in c:
-            # we have points very close to each other
-            # for the sake of performance, using simpler
-            # distance calc here
-            dist = sqrt((row['lat'] - center.lat) ** 2 + (row['lon'] - center.lon) ** 2)
-            if dist < mindist:
-                mindistrow = row
-                mindist = dist
-        if mindistrow == None:
-            return None
-        coord = self.ctype(mindistrow['lat'], mindistrow['lon'], '', mindistrow)
-        return coord
-                
-    def set_filter(self, found=None, has_details=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, adapt_filter=False, marked=None):
+    def _get_nearest(self, center, k, filter, bounds=None, summary=False):
         """
-        This sets a filtering on geocaches which is then applied to the results of selected query methods.
+        Search outward from center in growing rings and return a sorted list of (distance, geocache) tuples.
         
-        A value of None for any attribute means that no filtering is applied.
-        adapt_filter -- Copy the filter which was in effect until now and change it. If False, start over with clean filter settings.
+        Only the coordinates of the candidates are read while searching, the k closest geocaches are loaded at the end.
+        filter -- Only geocaches which match this filter are considered.
+        bounds -- If not None, only geocaches within this (c1, c2) rectangle are considered.
+        summary -- Return summaries instead of full geocaches (see get_points_filter)
         
         """
-        filter = copy(locals())
-        del filter['self']
-        self.filter = filter
+        if k < 1:
+            return []
 
-        if adapt_filter:
-            filterstring = copy(self.filterstring)
-            filterargs = copy(self.filterargs)
-        else:
-            filterstring = []
-            filterargs = []
+        if bounds != None:
+            bounds = self._get_box(*bounds)
+
+        reader = self._get_reader()
+        best = []
+        inner = None
+        radius = self.NEAREST_START_RADIUS
+        while True:
+            box, complete = self._get_radius_box(center, radius)
+            if bounds != None:
+                complete = complete or (box[0] <= bounds[0] and box[1] >= bounds[1] and box[2] <= bounds[2] and box[3] >= bounds[3])
+                search = (max(box[0], bounds[0]), min(box[1], bounds[1]), max(box[2], bounds[2]), min(box[3], bounds[3]))
+            else:
+                search = box
+
+            if search[0] <= search[1] and search[2] <= search[3]:
+                ring = filter + self._box_filter(search)
+                if inner != None:
+                    # everything within the previous rectangle was already examined
+                    ring = ring + Filter(('NOT ((lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?))',), inner)
+
+                # The conditions of a text search contain the MATCH, the ranking is not needed here
+                query = 'SELECT name, lat, lon FROM %s WHERE %s' % (self.cache_table, ring.get_where())
+                for name, lat, lon in reader.execute(query, ring.args):
+                    best.append((geo.distance_to(center, geo.Coordinate(lat, lon)), name))
+                best.sort(key=lambda x: x[0])
+                del best[k:]
+
+            # Every geocache outside of the rectangle is farther away than radius.
+            if complete or (len(best) == k and best[-1][0] <= radius):
+                break
+            inner = box
+            radius *= 2
+
+        found = {}
+        columns = self.summary_columns if summary else '%s.*' % self.cache_table
+        for i in xrange(0, len(best), self.ITER_CHUNK_SIZE):
+            names = [name for distance, name in best[i:i + self.ITER_CHUNK_SIZE]]
+            query = 'SELECT %s FROM %s WHERE name IN (%s)' % (columns, self.cache_table, ', '.join('?' for x in names))
+            for coord in self._pack_result(reader.execute(query, names), summary):
+                found[coord.name] = coord
+        return [(distance, found[name]) for distance, name in best if name in found]
+
+    @staticmethod
+    def _get_radius_box(center, radius):
+        """
+        Return the smallest rectangle (minlat, maxlat, minlon, maxlon) which contains all points within radius meters of center.
+        
+        The longitude offset is chosen such that the great circle distance from center to the eastern and western edge is exactly radius. The second return value is True if the rectangle covers the whole earth.
+        
+        """
+        angle = radius / geo.Coordinate.RADIUS_EARTH
+        if angle >= pi:
+            return (-90, 90, -180, 180), True
+        minlat = center.lat - degrees(angle)
+        maxlat = center.lat + degrees(angle)
+        if minlat <= -90 or maxlat >= 90:
+            # the rectangle contains a pole and therefore all longitudes
+            return (max(minlat, -90), min(maxlat, 90), -180, 180), (minlat <= -90 and maxlat >= 90)
+        ratio = sin(angle) / cos(radians(center.lat))
+        if ratio >= 1:
+            return (minlat, maxlat, -180, 180), False
+        dlon = degrees(asin(ratio))
+        if center.lon - dlon < -180 or center.lon + dlon > 180:
+            # crossing the antimeridian, being generous here
+            return (minlat, maxlat, -180, 180), False
+        return (minlat, maxlat, center.lon - dlon, center.lon + dlon), False
+                
+    def make_filter(self, found=None, has_details=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, marked=None, text_search=''):
+        """
+        Return a Filter for the given criteria, see set_filter.
+        
+        """
+        conditions = []
+        args = []
+        search = None
                 
         if found == True:
-            filterstring.append('(found = 1)')
+            conditions.append('(found = 1)')
         elif found == False:
-            filterstring.append('(found = 0)')
+            conditions.append('(found = 0)')
 
         if marked == True:
-            filterstring.append('(marked = 1)')
+            conditions.append('(marked = 1)')
         elif marked == False:
-            filterstring.append('(marked = 0)')
+            conditions.append('(marked = 0)')
                 
+        details = "(%s.name IN (SELECT name FROM %s WHERE desc != '' or shortdesc != ''))" % (self.cache_table, self.details_table)
         if has_details == True:
-            filterstring.append("(desc != '' or shortdesc != '')")
+            conditions.append(details)
         elif has_details == False:
-            filterstring.append("NOT (desc != '' or shortdesc != '')")
+            conditions.append("NOT %s" % details)
                         
+        if owner_search != None:
+            owner_search = self._to_unicode(owner_search)
         if owner_search != None and len(owner_search) > 2:
-            filterstring.append("(owner LIKE '%%%s%%')" % owner_search)
+            conditions.append("(owner LIKE ?)")
+            args.append(u'%%%s%%' % owner_search)
                         
+        if name_search != None:
+            name_search = self._to_unicode(name_search)
         if name_search != None and len(name_search) > 2:
-            filterstring.append("((name LIKE '%%%s%%') OR (title LIKE '%%%s%%'))" % (name_search, name_search))
+            conditions.append("((name LIKE ?) OR (title LIKE ?))")
+            args += [u'%%%s%%' % name_search] * 2
+
+        if text_search != None and text_search.strip() != '':
+            search = self._get_search_query(text_search)
+            conditions.append('(%s.rowid IN (SELECT rowid FROM %s WHERE %s MATCH ?))' % (self.cache_table, self.search_table, self.search_table))
+            args.append(search)
                         
         if size != None:
-            filterstring.append('(size IN (%s))' % (", ".join(str(b) for b in size)))
+            conditions.append('(size IN (%s))' % (", ".join('?' for b in size)))
+            args += size
 
         if terrain != None:
             if type(terrain) == tuple:
-                filterstring.append('(terrain >= ?) AND (terrain <= ?)')
-                filterargs.append(terrain[0] * 10)
-                filterargs.append(terrain[1] * 10)
+                conditions.append('(terrain >= ?) AND (terrain <= ?)')
+                args.append(terrain[0] * 10)
+                args.append(terrain[1] * 10)
             elif type(terrain) == list:
-                filterstring.append('(terrain IN (%s))' % (", ".join('?' for b in terrain)))
+                conditions.append('(terrain IN (%s))' % (", ".join('?' for b in terrain)))
                 for b in terrain:
-                    filterargs.append(b * 10)
+                    args.append(b * 10)
 
                         
         if diff != None:
             if type(diff) == tuple:
-                filterstring.append('(difficulty >= ?) AND (difficulty <= ?)')
-                filterargs.append(diff[0] * 10)
-                filterargs.append(diff[1] * 10)
+                conditions.append('(difficulty >= ?) AND (difficulty <= ?)')
+                args.append(diff[0] * 10)
+                args.append(diff[1] * 10)
             elif type(diff) == list:
-                filterstring.append('(difficulty IN (%s))' % (", ".join('?' for b in diff)))
+                conditions.append('(difficulty IN (%s))' % (", ".join('?' for b in diff)))
                 for b in diff:
-                    filterargs.append(b * 10)
+                    args.append(b * 10)
                         
         if ctype != None:
             if len(ctype) > 0:
-                filterstring.append('(type IN (%s))' % (", ".join('?' for b in ctype)))
+                conditions.append('(type IN (%s))' % (", ".join('?' for b in ctype)))
                 for b in ctype:
-                    filterargs.append(b)
+                    args.append(b)
                                         
-        if len(filterstring) == 0:
-            filterstring.append('1')
-                
-        self.filterstring = filterstring
-        self.filterargs = filterargs
+        return Filter(conditions, args, search)
+
+    def set_filter(self, found=None, has_details=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, adapt_filter=False, marked=None, text_search=''):
+        """
+        This sets a filtering on geocaches which is then applied to the results of selected query methods.
+        
+        A value of None for any attribute means that no filtering is applied.
+        adapt_filter -- Keep the filter which was in effect until now and add the new criteria. If False, start over with clean filter settings.
+        text_search -- Words to look up in the full text index (name, title, owner, attributes, description, hints and logs). Geocaches must contain all words, each as a prefix of a word. get_points_filter returns the best matches first.
+        
+        """
+        filter = self.make_filter(found=found, has_details=has_details, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked, text_search=text_search)
+        if adapt_filter:
+            filter = self.filter + filter
+        self.filter = filter
                 
     def push_filter(self):
         """
         Push the current filter settings to a stack of filter settings.
         
         """
-        self.filterstack.append((self.filterstring, self.filterargs))
+        self.filterstack.append(self.filter)
                 
     def pop_filter(self):
         """ 
         Pop the topmost filter settings off the filter settings stack and apply it.
         
         """
-        self.filterstring, self.filterargs = self.filterstack.pop()
+        self.filter = self.filterstack.pop()
                 
-    def get_points_filter(self, location=None, found=None, max_results=None):
+    def get_points_filter(self, location=None, found=None, max_results=None, summary=False, center=None):
         """
         Get geocaches according to the current filter.
         
         location -- Boundaries for the geographic location
         found -- Include found geocaches (None/True/False)
         max_results -- Maximum number of results (None = all)
+        summary -- Only read the fields which are needed to draw the geocaches on the map or in a list and return summaries (see stype in the constructor). This avoids loading descriptions, logs etc.
+        center -- Order the results by their distance to this coordinate, so that the closest max_results geocaches are returned (see get_nearest_points). Otherwise, the order is arbitrary (or by relevance for a text search).
         """
-        filterstring = copy(self.filterstring)
-        filterargs = copy(self.filterargs)
+        filter = self.filter + self.FILTER_FOUND[found]
 
         if max_results == None:
             max_results = self.MAX_RESULTS
+
+        if center != None:
+            return [coord for dist, coord in self._get_nearest(center, max_results, filter, location, summary)]
                 
         if location != None:
             c1, c2 = location
-            filterstring.append('(lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?)')
-            filterargs.append(min(c1.lat, c2.lat))
-            filterargs.append(max(c1.lat, c2.lat))
-            filterargs.append(min(c1.lon, c2.lon))
-            filterargs.append(max(c1.lon, c2.lon))
+            return self._select_location(filter, c1, c2, summary, max_results)
 
+        return self._select(filter, summary, max_results)
 
-        if found == True:
-            filterstring.append('(found = 1)')
-        elif found == False:
-            filterstring.append('(found = 0)')
+    def get_change_seq(self):
+        """
+        Return the sequence number of the last change to the geocaches, see get_changes_since.
+        
+        """
+        return self._get_reader().execute('SELECT coalesce(max(seq), 0) FROM %s' % self.changes_table).fetchone()[0]
 
+    def get_changes_since(self, seq, summary=False):
+        """
+        Return the geocaches which were changed or removed after the change with the given sequence number.
+        
+        Consumers which keep geocaches (such as lists or the map) can store the sequence number and apply the changes instead of querying everything again. Only the last change of each geocache is recorded, and only committed changes are returned.
         
-        query = 'SELECT * FROM %s WHERE %s LIMIT %s' % (self.cache_table, " AND ".join(filterstring), max_results)
+        Returns a tuple (seq, changed, removed): seq is the sequence number to pass the next time, changed is a list of the changed or new geocaches (or summaries, if summary is True) and removed is a list of the names of the removed geocaches.
+        
+        """
+        # a single statement, so that the sequence number matches the changes
+        query = 'SELECT change_seq, change_name, change_removed, %s FROM (SELECT seq AS change_seq, name AS change_name, removed AS change_removed FROM %s WHERE seq > ?) ' \
+            'LEFT JOIN %s ON %s.name = change_name ORDER BY change_seq' % (self.summary_columns if summary else '%s.*' % self.cache_table, self.changes_table, self.cache_table, self.cache_table)
+        changed = []
+        removed = []
+        for row in self._get_reader().execute(query, (seq,)):
+            seq = row['change_seq']
+            if row['change_removed']:
+                removed.append(row['change_name'])
+            elif summary and self.stype != None:
+                changed.append(self.stype(row))
+            else:
+                changed.append(self._make_geocache(row))
+        return (seq, changed, removed)
 
-        c = self.conn.execute(query, tuple(filterargs))
-        return self._pack_result(c)
+    def get_clusters(self, location, zoom, found=None):
+        """
+        Return the number of geocaches in each cell of the map in the given boundaries.
+        
+        This is used to draw an overview of the geocaches when there are too many of them to draw each one. Its running time depends only on the number of cells, not on the number of geocaches. The cells are 64x64 pixels at the given zoom level (or larger above CLUSTER_MAX_ZOOM).
+        
+        Returns a list of tuples (lat, lon, count, found, type), where lat and lon are the center of the geocaches in the cell, found is the number of found geocaches and type is the most common type. Returns None if the current filter has other conditions than found, which the clusters cannot take into account. A found condition of the filter is applied like the found argument.
+        
+        location -- Boundaries for the geographic location
+        zoom -- Zoom level of the map
+        found -- Include found geocaches (None/True/False)
+        
+        """
+        conditions = list(self.filter.conditions)
+        for value in (True, False):
+            condition = self.FILTER_FOUND[value].conditions[0]
+            if condition in conditions:
+                conditions.remove(condition)
+                if found == (not value):
+                    # the filter and the argument contradict each other
+                    return []
+                found = value
+        if len(conditions) > 0:
+            return None
+        zoom = max(0, min(zoom, self.CLUSTER_MAX_ZOOM))
+        c1, c2 = location
+        query = 'SELECT x, y, type, found, count, lat, lon FROM %s WHERE zoom = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?' % self.cluster_table
+        args = (zoom, self._cluster_x(min(c1.lon, c2.lon), zoom), self._cluster_x(max(c1.lon, c2.lon), zoom),
+            self._cluster_y(max(c1.lat, c2.lat), zoom), self._cluster_y(min(c1.lat, c2.lat), zoom))
+        if found != None:
+            query += ' AND found = ?'
+            args += (int(found), )
+        cells = {}
+        for x, y, type, f, count, lat, lon in self._get_reader().execute(query, args):
+            cell = cells.setdefault((x, y), [0, 0, 0.0, 0.0, {}])
+            cell[0] += count
+            cell[1] += count if f else 0
+            cell[2] += lat
+            cell[3] += lon
+            cell[4][type] = cell[4].get(type, 0) + count
+        return [(lat / count, lon / count, count, found, max(types, key=types.get)) for count, found, lat, lon, types in cells.values()]
+
+    def iter_points_filter(self, location=None, found=None, summary=False):
+        """
+        Iterate over all geocaches according to the current filter.
+        
+        Unlike get_points_filter, the number of results is not limited and the results are not cached. The query is executed immediately, so later changes to the filter do not affect the results. The geocaches are read in chunks while iterating.
+        
+        location -- Boundaries for the geographic location
+        found -- Include found geocaches (None/True/False)
+        summary -- See get_points_filter
+        
+        """
+        filter = self.filter + self.FILTER_FOUND[found]
+        if location != None:
+            c1, c2 = location
+            filter += self._location_filter(c1, c2)
+        args = filter.args if filter.search == None else (filter.search,) + filter.args
+        c = self._get_reader().execute(self._get_statement(filter, summary), args)
+        return self._iter_result(c, summary)
 
-    def _pack_result(self, cursor):
+    def _pack_result(self, cursor, summary=False):
         """
-        Transform all results rows into Geocache objects
+        Transform all results rows into Geocache objects (or summaries, if summary is True)
         
         """
-        points = [self.ctype(None, None, None, row) for row in cursor]
+        if summary and self.stype != None:
+            points = [self.stype(row) for row in cursor]
+        else:
+            points = [self._make_geocache(row) for row in cursor]
         cursor.close()
         return points
+
+    def _iter_result(self, cursor, summary=False):
+        """
+        Like _pack_result, but read the rows in chunks of ITER_CHUNK_SIZE and yield the geocaches (or summaries).
+        
+        """
+        make = self.stype if summary and self.stype != None else self._make_geocache
+        try:
+            rows = cursor.fetchmany(self.ITER_CHUNK_SIZE)
+            while rows:
+                for row in rows:
+                    yield make(row)
+                rows = cursor.fetchmany(self.ITER_CHUNK_SIZE)
+        finally:
+            cursor.close()
+
+    def _make_geocache(self, row):
+        """
+        Create a geocache from a result row. Its details are loaded from the details table when they are first accessed.
+        
+        """
+        coord = self.ctype(None, None, None, row)
+        coord.details_loader = self._load_details
+        return coord
+
+    def _load_details(self, name):
+        """
+        Return the details (see self.ctype.DETAIL_ATTRS) of the geocache with the given name as a dict.
+        
+        Compressed values are returned as they are, the geocache decompresses them on first access.
+        
+        """
+        row = self._get_reader().execute(self.details_query, (name,)).fetchone()
+        if row == None:
+            return dict((k, '') for k in self.ctype.DETAIL_ATTRS)
+        return dict((k, row[k]) for k in self.ctype.DETAIL_ATTRS)
                 
     def update_field(self, coordinate, field, newvalue, save = True):
         """
@@ -411,10 +1329,16 @@ class PointProvider():
         save -- Commit changes (set to False to speed up multiple changes)
         
         """
-        query = 'UPDATE %s SET %s = ? WHERE name = ?' % (self.cache_table, field)
-        self.conn.execute(query, (newvalue, coordinate.name))
-        if save:
-            self.save()
+        if field in self.compressed_fields:
+            newvalue = self.ctype.compress(newvalue)
+        if field in self.ctype.DETAIL_ATTRS:
+            query = 'INSERT INTO %s (`%s`, name) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET `%s` = excluded.`%s`' % (self.details_table, field, field, field)
+        else:
+            query = 'UPDATE %s SET %s = ? WHERE name = ?' % (self.cache_table, field)
+        with self.write_lock:
+            self.conn.execute(query, (newvalue, coordinate.name))
+            if save:
+                self.save()
 
     def get_by_name(self, gcname):
         """
@@ -424,10 +1348,10 @@ class PointProvider():
         
         """
         query = 'SELECT * FROM %s WHERE name = ? LIMIT 1' % self.cache_table
-        c = self.conn.execute(query, (gcname,))
+        c = self._get_reader().execute(query, (gcname,))
         row = c.fetchone()
         if row != None:
-            coord = self.ctype(None, None, None, row)
+            coord = self._make_geocache(row)
             return coord
         else:
             return None
@@ -440,16 +1364,74 @@ class PointProvider():
         
         """
         names = [x.name for x in l if x.name != '']
-        query = 'DELETE FROM %s WHERE name IN (%s)' % (self.cache_table, (','.join('?' for x in names)))
         
-        self.conn.execute(query, tuple(names))
-        self.save()
+        with self.write_lock:
+            # SQLite limits the number of variables in a statement to 999
+            for i in xrange(0, len(names), 900):
+                chunk = names[i:i + 900]
+                self.conn.execute('DELETE FROM %s WHERE name IN (%s)' % (self.cache_table, ', '.join('?' for x in chunk)), chunk)
+            self.save()
 
     def optimize(self):
         """
         Perform maintenance on the database to speed up things. 
         
-        Is not called automatically.
+        Is not called automatically. Runs all steps of maintain at once and returns the number of reclaimed pages.
         
         """
-        self.conn.execute('VACUUM')
+        pages = 0
+        for pages, left in self.maintain():
+            pass
+        return pages
+
+    def maintain(self):
+        """
+        Reclaim the free space in the database file and update the statistics of the query planner, in small steps.
+        
+        This is a generator. Each step takes roughly MAINTENANCE_SLICE seconds and yields a tuple of the number of pages reclaimed so far and the number of free pages left. The database can be used as usual between the steps, so they can be run whenever the main loop is idle, and the maintenance can be paused at any time.
+        
+        Databases which were created before incremental vacuuming was enabled are converted by a full VACUUM in the first step.
+        
+        """
+        with self.write_lock:
+            if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                logger.info("Converting database for incremental vacuum")
+                self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                self.conn.execute('VACUUM')
+                # VACUUM may renumber the rowids, which are referenced by the spatial index
+                # and the full text index
+                self._rebuild_spatial_index()
+                self._rebuild_search_index()
+                self.save()
+        reclaimed = 0
+        pages = 64
+        while True:
+            with self.write_lock:
+                left = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if left == 0:
+                    break
+                start = time()
+                self.conn.execute('PRAGMA incremental_vacuum(%d)' % pages).fetchall()
+                self.save()
+                elapsed = time() - start
+                now_left = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+            reclaimed += left - now_left
+            yield (reclaimed, now_left)
+            # adapt the number of pages to the time slice
+            pages = max(1, min(pages * 2, int(pages * self.MAINTENANCE_SLICE / max(elapsed, 0.001))))
+
+        with self.write_lock:
+            # only samples the tables, so this is fast even for large databases
+            self.conn.execute('PRAGMA analysis_limit = 1000')
+            if self._has_table('sqlite_stat1'):
+                self.conn.execute('PRAGMA optimize')
+            else:
+                self.conn.execute('ANALYZE')
+            self.save()
+        yield (reclaimed, 0)
+
+        with self.write_lock:
+            # the file is only truncated when the write-ahead log is written back
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        logger.info("Maintenance reclaimed %d pages" % reclaimed)
+        yield (reclaimed, 0)
@@ -121,7 +121,7 @@ class Controller(QtCore.QObject):
             logger.debug("Declined getGeocaches request")
             return False
         
-        points = self.core.pointprovider.get_points(geo.Coordinate(lat_start, lon_start), geo.Coordinate(lat_end, lon_end), self.MAX_POINTS + 1)
+        points = self.core.pointprovider.get_points(geo.Coordinate(lat_start, lon_start), geo.Coordinate(lat_end, lon_end), self.MAX_POINTS + 1, summary=True)
         
         if len(points) > self.MAX_POINTS:
             self._geocache_list = GeocacheListModel(self.core, [])
@@ -968,7 +968,10 @@ class ImageWrapper(QtCore.QObject):
 class GeocacheWrapper(QtCore.QObject):
     def __init__(self, geocache, core):
         QtCore.QObject.__init__(self)
-        self._geocache = geocache
+        # The map only loads summaries. In this case, the full geocache is
+        # loaded on first access to self._geocache.
+        self._summary = geocache
+        self._full_geocache = None if isinstance(geocache, geocaching.GeocacheSummary) else geocache
         self.core = core
         self._coordinate_list = None
         self._logs_list = None
@@ -987,8 +990,16 @@ class GeocacheWrapper(QtCore.QObject):
         #    GeocacheWrapper.GEOCACHE_CACHE[geocache.name].update(geocache)
         return GeocacheWrapper.GEOCACHE_CACHE[geocache.name]
 
+    def _get_geocache(self):
+        if self._full_geocache == None:
+            self._full_geocache = self.core.get_geocache_by_name(self._summary.name)
+            self._summary = self._full_geocache
+        return self._full_geocache
+
+    _geocache = property(_get_geocache)
+
     def update(self, geocache):
-        self._geocache = geocache
+        self._summary = self._full_geocache = geocache
         self._coordinate_list = None
         self._logs_list = None
         self._image_list = None
@@ -998,16 +1009,16 @@ class GeocacheWrapper(QtCore.QObject):
         self.coordsChanged.emit()
         
     def _name(self):
-        return self._geocache.name
+        return self._summary.name
 
     def _title(self):
-        return self._geocache.title
+        return self._summary.title
 
     def _lat(self):
-        return self._geocache.lat
+        return self._summary.lat
 
     def _lon(self):
-        return self._geocache.lon
+        return self._summary.lon
 
     def _shortdesc(self):
         return self._geocache.shortdesc
@@ -1042,28 +1053,28 @@ class GeocacheWrapper(QtCore.QObject):
         return path.join(self.core.settings['download_output_dir'], image)
 
     def _type(self):
-        return self._geocache.type
+        return self._summary.type
 
     def _size(self):
-        return self._geocache.size
+        return self._summary.size
 
     def _difficulty(self):
-        return (self._geocache.difficulty/10.0)
+        return (self._summary.difficulty/10.0)
 
     def _terrain(self):
-        return (self._geocache.terrain/10.0)
+        return (self._summary.terrain/10.0)
 
     def _owner(self):
         return self._geocache.owner
 
     def _found(self):
-        return self._geocache.found
+        return self._summary.found
 
     def _hints(self):
         return self._geocache.hints
         
     def _url(self):
-        return "http://coord.info/%s" % self._geocache.name
+        return "http://coord.info/%s" % self._summary.name
 
     def _coordinates(self):
         logger.debug("Preparing coordinate list...")
@@ -1084,10 +1095,10 @@ class GeocacheWrapper(QtCore.QObject):
         return self._image_list
 
     def _status(self):
-        return self._geocache.status
+        return self._summary.status
 
     def _has_details(self):
-        return self._geocache.was_downloaded()
+        return self._summary.was_downloaded()
         
     def _logas(self):
         try:
@@ -1127,7 +1138,7 @@ class GeocacheWrapper(QtCore.QObject):
         self.changed.emit()
         
     def _marked(self):
-        return self._geocache.marked
+        return self._summary.marked
         
     def _set_marked(self, marked):
         self._geocache.marked = marked
@@ -1254,7 +1265,7 @@ class GeocacheListModel(QtCore.QAbstractListModel):
         if by == self.SORT_BY_PROXIMITY:
             def key(f):
                 if gpsWrapper.gps_last_good_fix._valid():
-                    return f._geocache.distance_to(geo.Coordinate(gpsWrapper.gps_last_good_fix._lat(), gpsWrapper.gps_last_good_fix._lon()))
+                    return f._summary.distance_to(geo.Coordinate(gpsWrapper.gps_last_good_fix._lat(), gpsWrapper.gps_last_good_fix._lon()))
                 return None
         elif by == self.SORT_BY_NAME:
             key = lambda f: f._title()
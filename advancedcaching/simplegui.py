@@ -174,7 +174,10 @@ class SimpleGui(Gui):
             exit()
 
     def _get_geocaches_callback(self, visible_area, maxresults):
-        return self.core.pointprovider.get_points_filter(visible_area, False if self.settings['options_hide_found'] else None, maxresults)
+        return self.core.pointprovider.get_points_filter(visible_area, False if self.settings['options_hide_found'] else None, maxresults, summary=True)
+
+    def _get_clusters_callback(self, visible_area, zoom):
+        return self.core.pointprovider.get_clusters(visible_area, zoom, False if self.settings['options_hide_found'] else None)
  
 
     def _prepare_images(self, dataroot):
@@ -346,7 +349,7 @@ class SimpleGui(Gui):
             zoom = 6
 
         self.map = Map(center=coord, zoom=zoom)
-        self.geocache_layer = GeocacheLayer(self._get_geocaches_callback, self._show_cache_select)
+        self.geocache_layer = GeocacheLayer(self._get_geocaches_callback, self._show_cache_select, self._get_clusters_callback)
         self.marks_layer = MarksLayer()
         self.map.add_layer(self.geocache_layer)
         self.map.add_layer(self.marks_layer)
@@ -1002,15 +1005,16 @@ class SimpleGui(Gui):
         gtk.main()
         
     def _show_cache_select(self, caches):
+        # The map only knows summaries, so the full geocache is loaded here.
         if len(caches) == 0:
             return
         if len(caches) == 1:
-            self.show_cache(caches[0])
+            self.show_cache(self.core.get_geocache_by_name(caches[0].name))
             return
         menu = gtk.Menu()
         for c in caches:
             entry = gtk.MenuItem(self.shorten_name(c.title, 30))
-            entry.connect("activate", lambda x, cache=c: self.show_cache(cache))
+            entry.connect("activate", lambda x, name=c.name: self.show_cache(self.core.get_geocache_by_name(name)))
             menu.append(entry)
         menu.show_all()
         menu.popup(None, None, None, 0, 0)
@@ -33,6 +33,7 @@ rsync -av --delete --exclude='*.pyc' \
     $SOURCE/cachedownloader.py \
     $SOURCE/coordfinder.py \
     $SOURCE/geo.py \
+    $SOURCE/geobatch.py \
     $SOURCE/gui.py \
     $SOURCE/cli.py \
     $SOURCE/core.py \
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#   Copyright (C) 2012 Daniel Fett
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Author: Daniel Fett agtl@danielfett.de
+#   Jabber: fett.daniel@jaber.ccc.de
+#   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
+#
+
+# Benchmarks for the HTTP layer (advancedcaching/downloader.py). Each mode
+# downloads made-up geocaches from a stand-in server on localhost, which
+# can add round trip times, limited bandwidth and failures.
+
+from __future__ import with_statement
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'advancedcaching'))
+
+import gzip
+import logging
+import random
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from hashlib import md5
+from time import time, sleep
+import downloader
+from downloader import FileDownloader, RetryPolicy, BodyCollector, read_from_network, enable_http_recording, enable_http_replay
+logger = logging.getLogger('benchmark')
+
+if __name__ == '__main__':
+    # Run with
+    #   connections [number of caches] [round trip time in ms]
+    #   retries [number of caches] [failure rate]
+    #   httpcache [number of caches] [bandwidth in KB/s]
+    #   streaming [number of caches]
+    #   replay [number of caches] [round trip time in ms] [bandwidth in KB/s]
+    #
+    # connections: Compares a new connection per request to the keep-alive
+    # connection pool.
+    #
+    # retries: Compares importing from a failing server with and without
+    # the retry policy.
+    #
+    # httpcache: Imports without the HTTP cache, then twice with it.
+    #
+    # streaming: Compares the peak memory usage of parsing buffered and
+    # streamed downloads, the latter also while writing them into the HTTP
+    # cache, each in a process of its own (streaming-import).
+    #
+    # replay: Records an import into an HTTP archive and replays it, with
+    # and without the delays of the server.
+    logging.basicConfig(level=logging.INFO,
+                    format='%(relativeCreated)6d %(levelname)10s %(name)-20s %(message)s',
+                    )
+    logging.getLogger('downloader').setLevel(logging.WARNING)
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'connections'
+
+    # Each cache is imported with its print page, a few logbook pages and images.
+    LOG_PAGES = 2
+    IMAGES = 4
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for j in xrange(random.randint(2, 10))) for i in xrange(2000)]
+    def text(n):
+        return ' '.join(random.choice(words) for i in xrange(n))
+    BODIES = {
+        '/seek/cdpf.aspx?size=large': ('text/html', '<html><body>%s</body></html>' % ''.join('<p>%s</p>' % text(100) for i in xrange(400))),
+        '/seek/cdpf.aspx': ('text/html', '<html><body>%s</body></html>' % text(5000)),
+        '/seek/geocache.logbook': ('application/json', '{"status": "success", "data": ["%s"]}' % text(1000)),
+        '/images/': ('image/jpeg', ''.join(chr(random.randint(0, 255)) for i in xrange(15000))),
+    }
+
+    class StandInServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def __init__(self, rtt):
+            HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+            self.rtt = rtt
+            self.failure_rate = 0
+            self.bandwidth = 0 # bytes per second, 0 for unlimited
+            self.connections = 0
+            self.requests = 0
+            self.bytes = 0
+
+        def process_request(self, request, client_address):
+            self.connections += 1
+            ThreadingMixIn.process_request(self, request, client_address)
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Send each response in one piece, as real servers do, otherwise
+        # Nagle's algorithm delays the responses on persistent connections
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            # A new connection costs a round trip for the TCP handshake and two for TLS
+            sleep(self.server.rtt * 3)
+
+        def do_GET(self):
+            self.server.requests += 1
+            sleep(self.server.rtt)
+            content_type, body = BODIES[max((k for k in BODIES if self.path.startswith(k)), key=len)]
+            if random.random() < self.server.failure_rate:
+                if random.random() < 0.5:
+                    # Overloaded server
+                    self.send_response(503)
+                    self.send_header('Retry-After', '0')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                else:
+                    # Connection lost in the middle of the response
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body[:len(body) / 2])
+                    self.close_connection = 1
+                return
+            etag = '"%s"' % md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('ETag', etag)
+            if 'gzip' in self.headers.get('Accept-Encoding', '') and content_type != 'image/jpeg':
+                buf = StringIO()
+                f = gzip.GzipFile(fileobj=buf, mode='wb')
+                f.write(body)
+                f.close()
+                body = buf.getvalue()
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.server.bytes += len(body)
+            if self.server.bandwidth > 0:
+                sleep(float(len(body)) / self.server.bandwidth)
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    def start_server(rtt):
+        server = StandInServer(rtt)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def import_caches(d, base, count):
+        """
+        Return the number of caches which were downloaded completely.
+        
+        """
+        complete = 0
+        for i in xrange(count):
+            urls = ['%s/seek/cdpf.aspx?wp=GC%X' % (base, i)]
+            urls += ['%s/seek/geocache.logbook?tkn=GC%X&idx=%d' % (base, i, j + 1) for j in xrange(LOG_PAGES)]
+            urls += ['%s/images/GC%X-%d.jpg' % (base, i, j) for j in xrange(IMAGES)]
+            if None not in [read_from_network(d.get_reader(url, login=False)) for url in urls]:
+                complete += 1
+        return complete
+
+    if mode == 'connections':
+        from urllib2 import build_opener, HTTPCookieProcessor
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        rtt = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.01
+        server, base = start_server(rtt)
+        for title in ('new connection per request', 'keep-alive connection pool'):
+            d = FileDownloader('', '', '/tmp/agtl-benchmark-cookies')
+            if title == 'new connection per request':
+                d.opener = build_opener(HTTPCookieProcessor(d.cookiejar))
+            server.connections = server.requests = 0
+            start = time()
+            import_caches(d, base, count)
+            logger.info("%d caches, %s: %d connections opened for %d requests, %.2f s" % (count, title, server.connections, server.requests, time() - start))
+            d.pool.close()
+        server.shutdown()
+
+    elif mode == 'retries':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        server, base = start_server(0)
+        server.failure_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+        logging.getLogger('downloader').setLevel(logging.CRITICAL)
+        for title, attempts in (('without retries', 1), ('with retry policy', RetryPolicy.MAX_ATTEMPTS)):
+            d = FileDownloader('', '', '/tmp/agtl-benchmark-cookies')
+            d.retry_policy.MAX_ATTEMPTS = attempts
+            d.retry_policy.BACKOFF = 0.05
+            server.requests = 0
+            start = time()
+            complete = import_caches(d, base, count)
+            logger.info("%d caches, %s: %d complete, %d requests, %d retries, %d give-ups, %.2f s" % (count, title, complete, server.requests, d.retry_policy.retries, d.retry_policy.give_ups, time() - start))
+            d.pool.close()
+        server.shutdown()
+
+    elif mode == 'httpcache':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        server, base = start_server(0.01)
+        server.bandwidth = float(sys.argv[3]) * 1024 if len(sys.argv) > 3 else 128 * 1024
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for title, cache in (('without HTTP cache', None), ('first import with HTTP cache', cache_dir), ('second import with HTTP cache', cache_dir)):
+                d = FileDownloader('', '', '/tmp/agtl-benchmark-cookies', cache)
+                server.requests = server.bytes = 0
+                start = time()
+                complete = import_caches(d, base, count)
+                logger.info("%d caches, %s: %d complete, %d requests, %d KB transferred, %.2f s%s" % (count, title, complete, server.requests, server.bytes / 1024, time() - start, d.get_cache_status()))
+                d.pool.close()
+        finally:
+            shutil.rmtree(cache_dir)
+        server.shutdown()
+
+    elif mode == 'streaming':
+        # Each way of downloading runs in a process of its own, because the peak RSS never decreases.
+        import subprocess
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 800
+        server, base = start_server(0)
+        for title in ('buffered', 'streamed', 'streamed into the HTTP cache'):
+            output = subprocess.Popen([sys.executable, __file__, 'streaming-import', title, base, str(count)], stdout=subprocess.PIPE).communicate()[0]
+            logger.info("%d caches, %s: %s" % (count, title, output.strip()))
+        server.shutdown()
+
+    elif mode == 'streaming-import':
+        import resource
+        title, base, count = sys.argv[2], sys.argv[3], int(sys.argv[4])
+        try:
+            from lxml.html import HTMLParser, fromstring
+            parser_factory = lambda: HTMLParser(encoding='utf-8')
+            parse = fromstring
+        except ImportError:
+            # Without lxml, the parser of the standard library stands in; it builds no tree
+            from HTMLParser import HTMLParser
+            parser_factory = HTMLParser
+            def parse(text):
+                parser = HTMLParser()
+                parser.feed(text)
+                return parser.close()
+        from json import loads
+        cache_dir = tempfile.mkdtemp() if title == 'streamed into the HTTP cache' else None
+        d = FileDownloader('', '', '/tmp/agtl-benchmark-cookies', cache_dir)
+        # The print pages of geocaches with long descriptions are a few hundred kB
+        page = '%s/seek/cdpf.aspx?size=large&wp=GC%X'
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time()
+        try:
+            for i in xrange(count):
+                logbooks = ['%s/seek/geocache.logbook?tkn=GC%X&idx=%d' % (base, i, j + 1) for j in xrange(LOG_PAGES)]
+                if title == 'buffered':
+                    # As before: the body, the decoded text and the tree
+                    parse(unicode(read_from_network(d.get_reader(page % (base, i), login=False)), 'utf-8'))
+                    for url in logbooks:
+                        loads(read_from_network(d.get_reader(url, login=False)))
+                else:
+                    d.get_parsed(page % (base, i), parser_factory, login=False)
+                    for url in logbooks:
+                        loads(d.get_parsed(url, BodyCollector, login=False))
+        finally:
+            if cache_dir != None:
+                shutil.rmtree(cache_dir)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print "peak RSS %.1f MB (%.1f MB above the interpreter), %.2f s" % (after / 1024.0, (after - before) / 1024.0, time() - start)
+
+    elif mode == 'replay':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        rtt = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.05
+        bandwidth = float(sys.argv[4]) * 1024 if len(sys.argv) > 4 else 128 * 1024
+        server, base = start_server(rtt)
+        server.bandwidth = bandwidth
+        archive = tempfile.mkdtemp()
+        def download(d):
+            bodies = []
+            for i in xrange(count):
+                bodies.append(d.get_parsed('%s/seek/cdpf.aspx?wp=GC%X' % (base, i), BodyCollector, login=False))
+                bodies += [read_from_network(d.get_reader('%s/seek/geocache.logbook?tkn=GC%X&idx=%d' % (base, i, j + 1), login=False)) for j in xrange(LOG_PAGES)]
+                bodies += [read_from_network(d.get_reader('%s/images/GC%X-%d.jpg' % (base, i, j), login=False)) for j in xrange(IMAGES)]
+            return bodies
+        try:
+            enable_http_recording(archive)
+            start = time()
+            d = FileDownloader('', '', '/tmp/agtl-benchmark-cookies')
+            recorded = download(d)
+            d.pool.close()
+            downloader.HTTP_RECORD_PATH = None
+            size = sum(os.path.getsize(os.path.join(archive, 'bodies', name)) for name in os.listdir(os.path.join(archive, 'bodies')))
+            logger.info("%d caches, recorded from the stand-in server (%.0f ms, %.0f KB/s): %d requests, %d KB archive, %.2f s" % (count, rtt * 1000, bandwidth / 1024, server.requests, size / 1024, time() - start))
+            server.shutdown()
+            for title, latency, speed in (('replayed without delays', 0, 0), ('replayed with the same delays', rtt, bandwidth)):
+                enable_http_replay(archive, latency, speed)
+                start = time()
+                replayed = download(FileDownloader('', '', '/tmp/agtl-benchmark-cookies'))
+                logger.info("%d caches, %s: %.2f s, %s" % (count, title, time() - start, 'identical' if replayed == recorded else 'DIFFERENT'))
+        finally:
+            shutil.rmtree(archive)
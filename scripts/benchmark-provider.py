@@ -0,0 +1,616 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#   Copyright (C) 2012 Daniel Fett
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Author: Daniel Fett agtl@danielfett.de
+#   Jabber: fett.daniel@jaber.ccc.de
+#   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
+#
+
+# Benchmarks for the database layer (advancedcaching/provider.py). Each
+# mode works on temporary databases filled with random geocaches, which
+# are removed afterwards, including the files of the write-ahead log.
+
+from __future__ import with_statement
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'advancedcaching'))
+
+import logging
+import random
+import tempfile
+from contextlib import contextmanager
+from json import dumps, loads
+from sqlite3 import connect, Row
+from time import time
+import geo
+import geocaching
+from provider import PointProvider
+logger = logging.getLogger('benchmark')
+
+
+@contextmanager
+def temporary_database():
+    """
+    Yield the name of a new, empty database file and remove it afterwards, along with the files SQLite creates next to it.
+    
+    """
+    handle, filename = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    try:
+        yield filename
+    finally:
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+
+if __name__ == '__main__':
+    # Run with "viewports [size ...]", "details [size]",
+    # "search [size]", "statements [size]", "redraws [size]",
+    # "concurrency [size]", "iterate [size]", "maintenance [size]",
+    # "compression [size]" or "clusters [size ...]".
+    #
+    # viewports: Fills temporary databases of growing size with random
+    # geocaches and measures the time it takes to query a map-sized rectangle.
+    #
+    # details: Fills a database which still has the old layout (details
+    # in the geocache table) with geocaches with realistic details, then
+    # compares scan times and file size before and after the migration.
+    #
+    # search: Compares searching with the full text index to LIKE queries,
+    # then checks that non-ASCII text given as UTF-8 or unicode is found.
+    #
+    # statements: Measures map redraws with a filter, with and without the
+    # statement cache.
+    #
+    # redraws: Measures map redraws as they happen while following the GPS
+    # position, with and without the result cache.
+    #
+    # concurrency: Measures map redraws while geocaches are being stored,
+    # in the main loop as before and from a download thread with both
+    # journal modes.
+    #
+    # iterate: Compares the peak memory usage of reading all geocaches
+    # with iter_all and get_all.
+    #
+    # maintenance: Removes half of the geocaches and compares a full VACUUM
+    # to the steps of maintain.
+    #
+    # compression: Compares the file size, the time to open the database
+    # and show the map, and the time to show a geocache in detail, with
+    # and without compressed details.
+    #
+    # clusters: Measures the time for the overview of a screen at low zoom
+    # levels from the clusters, compared to the query which was run before,
+    # and the cost of keeping the clusters up to date when inserting.
+    logging.basicConfig(level=logging.INFO,
+                    format='%(relativeCreated)6d %(levelname)10s %(name)-20s %(message)s',
+                    )
+
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'viewports'
+    QUERIES = 200
+    # Roughly the size of Germany, and roughly the area shown on a N900 screen at zoom level 11
+    AREA = (47.0, 55.0, 6.0, 15.0)
+    VIEWPORT = (0.2, 0.4)
+
+    random.seed(42)
+    viewports = []
+    for i in xrange(QUERIES):
+        lat = random.uniform(AREA[0], AREA[1] - VIEWPORT[0])
+        lon = random.uniform(AREA[2], AREA[3] - VIEWPORT[1])
+        viewports.append((geo.Coordinate(lat, lon), geo.Coordinate(lat + VIEWPORT[0], lon + VIEWPORT[1])))
+
+    template = geocaching.GeocacheCoordinate(0, 0).serialize()
+    words = [u''.join(random.choice(u'abcdefghijklmnopqrstuvwxyz') for i in xrange(random.randint(3, 10))) for j in xrange(20000)]
+    words += [u'<b>', u'</b>', u'<br />', u'&amp;']
+    def rows(size, details=False, scale=1):
+        def text(n):
+            return u' '.join(random.choice(words) for i in xrange(max(1, int(n * scale))))
+        for i in xrange(size):
+            row = dict(template)
+            row['name'] = 'GC%X' % i
+            row['title'] = text(4 / scale)
+            row['owner'] = text(1 / scale)
+            row['type'] = random.choice(geocaching.GeocacheCoordinate.TYPES)
+            row['size'] = random.randint(1, 5)
+            row['difficulty'] = random.choice(range(10, 55, 5))
+            row['terrain'] = random.choice(range(10, 55, 5))
+            row['found'] = int(random.random() < 0.2)
+            row['lat'] = random.uniform(AREA[0], AREA[1])
+            row['lon'] = random.uniform(AREA[2], AREA[3])
+            if details:
+                # Typical sizes of fully downloaded geocaches
+                row['shortdesc'] = text(40)
+                row['desc'] = text(800)
+                row['hints'] = text(10)
+                row['waypoints'] = dumps([{'name': text(3), 'lat': row['lat'], 'lon': row['lon'], 'comment': text(20)} for j in xrange(3)])
+                row['images'] = dumps(dict(('%d.jpg' % j, text(3)) for j in xrange(3)))
+                row['logs'] = dumps([{'type': 'smile', 'finder': text(1), 'year': 2012, 'month': 1, 'day': 1, 'text': text(40)} for j in xrange(20)])
+            yield row
+
+    def measure(p, query, args_callback, load=True):
+        start = time()
+        count = 0
+        for c1, c2 in viewports:
+            c = p.conn.execute(query, args_callback(c1, c2))
+            count += len(p._pack_result(c) if load else c.fetchall())
+        return count, (time() - start) / QUERIES * 1000
+
+    if mode == 'viewports':
+        sizes = [int(x) for x in sys.argv[2:]] or [10000, 100000, 500000]
+        for size in sizes:
+            with temporary_database() as filename:
+                p = PointProvider(filename, geocaching.GeocacheCoordinate)
+                start = time()
+                p.conn.executemany(p.insert_query, rows(size))
+                p.save()
+                logger.info("%7d rows: inserted in %.2f s" % (size, time() - start))
+
+                rtree_query = 'SELECT * FROM %s WHERE %s LIMIT %d' % (p.cache_table, p.location_condition, PointProvider.MAX_RESULTS)
+                rtree_args = lambda c1, c2: p._location_filter(c1, c2).args
+                # For comparison: the query which was used before the spatial index was introduced.
+                btree_query = 'SELECT * FROM %s WHERE (lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?) LIMIT %d' % (p.cache_table, PointProvider.MAX_RESULTS)
+                btree_args = lambda c1, c2: (c1.lat, c2.lat, c1.lon, c2.lon)
+
+                found, rtree = measure(p, rtree_query, rtree_args)
+                found_count, rtree_count = measure(p, rtree_query.replace('SELECT *', 'SELECT count(*)'), rtree_args, False)
+                p.conn.execute('CREATE INDEX %(table)s_latlon ON %(table)s (lat ASC, lon ASC)' % {'table': p.cache_table})
+                found_btree, btree = measure(p, btree_query, btree_args)
+                found_count, btree_count = measure(p, btree_query.replace('SELECT *', 'SELECT count(*)'), btree_args, False)
+
+                if found != found_btree:
+                    logger.error("Result mismatch: %d results with spatial index, %d with lat/lon index" % (found, found_btree))
+                logger.info("%7d rows: %.1f results per viewport" % (size, found / float(QUERIES)))
+                logger.info("%7d rows: spatial index: %.2f ms per viewport (%.3f ms without loading the rows)" % (size, rtree, rtree_count))
+                logger.info("%7d rows: lat/lon index: %.2f ms per viewport (%.3f ms without loading the rows)" % (size, btree, btree_count))
+                del p
+
+    elif mode == 'details':
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+        with temporary_database() as filename:
+            # Database layout from before the details table was introduced
+            conn = connect(filename)
+            conn.execute('CREATE TABLE geocaches (%s)' % ', '.join('`%s` %s' % m for m in geocaching.GeocacheCoordinate.SQLROW.items()))
+            columns = geocaching.GeocacheCoordinate.SQLROW.keys()
+            conn.executemany("INSERT INTO geocaches (`%s`) VALUES (%s)" % ('`, `'.join(columns), ', '.join(':%s' % k for k in columns)), rows(size, True))
+            conn.execute('CREATE INDEX geocaches_latlon ON geocaches (lat ASC, lon ASC)')
+            conn.commit()
+            conn.close()
+
+            viewport_query = 'SELECT * FROM geocaches WHERE (lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?) LIMIT %d' % PointProvider.MAX_RESULTS
+            viewport_args = lambda c1, c2: (c1.lat, c2.lat, c1.lon, c2.lon)
+            def scan(p):
+                start = time()
+                count = len(p._pack_result(p.conn.execute('SELECT * FROM geocaches WHERE found = 0')))
+                return count, (time() - start) * 1000
+
+            class LegacyProvider(PointProvider):
+                # Reads the old layout without migrating it
+                def __init__(self, filename, ctype):
+                    self.conn = connect(filename)
+                    self.conn.row_factory = Row
+                    self.conn.text_factory = unicode
+                    self.ctype = ctype
+                    self.stype = None
+
+            for step in ('before', 'after'):
+                if step == 'before':
+                    p = LegacyProvider(filename, geocaching.GeocacheCoordinate)
+                else:
+                    start = time()
+                    p = PointProvider(filename, geocaching.GeocacheCoordinate)
+                    logger.info("%7d rows: migration took %.2f s" % (size, time() - start))
+                    p.conn.execute('CREATE INDEX IF NOT EXISTS geocaches_latlon ON geocaches (lat ASC, lon ASC)')
+                found, viewport = measure(p, viewport_query, viewport_args)
+                count, full_scan = scan(p)
+                logger.info("%7d rows, %s: %.1f MB, %.2f ms per viewport (%.1f results), %.0f ms to scan the whole table" % (size, step, os.path.getsize(filename) / 1048576.0, viewport, found / float(QUERIES), full_scan))
+                del p
+
+    elif mode == 'search':
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        with temporary_database() as filename:
+            p = PointProvider(filename, geocaching.GeocacheCoordinate)
+            start = time()
+            data = list(rows(size, True, 0.1))
+            p.conn.executemany(p.insert_query, data)
+            p.conn.executemany(p.details_replace_query, data)
+            p.save()
+            logger.info("%7d rows: inserted in %.2f s, %.1f MB" % (size, time() - start, os.path.getsize(filename) / 1048576.0))
+            del data
+
+            searches = [random.choice(words[:-4]) for i in xrange(QUERIES)]
+            def measure_search(callback):
+                start = time()
+                count = 0
+                for word in searches:
+                    count += len(callback(word))
+                return count / float(QUERIES), (time() - start) / QUERIES * 1000
+
+            def text_search(word):
+                p.set_filter(text_search=word)
+                return p.get_points_filter(summary=True)
+            def prefix_search(word):
+                p.set_filter(text_search=word[:3])
+                return p.get_points_filter(summary=True)
+            def name_search(word):
+                p.set_filter(name_search=word)
+                return p.get_points_filter(summary=True)
+            def like_search(word):
+                # What searching the descriptions would cost without the index
+                return p.conn.execute("SELECT name FROM %s WHERE desc LIKE ? LIMIT %d" % (p.details_table, PointProvider.MAX_RESULTS), ('%%%s%%' % word,)).fetchall()
+
+            for title, callback in (('full text, whole word', text_search), ('full text, 3 letter prefix', prefix_search), ('full text, names only', p.search_names), ('LIKE on name and title', name_search), ('LIKE on descriptions', like_search)):
+                results, duration = measure_search(callback)
+                logger.info("%7d rows: %s: %.2f ms per search (%.1f results)" % (size, title, duration, results))
+
+            # The GUIs search with the UTF-8 encoded text of their entry fields
+            row = rows(1).next()
+            row.update({'name': 'GCUML', 'title': u'M\xfcllers Schatz', 'owner': u'Gr\xfcn & M\xfcller'})
+            p.conn.execute(p.insert_query, row)
+            p.save()
+            for query in ('M\xc3\xbcller', u'M\xfcller'):
+                for criteria in ({'owner_search': query}, {'name_search': query}):
+                    p.set_filter(**criteria)
+                    found = [c.name for c in p.get_points_filter(summary=True)]
+                    if found != ['GCUML']:
+                        raise AssertionError("Searching for %r found %r" % (criteria, found))
+                p.set_filter(text_search=query)
+                found = ([c.name for c in p.get_points_filter(summary=True)], p.search_names(query))
+                if found != (['GCUML'], ['GCUML']):
+                    raise AssertionError("Full text search for %r found %r" % (query, found))
+            logger.info("non-ASCII searches by owner, name and full text: ok")
+            del p
+
+    elif mode == 'statements':
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+        with temporary_database() as filename:
+            p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+            p.conn.executemany(p.insert_query, rows(size))
+            p.save()
+            p.set_filter(found=False, size=[1, 2, 3], terrain=[1, 1.5, 2], ctype=[geocaching.GeocacheCoordinate.TYPE_REGULAR])
+
+            for title, clear in (('cached', False), ('rebuilt', True)):
+                start = time()
+                count = 0
+                for i in xrange(5):
+                    for c1, c2 in viewports:
+                        if clear:
+                            p.statements.clear()
+                            del p.statement_keys[:]
+                        count += len(p.get_points_filter((c1, c2), summary=True))
+                logger.info("%7d rows: statements %s: %.3f ms per redraw (%.1f results)" % (size, title, (time() - start) / (5 * QUERIES) * 1000, count / (5.0 * QUERIES)))
+            start = time()
+            for i in xrange(10000):
+                p._get_statement(p.filter + p._location_filter(viewports[0][0], viewports[0][1]), True, PointProvider.MAX_RESULTS)
+            logger.info("cached statement lookup: %.1f us" % ((time() - start) / 10000 * 1000000))
+            start = time()
+            for i in xrange(10000):
+                p.statements.clear()
+                del p.statement_keys[:]
+                p._get_statement(p.filter + p._location_filter(viewports[0][0], viewports[0][1]), True, PointProvider.MAX_RESULTS)
+            logger.info("building the statement: %.1f us" % ((time() - start) / 10000 * 1000000))
+            del p
+
+    elif mode == 'redraws':
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        with temporary_database() as filename:
+            p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+            p.conn.executemany(p.insert_query, rows(size))
+            p.save()
+
+            # Each viewport is redrawn a few times for new GPS fixes, moved
+            # by a few pixels and then panned by a quarter of its size.
+            redraws = []
+            for c1, c2 in viewports[:50]:
+                for i in xrange(10):
+                    redraws.append((c1, c2))
+                for i in xrange(1, 6):
+                    d = VIEWPORT[0] / 100 * i
+                    redraws.append((geo.Coordinate(c1.lat + d, c1.lon + d), geo.Coordinate(c2.lat + d, c2.lon + d)))
+                for i in xrange(1, 5):
+                    d = VIEWPORT[1] / 4 * i
+                    redraws.append((geo.Coordinate(c1.lat, c1.lon + d), geo.Coordinate(c2.lat, c2.lon + d)))
+
+            results = {}
+            for title, cache_size in (('without result cache', 0), ('with result cache', PointProvider.RESULT_CACHE_SIZE)):
+                p.RESULT_CACHE_SIZE = cache_size
+                start = time()
+                results[cache_size] = [sorted(x.name for x in p.get_points_filter((c1, c2), None, PointProvider.MAX_RESULTS, summary=True)) for c1, c2 in redraws]
+                logger.info("%7d rows: %s: %.3f ms per redraw (%.1f results)" % (size, title, (time() - start) / len(redraws) * 1000, sum(len(x) for x in results[cache_size]) / float(len(redraws))))
+            if results[0] != results[PointProvider.RESULT_CACHE_SIZE]:
+                logger.error("Result mismatch")
+            del p
+
+    elif mode == 'concurrency':
+        from threading import Thread
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        BATCH = 500
+        def caches(count, offset):
+            for i, row in enumerate(rows(count)):
+                row['name'] = 'GCX%X' % (offset + i)
+                yield geocaching.GeocacheCoordinate(None, data=row)
+        updates = [list(caches(BATCH, i * BATCH)) for i in xrange(20)]
+
+        for title, journal_mode, threaded in (('writes in main loop', 'WAL', False), ('rollback journal', 'DELETE', True), ('write-ahead log', 'WAL', True)):
+            with temporary_database() as filename:
+                p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+                p.conn.executemany(p.insert_query, rows(size))
+                p.save()
+                p.conn.execute('PRAGMA journal_mode = %s' % journal_mode)
+                p.RESULT_CACHE_SIZE = 0
+                redraw = lambda (c1, c2): p.get_points_filter((c1, c2), None, PointProvider.MAX_RESULTS, summary=True)
+
+                latencies = []
+                if threaded:
+                    writer = Thread(target=lambda: [p.add_points(batch) for batch in updates])
+                    writer.start()
+                    i = 0
+                    while writer.is_alive():
+                        start = time()
+                        redraw(viewports[i % QUERIES])
+                        latencies.append(time() - start)
+                        i += 1
+                    writer.join()
+                else:
+                    # Formerly, the geocaches were stored in an idle callback
+                    # in the main loop, so redraws had to wait for each batch.
+                    for i, batch in enumerate(updates):
+                        start = time()
+                        p.add_points(batch)
+                        redraw(viewports[i % QUERIES])
+                        latencies.append(time() - start)
+                logger.info("%7d rows: %s: %.2f ms average, %.2f ms maximum latency of %d redraws" % (size, title, sum(latencies) / len(latencies) * 1000, max(latencies) * 1000, len(latencies)))
+                del p
+
+    elif mode == 'iterate':
+        import resource
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        with temporary_database() as filename:
+            p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+            p.conn.executemany(p.details_replace_query, rows(size, True, 0.1))
+            p.conn.executemany(p.insert_query, rows(size))
+            p.save()
+            # The peak memory usage can only grow, so the iterator is measured first
+            for title, method in (('iter_all', p.iter_all), ('get_all', p.get_all)):
+                start = time()
+                found = sum(1 for x in method() if len(x.desc) > 0)
+                logger.info("%7d rows: %s: %.2f s, %d MB peak memory usage (%d with details)" % (size, title, time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, found))
+            del p
+
+    elif mode == 'maintenance':
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+        for title, full in (('full VACUUM', True), ('maintain', False)):
+            with temporary_database() as filename:
+                p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+                p.conn.executemany(p.details_replace_query, rows(size, True))
+                p.conn.executemany(p.insert_query, rows(size))
+                p.save()
+                p.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                before = os.path.getsize(filename)
+                p.conn.execute('DELETE FROM %s WHERE rowid %% 2 = 0' % p.cache_table)
+                p.save()
+                free = p.conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+                steps = []
+                start = time()
+                if full:
+                    # What optimize did before
+                    p.conn.execute('VACUUM')
+                    p._rebuild_spatial_index()
+                    p._rebuild_search_index()
+                    p.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                    steps.append(time() - start)
+                else:
+                    step = time()
+                    for pages, left in p.maintain():
+                        steps.append(time() - step)
+                        step = time()
+                logger.info("%7d rows: %s: %d free pages, %.2f s in total, %d steps, longest step %.0f ms, %.1f MB -> %.1f MB" % (size, title, free, time() - start, len(steps), max(steps) * 1000, before / 1048576.0, os.path.getsize(filename) / 1048576.0))
+                del p
+
+    elif mode == 'compression':
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+        names = ['GC%X' % random.randrange(size) for i in xrange(QUERIES)]
+        for title, compress in (('plain text', False), ('compressed', True)):
+            PointProvider.COMPRESS_DETAILS = compress
+            with temporary_database() as filename:
+                p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+                p.conn.executemany(p.details_replace_query, (p._compress_details(row) for row in rows(size, True)))
+                p.conn.executemany(p.insert_query, rows(size))
+                p.save()
+                p.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                stored = p.conn.execute('SELECT sum(%s) FROM %s' % (' + '.join('length(`%s`)' % k for k in geocaching.GeocacheCoordinate.COMPRESSED_ATTRS), p.details_table)).fetchone()[0]
+                del p
+
+                start = time()
+                p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+                p.get_points_filter(viewports[0], None, PointProvider.MAX_RESULTS, summary=True)
+                opened = time() - start
+
+                start = time()
+                for name in names:
+                    c = p.get_by_name(name)
+                    c.desc, c.get_logs(), c.get_images()
+                details = (time() - start) / len(names)
+                logger.info("%7d rows: %s: %.1f MB (%.1f MB in the compressible fields), %.1f ms to open, %.2f ms per detail view" % (size, title, os.path.getsize(filename) / 1048576.0, stored / 1048576.0, opened * 1000, details * 1000))
+                del p
+
+    elif mode == 'clusters':
+        sizes = [int(x) for x in sys.argv[2:]] or [10000, 100000]
+        for size in sizes:
+            data = list(rows(size))
+            times = {}
+            for clusters in (False, True):
+                with temporary_database() as filename:
+                    p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+                    if not clusters:
+                        for trigger in ('insert', 'update', 'delete'):
+                            p.conn.execute('DROP TRIGGER %s_clusters_%s' % (p.cache_table, trigger))
+                    start = time()
+                    p.conn.executemany(p.insert_query, data)
+                    p.save()
+                    times[clusters] = time() - start
+                    if not clusters:
+                        del p
+                        continue
+                    logger.info("%7d rows: inserted in %.2f s with clusters, %.2f s without" % (size, times[True], times[False]))
+
+                    for zoom in (5, 7, 9):
+                        # The screen of a N900, 800x480 pixels
+                        span = (480.0 / 256 * 180 / 2 ** zoom, 800.0 / 256 * 360 / 2 ** zoom)
+                        screens = [(geo.Coordinate(c1.lat, c1.lon), geo.Coordinate(c1.lat + span[0], c1.lon + span[1])) for c1, c2 in viewports]
+                        start = time()
+                        count = sum(sum(x[2] for x in p.get_clusters(screen, zoom)) for screen in screens)
+                        from_clusters = (time() - start) / len(screens)
+                        start = time()
+                        for screen in screens:
+                            p.get_points_filter(screen, None, 100, summary=True)
+                        query = (time() - start) / len(screens)
+                        logger.info("%7d rows: zoom %d: %.2f ms per screen from the clusters (%.0f geocaches), %.2f ms for the query with 100 results" % (size, zoom, from_clusters * 1000, count / float(len(screens)), query * 1000))
+                    del p
+
+    elif mode == 'changes':
+        sizes = [int(x) for x in sys.argv[2:]] or [10000, 100000]
+        for size in sizes:
+            with temporary_database() as filename:
+                p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+                data = list(rows(size + 50))
+                data, new = data[:size], data[size:]
+                p.conn.executemany(p.insert_query, data)
+                p.save()
+                # A download of 500 geocaches, some of them new
+                seq = p.get_change_seq()
+                batch = random.sample(data, 450) + new
+                p.conn.executemany(p.replace_query, batch)
+                p.save()
+                start = time()
+                new_seq, changed, removed = p.get_changes_since(seq, summary=True)
+                delta = time() - start
+                start = time()
+                everything = list(p.iter_points_filter(summary=True))
+                reload = time() - start
+                logger.info("%7d rows: %d changes in %.1f ms, reloading %d geocaches in %.1f ms" % (size, len(changed) + len(removed), delta * 1000, len(everything), reload * 1000))
+                del p
+
+    elif mode == 'nearest':
+        sizes = [int(x) for x in sys.argv[2:]] or [10000, 100000]
+        for size in sizes:
+            with temporary_database() as filename:
+                p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+                p.conn.executemany(p.insert_query, rows(size))
+                p.save()
+                centers = [geo.Coordinate(random.uniform(AREA[0], AREA[1]), random.uniform(AREA[2], AREA[3])) for i in xrange(20)]
+                # For comparison: ordering the whole table by the distance, as
+                # ORDER BY on a computed distance does
+                reader = p._get_reader()
+                reader.create_function('distance', 4, lambda lat1, lon1, lat2, lon2: geo.distance_to(geo.Coordinate(lat1, lon1), geo.Coordinate(lat2, lon2)))
+                full_query = 'SELECT * FROM %s ORDER BY distance(lat, lon, ?, ?) LIMIT %d' % (p.cache_table, PointProvider.MAX_RESULTS)
+                missed = 0
+                wrong = 0
+                times = [0, 0, 0]
+                for center in centers:
+                    # as the search used to do: any MAX_RESULTS geocaches, sorted afterwards
+                    start = time()
+                    points = p.get_points_filter()
+                    for c in points:
+                        c.prox = c.distance_to(center)
+                    points.sort(cmp=lambda x, y: cmp(x.prox, y.prox))
+                    times[0] += time() - start
+                    start = time()
+                    exact = p._pack_result(reader.execute(full_query, (center.lat, center.lon)))
+                    times[1] += time() - start
+                    start = time()
+                    nearest = p.get_points_filter(center=center)
+                    times[2] += time() - start
+                    missed += len(set(c.name for c in exact[:100]) - set(c.name for c in points[:100]))
+                    wrong += len(set(c.name for c in exact) ^ set(c.name for c in nearest))
+                if wrong > 0:
+                    logger.error("Result mismatch: %d geocaches differ between the full sort and the nearest neighbour search" % wrong)
+                logger.info("%7d rows: sorting in Python %.1f ms per search (%.0f of the nearest 100 missing), sorting the table in SQL %.1f ms, nearest neighbour search %.1f ms" % (size, times[0] / len(centers) * 1000, missed / float(len(centers)), times[1] / len(centers) * 1000, times[2] / len(centers) * 1000))
+                del p
+
+    elif mode == 'objects':
+        import gc
+        import resource
+        def resident():
+            gc.collect()
+            return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        with temporary_database() as filename:
+            p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+            p.conn.executemany(p.insert_query, rows(size))
+            p.save()
+            for title, columns, make in (('geocaches', '*', p._make_geocache), ('summaries', p.summary_columns, p.stype)):
+                # The rows hold the values, so only the objects themselves are measured
+                result = p.conn.execute('SELECT %s FROM %s' % (columns, p.cache_table)).fetchall()
+                before = resident()
+                start = time()
+                objects = [make(row) for row in result]
+                elapsed = time() - start
+                logger.info("%7d rows: %s: %.0f bytes per object, %.1f us to create one" % (size, title, (resident() - before) / float(size), elapsed / size * 1000000))
+                del objects, result
+            del p
+
+    elif mode == 'json':
+        with temporary_database() as filename:
+            p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+            data = list(rows(100, True))
+            for row in data:
+                row['logs'] = dumps(loads(row['logs']) * 25)
+            p.conn.executemany(p.insert_query, data)
+            p.conn.executemany(p.details_replace_query, data)
+            p.save()
+            parses = [0]
+            def counting_loads(text, loads=geocaching.loads, **kwargs):
+                parses[0] += 1
+                return loads(text, **kwargs)
+            geocaching.loads = counting_loads
+            start = time()
+            for row in data:
+                c = p.get_by_name(row['name'])
+                # the status check after a download, the log view and its pages
+                for i in xrange(4):
+                    c.get_logs()
+                c.get_waypoints(), c.get_images()
+                c.serialize()
+            logger.info("500 logs per geocache: %.1f ms to open one, %.1f JSON fields parsed" % ((time() - start) / len(data) * 1000, parses[0] / float(len(data))))
+            del p
+
+    elif mode == 'writes':
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        with temporary_database() as filename:
+            p = PointProvider(filename, geocaching.GeocacheCoordinate, geocaching.GeocacheSummary)
+            data = list(rows(size, True))
+            p.conn.executemany(p.details_replace_query, [p._compress_details(row) for row in data])
+            p.conn.executemany(p.insert_query, data)
+            p.save()
+            def add_point(c):
+                p.add_point(c, True)
+                p.save()
+            # toggling "marked" of an opened geocache, one commit each as in the user interface
+            for title, write in (('add_point', add_point), ('save_changes', lambda c: p.save_changes([c]))):
+                caches = [p.get_by_name(row['name']) for row in data]
+                for c in caches:
+                    c.get_logs()
+                # the size of the WAL is the amount of data written
+                p.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                p.conn.execute('PRAGMA wal_autocheckpoint = 0')
+                start = time()
+                for c in caches:
+                    c.marked = not c.marked
+                    write(c)
+                logger.info("%7d geocaches: %s: %.2f ms per change, %.1f MB written to the WAL" % (size, title, (time() - start) / size * 1000, os.path.getsize(filename + '-wal') / 1048576.0))
+            del p